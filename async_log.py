@@ -0,0 +1,197 @@
+import logging
+import threading
+import traceback
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+from experimentlog import AnchoredClock, ExperimentException
+
+try:
+    from concurrent.futures import Future
+except ImportError:
+    class Future(object):
+        """Minimal stand-in for concurrent.futures.Future, where it is not available"""
+        def __init__(self):
+            self._done = threading.Event()
+            self._result = self._exception = None
+
+        def set_result(self, result):
+            self._result = result
+            self._done.set()
+
+        def set_exception(self, exception):
+            self._exception = exception
+            self._done.set()
+
+        def done(self):
+            return self._done.is_set()
+
+        def result(self, timeout=None):
+            if not self._done.wait(timeout):
+                raise RuntimeError("Timed out waiting for the log")
+            if self._exception is not None:
+                raise self._exception
+            return self._result
+
+# queued to stop the writer thread
+_STOP = object()
+
+class AsyncExperimentLog(object):
+    """Non-blocking front end for an ExperimentLog, or a zmq_log.LogProxy.
+
+    The log is owned by a dedicated writer thread, and every call returns at once with a future for
+    its result: an asyncio future, which can be awaited, if asyncio is available, and otherwise a
+    concurrent.futures.Future (with result()). Consecutive log() calls queued up while the writer is
+    busy are written together with log_many(), in one transaction (and one round trip to a LogProxy).
+
+    log() timestamps entries when it is called (with the log's clock), not when they are written.
+
+        alog = AsyncExperimentLog(lambda: ExperimentLog("my.db"))
+        alog.enter("Trial")
+        alog.log("mouse", data={"x":x, "y":y})
+        alog.flush().result()
+
+    (Under Python 3, where asyncio is available, the futures are awaited instead: await alog.flush().)
+    Calls made after close() raise ExperimentException.
+
+    Parameters:
+        factory: function returning the log. It is called in the writer thread, as neither SQLite
+                 connections nor 0MQ sockets can be shared between threads.
+        max_batch: the maximum number of log() calls written together
+        loop: the asyncio event loop the futures belong to (default: the current event loop)
+    """
+    def __init__(self, factory, max_batch=1000, loop=None):
+        self.queue = queue.Queue()
+        self.max_batch = max_batch
+        self.loop = loop
+        self.ready = threading.Event()
+        # nothing can be queued after close()
+        self.lock = threading.RLock()
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self._write, args=(factory,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    def _submit(self, name, args=(), kwargs={}):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise ExperimentException("The asynchronous log is closed")
+            self.queue.put((name, args, kwargs, future))
+        if asyncio is not None:
+            return asyncio.wrap_future(future, loop=self.loop)
+        return future
+
+    def log(self, stream, t=None, t_ns=None, **kwargs):
+        """Log an entry; see ExperimentLog.log(). The future gives the id of the entry."""
+        if t is None and t_ns is None:
+            t_ns = self.clock.time_ns()
+        kwargs.update(stream=stream, t=t, t_ns=t_ns)
+        return self._submit("log", kwargs=kwargs)
+
+    def enter(self, *args, **kwargs):
+        return self._submit("enter", args, kwargs)
+
+    def leave(self, *args, **kwargs):
+        return self._submit("leave", args, kwargs)
+
+    def cd(self, path):
+        return self._submit("cd", (path,))
+
+    def bind(self, *args, **kwargs):
+        return self._submit("bind", args, kwargs)
+
+    def call(self, name, *args, **kwargs):
+        """Call any other method of the log"""
+        return self._submit(name, args, kwargs)
+
+    def flush(self):
+        """Commit everything logged so far; the future completes once it is stored"""
+        return self._submit("commit")
+
+    def close(self):
+        """Close the log, and stop the writer thread once everything queued has been written"""
+        with self.lock:
+            future = self._submit("close")
+            self.closed = True
+            self.queue.put(_STOP)
+        return future
+
+    def _write(self, factory):
+        """The writer thread"""
+        try:
+            explog = factory()
+            self.clock = AnchoredClock(anchor=explog.clock_anchor)
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            self.ready.set()
+
+        stopped = False
+        while not stopped:
+            # everything queued up since the last batch
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stopped = True
+                batch = [item for item in batch if item is not _STOP]
+            i = 0
+            while i < len(batch):
+                # write runs of consecutive log() calls together
+                j = i
+                while j < len(batch) and batch[j][0]=="log":
+                    j += 1
+                if j > i:
+                    self._run_log_many(explog, batch[i:j])
+                    i = j
+                else:
+                    name, args, kwargs, future = batch[i]
+                    self._run(explog, name, args, kwargs, future)
+                    i += 1
+
+    def _run(self, explog, name, args, kwargs, future):
+        """Call the method name of the log, and complete the future with the result"""
+        try:
+            result = getattr(explog, name)(*args, **kwargs)
+        except Exception as e:
+            logging.error("Asynchronous log call failed:\n%s" % traceback.format_exc())
+            future.set_exception(e)
+            return
+        future.set_result(result)
+        
+    def _run_log_many(self, explog, items):
+        """Write the queued log() items with log_many(), and complete their futures with their ids. Only the 
+        item which could not be logged fails; the items before it were written, and the items after it are retried."""
+        while items:
+            try:
+                ids = explog.log_many([kwargs for _, _, kwargs, _ in items])
+            except Exception as e:
+                logging.error("Asynchronous log call failed:\n%s" % traceback.format_exc())
+                written = getattr(e, "written", None)
+                if written is None:
+                    # no way to tell which were written
+                    for item in items:
+                        item[3].set_exception(e)
+                    return
+                for item, id in zip(items, written):
+                    item[3].set_result(id)
+                items[len(written)][3].set_exception(e)
+                items = items[len(written)+1:]
+                continue
+            for item, id in zip(items, ids):
+                item[3].set_result(id)
+            return
@@ -1,15 +1,28 @@
 import sqlite3
-import time
 import os, sys
+import tempfile
+from experimentlog import backup_database
+import extract
 
+# dump.py <in_db> <out_db>: online copy of the database, even while it is being written
+# dump.py <in_db> <out.sql[.gz]>: SQL text dump (of a copy), gzip compressed if the name ends .gz
 if len(sys.argv)==3:
-    in_db = sys.argv[1]
+    in_db, out = sys.argv[1], sys.argv[2]
     conn = sqlite3.connect(in_db)        
-    print("Dumping %s to %s" % (sys.argv[1], sys.argv[2]))
-    with open(sys.argv[2], "w") as f:
-        for l in conn.iterdump():
-            f.write(l)
+    if out.endswith(".sql") or out.endswith(".sql.gz"):
+        print("Dumping %s to %s" % (in_db, out))
+        handle, snapshot = tempfile.mkstemp(suffix=".db", dir=os.path.dirname(os.path.abspath(out)))
+        os.close(handle)
+        try:
+            backup_database(conn, snapshot)
+            snapshot_conn = sqlite3.connect(snapshot)
+            with extract.open_archive(out, "w") as f:
+                extract.dump_sql(snapshot_conn, f)
+            snapshot_conn.close()
+        finally:
+            os.remove(snapshot)
+    else:
+        print("Backing up %s to %s" % (in_db, out))
+        backup_database(conn, out)
 else:
-    print "Usage: dump.py <in_db> <out_text>"
-            
-            
\ No newline at end of file
+    print "Usage: dump.py <in_db> <out_db | out.sql | out.sql.gz>"
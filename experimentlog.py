@@ -8,7 +8,17 @@ import numpy as np
 import platform
 import traceback
 import collections
+import os
+import re
+import hashlib
+import shutil
 from ntpsync import check_time_sync
+import payload
+import journal
+from records import LogRecord
+import threading
+import ctypes
+import ctypes.util
 from multiprocessing import RLock
 
 # save/load dictionaries of Numpy arrays from strings
@@ -22,6 +32,76 @@ def str_to_np(s):
     n = np.load(c)
     return n
 
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+    
+def _posix_monotonic_ns():
+    """Return a function reading CLOCK_MONOTONIC with clock_gettime() through ctypes, or None if it is not available"""
+    CLOCK_MONOTONIC = 1 # Linux
+    if not platform.system().startswith("Linux"):
+        return None
+    for name in ["c", "rt"]:
+        try:
+            clock_gettime = ctypes.CDLL(ctypes.util.find_library(name)).clock_gettime
+        except (OSError, AttributeError, TypeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        ts = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))!=0:
+            continue
+        def monotonic_ns():
+            ts = _timespec()
+            clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+            return ts.tv_sec * 1000000000 + ts.tv_nsec
+        return monotonic_ns
+    return None
+
+# integer nanosecond monotonic clock, shared by all processes on a host. 
+# Before Python 3.3, CLOCK_MONOTONIC is read through ctypes on Linux; only where that is not possible
+# does this fall back to the wall clock.
+if hasattr(time, "monotonic_ns"):
+    monotonic_ns = time.monotonic_ns
+elif hasattr(time, "monotonic"):
+    def monotonic_ns():
+        return int(time.monotonic() * 1e9)
+else:
+    monotonic_ns = _posix_monotonic_ns()
+    if monotonic_ns is None:
+        def monotonic_ns():
+            return int(time.time() * 1e9)
+        
+def wall_time_ns():
+    """Wall clock time, in integer nanoseconds since the epoch"""
+    if hasattr(time, "time_ns"):
+        return time.time_ns()
+    return int(time.time() * 1e9)
+    
+class AnchoredClock(object):
+    """Timestamps taken from the monotonic clock, mapped once onto (offset corrected) wall clock time.
+    Unlike time.time(), the timestamps do not jump if the system clock is adjusted while the clock is in use.
+    
+    The monotonic clock is shared by all the processes on a host, so a clock built from another clock's 
+    anchor gives the same timestamps in a different process (see zmq_log.LogProxy.clock()).
+    """
+    def __init__(self, offset=0, anchor=None):
+        """
+        offset: offset to apply to the wall clock time (e.g. from NTP), in seconds
+        anchor: (wall_ns, monotonic_ns) pair to map the monotonic clock with; if None, 
+                the clocks are sampled now
+        """
+        if anchor is None:
+            anchor = (wall_time_ns() + int(offset * 1e9), monotonic_ns())
+        self.anchor = tuple(anchor)
+        self.base_ns = self.anchor[0] - self.anchor[1]
+        
+    def time_ns(self):
+        """Return the time, in integer nanoseconds since the epoch"""
+        return self.base_ns + monotonic_ns()
+        
+    def time(self):
+        """Return the time, in seconds since the epoch"""
+        return (self.base_ns + monotonic_ns()) * 1e-9
+        
 # enable logging
 logFormatter = logging.Formatter(fmt="%(asctime)s [%(levelname)-5.5s]  %(message)s",
                                  datefmt='%m-%d %H:%M')
@@ -43,9 +123,191 @@ rootLogger.addHandler(consoleHandler)
 class ExperimentException(Exception):
     pass
 
+class BackupBusy(ExperimentException):
+    """The database was written to so often during a backup that it never completed (see backup_database())"""
+    pass
+
 def pretty_json(x):
     return json.dumps(x, sort_keys=True, indent=4, separators=(',', ': '))
             
+# SQLite C library, for the online backup API where the sqlite3 module does not expose it (before Python 3.7)
+SQLITE_OK, SQLITE_BUSY, SQLITE_LOCKED, SQLITE_DONE = 0, 5, 6, 101
+SQLITE_OPEN_READONLY, SQLITE_OPEN_CREATE = 1, 6
+_libsqlite = []
+
+def libsqlite():
+    """Return the SQLite library, loaded with ctypes, or None if it cannot be found"""
+    if not _libsqlite:
+        name = ctypes.util.find_library("sqlite3")
+        lib = None
+        if name is not None:
+            try:
+                lib = ctypes.CDLL(name)
+                lib.sqlite3_backup_init.restype = ctypes.c_void_p
+                lib.sqlite3_backup_init.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_char_p]
+                for fn in ["sqlite3_backup_step", "sqlite3_backup_remaining", "sqlite3_backup_finish", "sqlite3_close", 
+                           "sqlite3_errmsg", "sqlite3_busy_timeout"]:
+                    getattr(lib, fn).argtypes = [ctypes.c_void_p] + ([ctypes.c_int] if fn in ["sqlite3_backup_step", "sqlite3_busy_timeout"] else [])
+                lib.sqlite3_errmsg.restype = ctypes.c_char_p
+                lib.sqlite3_open_v2.argtypes = [ctypes.c_char_p, ctypes.POINTER(ctypes.c_void_p), ctypes.c_int, ctypes.c_char_p]
+            except (OSError, AttributeError):
+                lib = None
+        _libsqlite.append(lib)
+    return _libsqlite[0]
+    
+def _encode_fname(fname):
+    return fname.encode("utf8") if isinstance(fname, unicode) else fname
+    
+def _backup_steps(source, target, pages, sleep, max_restarts=10):
+    """Copy the database file source to target with SQLite's online backup API, on a connection of its own, 
+    pages pages at a time. The read lock on source is only held during each step, so writers carry on in 
+    between. A write to source restarts the copy, and the sleep between steps is doubled (up to a second) 
+    after each restart to let the copy catch up; after max_restarts restarts, BackupBusy is raised."""
+    lib = libsqlite()
+    src, dst = ctypes.c_void_p(), ctypes.c_void_p()
+    try:
+        if lib.sqlite3_open_v2(_encode_fname(source), ctypes.byref(src), SQLITE_OPEN_READONLY, None)!=SQLITE_OK:
+            raise ExperimentException("Cannot open %s to back it up" % source)
+        if lib.sqlite3_open_v2(_encode_fname(target), ctypes.byref(dst), SQLITE_OPEN_CREATE, None)!=SQLITE_OK:
+            raise ExperimentException("Cannot create the backup %s" % target)
+        lib.sqlite3_busy_timeout(src, 5000)
+        backup = lib.sqlite3_backup_init(dst, "main", src, "main")
+        if not backup:
+            raise ExperimentException("Cannot back up %s: %s" % (source, lib.sqlite3_errmsg(dst)))
+        restarts, remaining = 0, None
+        while True:
+            rc = lib.sqlite3_backup_step(backup, pages)
+            if rc==SQLITE_DONE:
+                break
+            if rc not in (SQLITE_OK, SQLITE_BUSY, SQLITE_LOCKED):
+                lib.sqlite3_backup_finish(backup)
+                raise ExperimentException("Backup of %s failed: %s" % (source, lib.sqlite3_errmsg(dst)))
+            left = lib.sqlite3_backup_remaining(backup)
+            if remaining is not None and left > remaining:
+                restarts += 1
+                if restarts > max_restarts:
+                    lib.sqlite3_backup_finish(backup)
+                    raise BackupBusy("Backup of %s restarted %d times by writes; abandoned" % (source, max_restarts))
+            remaining = left
+            delay = sleep if rc==SQLITE_OK and not restarts else max(sleep, 0.01)
+            time.sleep(min(1.0, delay * 2**restarts))
+        if lib.sqlite3_backup_finish(backup)!=SQLITE_OK:
+            raise ExperimentException("Backup of %s failed: %s" % (source, lib.sqlite3_errmsg(dst)))
+    finally:
+        lib.sqlite3_close(src)
+        lib.sqlite3_close(dst)
+
+def backup_database(conn, fname, pages=256, sleep=0.0, schema="main"):
+    """Copy the database (or attached schema) open on conn to the file fname, while it is in use.
+    
+    SQLite's online backup API copies pages pages at a time, sleeping for sleep seconds between steps: through
+    conn where the sqlite3 module has it (Python 3.7+), and otherwise through the SQLite library on a connection 
+    of its own. If neither is possible (e.g. an in-memory database), VACUUM INTO (SQLite 3.27+) writes a 
+    compacted copy in a single statement. The copy is written to a temporary file and then renamed, 
+    so fname is always a complete database."""
+    tmp_fname = fname + ".tmp"
+    if os.path.exists(tmp_fname):
+        os.remove(tmp_fname)
+    source = [f for _, name, f in conn.execute("PRAGMA database_list").fetchall() if name==schema][0]
+    if hasattr(conn, "backup"):
+        target = sqlite3.connect(tmp_fname)
+        try:
+            conn.backup(target, pages=pages, sleep=sleep, name=schema)
+        finally:
+            target.close()
+    elif source and libsqlite() is not None:
+        _backup_steps(source, tmp_fname, pages, sleep)
+    else:
+        conn.execute("VACUUM %s INTO ?" % schema, (tmp_fname,))
+    if os.path.exists(fname):
+        os.remove(fname)
+    os.rename(tmp_fname, fname)
+        
+def _has_table(conn, name, schema="main"):
+    return conn.execute("SELECT count(*) FROM %s.sqlite_master WHERE type='table' AND name=?" % schema, (name,)).fetchone()[0] > 0
+
+def create_field_indices(conn, schema, fields):
+    """Create the indices of the indexed payload fields (stream id, field) on the log in the given schema"""
+    for stream_id, field in fields:
+        conn.execute("CREATE INDEX IF NOT EXISTS %s.log_field_%d_%s_ix ON log(%s) WHERE stream=%d" % 
+                     (schema, stream_id, field.replace(".", "_"), payload.field_expression(field), stream_id))
+
+# indices for reading a finalized log; log_stream_ix matches the clustering order
+analysis_indices = [("log_stream_ix", "stream, session, time"), ("log_session_ix", "session, time, id"), 
+                    ("log_time_ix", "time"), ("log_tag_ix", "tag"), ("log_valid_ix", "valid")]
+    
+def _cluster_log(conn, schema, fields):
+    """Rewrite the log table in the given schema in (stream, session, time) order, and build the analysis 
+    indices. Returns the number of entries.
+    
+    The entries keep their ids: id becomes an ordinary (uniquely indexed) column rather than the rowid, 
+    so the rows are stored in the order they are inserted here. Entries logged afterwards are given 
+    their ids by ExperimentLog (see ExperimentLog._next_log_id())."""
+    sql = conn.execute("SELECT sql FROM %s.sqlite_master WHERE type='table' AND name='log'" % schema).fetchone()[0]
+    for index, in conn.execute("SELECT name FROM %s.sqlite_master WHERE type='index' AND tbl_name='log' AND sql IS NOT NULL" % schema).fetchall():
+        conn.execute("DROP INDEX %s.%s" % (schema, index))
+    conn.execute("CREATE TEMP TABLE log_clustered AS SELECT * FROM %s.log ORDER BY stream, session, time, id" % schema)
+    conn.execute("DROP TABLE %s.log" % schema)
+    sql = re.sub(r"\bid INTEGER PRIMARY KEY( AUTOINCREMENT)?", "id INTEGER NOT NULL", sql, count=1)
+    conn.execute(re.sub(r"^CREATE TABLE (\w+\.)?log\b", "CREATE TABLE %s.log" % schema, sql, count=1))
+    columns = ",".join(info[1] for info in conn.execute("PRAGMA %s.table_info(log)" % schema).fetchall())
+    conn.execute("INSERT INTO %s.log(%s) SELECT %s FROM temp.log_clustered ORDER BY rowid" % (schema, columns, columns))
+    n = conn.execute("SELECT count(*) FROM temp.log_clustered").fetchone()[0]
+    conn.execute("DROP TABLE temp.log_clustered")
+    conn.execute("CREATE UNIQUE INDEX %s.log_id_ix ON log(id)" % schema)
+    for index, columns in analysis_indices:
+        conn.execute("CREATE INDEX %s.%s ON log(%s)" % (schema, index, columns))
+    create_field_indices(conn, schema, fields)
+    return n
+    
+def finalize_database(conn, run=None, open_shard=None):
+    """Optimise the database open on conn for reading, once capture is complete. 
+    
+    The log is written in the order entries arrive, interleaving all of the streams, and without 
+    indices. This rewrites it clustered by (stream, session, time), so that reading a stream or session 
+    is sequential, builds the analysis indices, runs ANALYZE and VACUUM, and records the finalize in 
+    the dataset metadata ("finalized"). Log entries keep their ids. This can take a long time on a 
+    large database.
+    
+    Parameters:
+        run: the id of the run finalizing the database, if any, recorded in the dataset metadata
+        open_shard: in a sharded database, the id of the shard attached to conn as "shard", if any
+    
+    Returns:
+        the number of log entries
+    """
+    start = time.time()
+    conn.commit()
+    fields = []
+    if _has_table(conn, "indexed_fields"):
+        fields = conn.execute("SELECT stream, field FROM indexed_fields ORDER BY id").fetchall()
+    if _has_table(conn, "shards"):
+        fname = [f for _, name, f in conn.execute("PRAGMA database_list").fetchall() if name=="main"][0]
+        n = 0
+        for shard_id, shard_fname in conn.execute("SELECT id, fname FROM shards ORDER BY id").fetchall():
+            if shard_id==open_shard:
+                schema = "shard"
+            else:
+                schema = "finalize_shard"
+                conn.execute("ATTACH DATABASE ? AS finalize_shard", (os.path.join(os.path.dirname(fname), shard_fname),))
+            n += _cluster_log(conn, schema, fields)
+            conn.commit()
+            conn.execute("ANALYZE %s" % schema)
+            conn.execute("VACUUM %s" % schema)
+            if schema!="shard":
+                conn.execute("DETACH DATABASE finalize_shard")
+    else:
+        n = _cluster_log(conn, "main", fields)
+    row = conn.execute("SELECT json FROM meta WHERE id=(SELECT max(id) FROM meta WHERE mtype='DATASET')").fetchone()
+    dataset = json.loads(row[0]) if row is not None and row[0] else {}
+    dataset["finalized"] = dict(time=time.time(), run=run, log_entries=n)
+    conn.execute("INSERT INTO meta(json, mtype) VALUES (?, 'DATASET')", (json.dumps(dataset),))
+    conn.commit()
+    conn.execute("ANALYZE main")
+    conn.execute("VACUUM main")
+    logging.debug("Finalized %d log entries in %.1f seconds" % (n, time.time()-start))
+    return n
+        
 class MetaProxy(object):
         """Proxy for accessing whole-dataset metadata"""        
         
@@ -63,27 +325,108 @@ class MetaProxy(object):
         def __setattr__(self, attr, value):                        
             self._explog.set_meta(**{attr:value})
 
+def _unicode(name):
+    """Names as SQLite returns them: byte strings are taken to be UTF-8, so that a non-ASCII str 
+    matches the unicode name read back from the database"""
+    if isinstance(name, str):
+        return name.decode("utf-8")
+    return name
+    
+class MetaRegistry(object):
+    """In-memory index of the ids of the meta table, by (mtype, name). It is loaded once when the database 
+    is opened and kept up to date as metadata is created, so looking up streams, paths, users etc. 
+    never queries the database."""
+    def __init__(self, cursor=None):
+        self.ids = {}
+        if cursor is not None:
+            self.load(cursor)
+            
+    def load(self, cursor):
+        """(Re)load the registry from the meta table"""
+        self.ids = {}
+        for id, mtype, name in cursor.execute("SELECT id, mtype, name FROM meta ORDER BY id").fetchall():
+            self.ids.setdefault((mtype, _unicode(name)), id)
+            
+    def get(self, mtype, name):
+        """Return the id of the given metadata object, or None if it does not exist"""
+        return self.ids.get((mtype, _unicode(name)))
+        
+    def add(self, mtype, name, id):
+        self.ids.setdefault((mtype, _unicode(name)), id)
+        
+    def names(self, mtype):
+        """Return the names of all of the metadata objects of type mtype"""
+        return sorted(name for t, name in self.ids if t==mtype)
+        
+    def __len__(self):
+        return len(self.ids)
+        
 MetaTuple = collections.namedtuple('MetaTuple', ['mtype', 'name', 'type', 'description', 'json'])
+
+def read_records(cursor, from_id=0, streams=None, path=None, chunk_size=1000, log_table="log"):
+    """Read the log entries with id > from_id from the database, in id order.
+    
+    Parameters:
+        streams: If given, only read entries from these streams (a list of names)
+        path: If given, only read entries from sessions whose path begins with this prefix
+        chunk_size: number of entries read at a time
+        log_table: table to read from
+        
+    Returns:
+        generator of lists of LogRecord tuples, each up to chunk_size long
+    """
+    decoder = payload.PayloadDecoder(cursor)
+    query = "SELECT log.id, log.session, session.path, stream.name, log.time, log.valid, log.tag, log.json, log.binary, log.stream FROM %s AS log JOIN stream ON stream.id=log.stream JOIN session ON session.id=log.session WHERE log.id>?" % log_table
+    parameters = (from_id,)
+    if streams is not None:
+        query += " AND stream.name IN (%s)" % ",".join("?"*len(streams))
+        parameters += tuple(streams)
+    if path is not None:
+        query += " AND substr(session.path, 1, ?)=?"
+        parameters += (len(path), path)
+    result = cursor.execute(query + " ORDER BY log.id", parameters)
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield [LogRecord(id, session, spath, stream, t, valid, tag, decoder.loads(js, stream_id), binary) for id, session, spath, stream, t, valid, tag, js, binary, stream_id in rows]
             
 class ExperimentLog(object):
    
-    def __init__(self, fname, autocommit=None, ntp_sync=True, ntp_servers=None, run_config={}):
+    def __init__(self, fname, autocommit=None, ntp_sync=True, ntp_servers=None, run_config={}, shard=False, shard_size=None, store_ns=False,
+                 journal=False, journal_size=64<<20, journal_interval=None):
         """
         autocommit: If None, never autocommits. If an integer, autocommits every n seconds. If True,
                     autocommits on *every* write (not recommended)
+        shard: If True, the log and binary tables of each run are written to their own shard database
+               (fname.shard000001, ...), and fname only holds the catalog (runs, sessions, meta, ...). 
+               Sharding is fixed when the database is created. Use extract.open_shards() to read a sharded database.
+        shard_size: If given, a new shard is also started whenever the current shard grows beyond this many bytes.
+        store_ns: If True, log timestamps are also stored as integer nanoseconds since the epoch, in log.time_ns
+        journal: If True, log() appends entries to a memory mapped journal file (fname.journal) instead of writing 
+                 to the database, and they are imported into the log in bulk by import_journal(), close(),
+                 when the journal is full, or every journal_interval seconds in a background thread. 
+                 Entries left in the journal by a crash are imported when the database is next opened.
+        journal_size: size of the journal file, in bytes
+        journal_interval: If given, a background thread imports the journal every journal_interval seconds
                     """
         logging.debug("Opening database '%s'. Autocommit: '%s'" % (fname, autocommit))                 
         
         self.db_lock = RLock()
                 
         with self.db_lock:
-            self.conn = sqlite3.connect(fname)                        
+            self.fname = fname
+            # the background journal importer shares the connection, under the db_lock
+            self.conn = sqlite3.connect(fname, check_same_thread=journal_interval is None)
             self.cursor = self.conn.cursor()
         
             self.time_offset = 0
             if ntp_sync:
                 # synchronise the (global) time
                 self.time_offset = check_time_sync(n_queries=10, servers=ntp_servers)
+            # all timestamps come from the monotonic clock, anchored to the wall clock once, here
+            self.clock = AnchoredClock(offset=self.time_offset)
+            self.store_ns = store_ns
                         
             # extend the cache size and disable synchronous writing
             self.execute("PRAGMA cache_size=2000000;")
@@ -94,16 +437,34 @@ class ExperimentLog(object):
                          
             # create the tables
             table_exists = self.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='runs'").fetchone()[0]
+            shards_exist = self.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='shards'").fetchone()[0]
+            if shard and table_exists and not shards_exist:
+                raise ExperimentException("%s was not created with sharding; cannot shard it" % fname)
+            if shard and fname==":memory:":
+                raise ExperimentException("Cannot shard an in-memory database")
+            self.sharded = bool(shard or shards_exist)
+            self.shard_size = shard_size
             
             if not table_exists:            
                 self.create_tables()
             else:
                 logging.debug("Tables already created.")
+                self.upgrade_tables()
+            # set by _open_shard() if sharded
+            self.next_log_id = None if self.sharded else self._next_log_id()
                                 
             self.autocommit = autocommit                
             self.last_commit_time = self.real_time()              
             self.in_run = False
-            self.stream_cache = {}
+            # ids of the metadata, so the hot path never has to look them up in the database
+            self.registry = MetaRegistry(self.cursor)
+            self.path_cache = {}
+            self.load_codecs()
+            # subscribers to committed log records, and the records waiting to be committed
+            self.subscribers = []
+            self.pending = []
+            # periodic snapshots (see snapshot_every())
+            self.snapshot_thread = None
             self.opened = True
             
             # start in the root session
@@ -112,6 +473,20 @@ class ExperimentLog(object):
             
             # start the run
             self._start(run_config=run_config)
+            if self.sharded:
+                self._open_shard()
+                
+            self.journal = None
+            if journal or os.path.exists(self.journal_fname):
+                self._open_journal(journal_size)
+                if not journal:
+                    # only recovering the entries of an earlier journalled run
+                    self._close_journal()
+            self.journal_thread = None
+            if self.journal is not None and journal_interval is not None:
+                self.journal_thread = threading.Thread(target=self._import_journal_every, args=(journal_interval,))
+                self.journal_thread.daemon = True
+                self.journal_thread.start()
             
         
     def resume_session(self, id):
@@ -142,7 +517,12 @@ class ExperimentLog(object):
     
     def real_time(self):
         """Return offseted time"""
-        return time.time() + self.time_offset
+        return self.clock.time()
+        
+    @property
+    def clock_anchor(self):
+        """The (wall_ns, monotonic_ns) anchor of the clock, for building an identical AnchoredClock"""
+        return self.clock.anchor
     
     def create_tables(self):
         """Create the SQLite tables for the experiment, if they do not already exist"""
@@ -173,15 +553,26 @@ class ExperimentLog(object):
                     FOREIGN KEY (path) REFERENCES meta(id)
                     )''')
                             
-        # text tags which are recorded throughout the trial stream
-        self.execute('''CREATE TABLE IF NOT EXISTS log
-                    (id INTEGER PRIMARY KEY, session INT, valid INT, time REAL, stream INT, tag TEXT, json TEXT, binary INT,
-                    FOREIGN KEY(stream) REFERENCES meta(id),
-                    FOREIGN KEY(session) REFERENCES session(id),
-                    FOREIGN KEY(binary) REFERENCES binary(id))                    
-                    ''')
-                    
-        self.execute('''CREATE TABLE IF NOT EXISTS binary (id INTEGER PRIMARY KEY, binary BLOB)''')
+        if not self.sharded:
+            # text tags which are recorded throughout the trial stream
+            self.execute('''CREATE TABLE IF NOT EXISTS log
+                        (id INTEGER PRIMARY KEY, session INT, valid INT, time REAL, stream INT, tag TEXT, json TEXT, binary INT, time_ns INT,
+                        FOREIGN KEY(stream) REFERENCES meta(id),
+                        FOREIGN KEY(session) REFERENCES session(id),
+                        FOREIGN KEY(binary) REFERENCES binary(id))                    
+                        ''')
+                        
+            # identical binaries share a row, found by their hash
+            self.execute('''CREATE TABLE IF NOT EXISTS binary (id INTEGER PRIMARY KEY, binary BLOB, hash TEXT)''')
+            self.execute('''CREATE UNIQUE INDEX IF NOT EXISTS binary_hash_ix ON binary(hash)''')
+        else:
+            # the log and binary tables live in the shard databases instead; 
+            # fname is the shard file, relative to the catalog. Log and binary ids in a shard start 
+            # from (shard id << 32), so they are unique across all shards
+            self.execute('''CREATE TABLE IF NOT EXISTS shards
+                        (id INTEGER PRIMARY KEY, run INT, fname TEXT, start_time REAL, end_time REAL,
+                        first_id INT, last_id INT,
+                        FOREIGN KEY(run) REFERENCES runs(id))''')
                     
         self.execute('''CREATE TABLE IF NOT EXISTS sync_ext
                     (id INTEGER PRIMARY KEY,
@@ -199,6 +590,7 @@ class ExperimentLog(object):
         # start_time and end_time are the times when the software was started and stopped
         # uname records the details of the machine this was run was executed on
         # ntp_clock_offset records the clock offset that was in effect for this run (all timestamps already incorporate this value)
+        # clock_wall_ns and clock_monotonic_ns record the anchor mapping the monotonic clock to wall time for this run
         # json records any per-run configuration
         self.execute('''CREATE TABLE IF NOT EXISTS runs
                     (id INTEGER PRIMARY KEY,
@@ -207,7 +599,9 @@ class ExperimentLog(object):
                     clean_exit INT,
                     json TEXT,
                     uname TEXT,
-                    ntp_clock_offset REAL)
+                    ntp_clock_offset REAL,
+                    clock_wall_ns INT,
+                    clock_monotonic_ns INT)
                     ''')
 
         # maps software runs to experimental sessions
@@ -233,6 +627,24 @@ class ExperimentLog(object):
         self.execute('''CREATE VIEW IF NOT EXISTS dataset AS SELECT * FROM meta WHERE mtype="DATASET"''')        
         self.meta.stage = "init"                
         
+    def upgrade_tables(self):
+        """Bring the tables of a database created by an older version up to date"""
+        def columns(table):
+            return [info[1] for info in self.execute("PRAGMA table_info(%s)" % table).fetchall()]
+            
+        if "clock_wall_ns" not in columns("runs"):
+            logging.debug("Adding clock anchors to the runs table.")
+            self.execute("ALTER TABLE runs ADD COLUMN clock_wall_ns INT")
+            self.execute("ALTER TABLE runs ADD COLUMN clock_monotonic_ns INT")
+        if not self.sharded:
+            if "hash" not in columns("binary"):
+                logging.debug("Adding hashes to the binary table.")
+                self.execute("ALTER TABLE binary ADD COLUMN hash TEXT")
+                self.execute("CREATE UNIQUE INDEX IF NOT EXISTS binary_hash_ix ON binary(hash)")
+            if "time_ns" not in columns("log"):
+                logging.debug("Adding nanosecond times to the log table.")
+                self.execute("ALTER TABLE log ADD COLUMN time_ns INT")
+        
     @property    
     def random_seed(self):
         """Return the current random seed"""
@@ -259,10 +671,12 @@ class ExperimentLog(object):
             
     def _start(self, run_config={}):
         """Create a new run entry in the runs table."""
-        self.execute("INSERT INTO runs(start_time,clean_exit, ntp_clock_offset, uname, json) VALUES (?, ?, ?, ?, ?)",
+        self.execute("INSERT INTO runs(start_time,clean_exit, ntp_clock_offset, clock_wall_ns, clock_monotonic_ns, uname, json) VALUES (?, ?, ?, ?, ?, ?, ?)",
                            (self.real_time(),                           
                            0,                           
                            self.time_offset,
+                           self.clock.anchor[0],
+                           self.clock.anchor[1],
                            json.dumps(platform.uname()),
                            json.dumps(run_config)))
         self.run_id = self.cursor.lastrowid
@@ -283,26 +697,233 @@ class ExperimentLog(object):
                 
     def sync_ext(self, fname, start_time, duration=None, media_start_time=0, time_rate=1.0, description=None, data={}):
         """Synchronise an external file (e.g. a video or audio recording) with the main log file.
-        Must specify the start_time (in seconds since the epoch, same format as all other times). time_rate can be used to adjust
-        for files that have some time slippage"""
+        Must specify the start_time (in seconds since the epoch, same format as all other times), at which 
+        media_start_time (in seconds) into the file was played/recorded. time_rate can be used to adjust
+        for files that have some time slippage: log time = start_time + (media time - media_start_time) * time_rate.
+        A "frame_rate" entry in data is used by extract.align_media() to convert frame numbers to media times."""
         with self.db_lock:
-            logging.debug("Syncing %s to %f:%s (%s) " % (fname, start_time, description))
-            self.execute("INSERT INTO sync_ext(fname, start_time, duration, media_start_time, time_rate, description, json) VALUES  (?,?,?,?,?,?)", 
+            logging.debug("Syncing %s to %f (%s) " % (fname, start_time, description))
+            self.execute("INSERT INTO sync_ext(fname, start_time, duration, media_start_time, time_rate, description, json) VALUES  (?,?,?,?,?,?,?)", 
                 (fname, start_time, duration,  media_start_time, time_rate, description, json.dumps(data)))
         
     def add_indices(self):
-        """Add indices to the log"""
+        """Add indices to the log (of the current shard, if the database is sharded)"""
+        with self.db_lock:
+            schema = "shard." if self.sharded else ""
+            self.execute("CREATE INDEX %slog_session_ix ON log(session, time, id)" % schema)
+            self.execute("CREATE INDEX %slog_tag_ix ON log(tag)" % schema)
+            self.execute("CREATE INDEX %slog_stream_ix ON log(stream)" % schema)
+            self.execute("CREATE INDEX %slog_valid_ix ON log(valid)" % schema)
+            
+    def finalize(self):
+        """Optimise the database for reading, once capture is complete; see finalize_database(). 
+        Log entries keep their ids, so ids recorded before finalizing (e.g. by subscribers or incremental 
+        exports) still refer to the same entries."""
+        with self.db_lock:
+            self.commit()
+            finalize_database(self.conn, run=self.run_id, open_shard=self.shard_id if self.sharded else None)
+            self.next_log_id = self._next_log_id()
+            
+    def _next_log_id(self):
+        """Return the id to give the next log entry, or None if SQLite assigns it (id is the rowid of the log, 
+        until it is finalized)"""
+        schema = "shard" if self.sharded else "main"
+        if [info[5] for info in self.execute("PRAGMA %s.table_info(log)" % schema).fetchall() if info[1]=="id"][0]:
+            return None
+        last_id = self.execute("SELECT max(id) FROM %s" % self.log_table).fetchone()[0]
+        if last_id is None and self.sharded:
+            return self.execute("SELECT first_id FROM shards WHERE id=?", (self.shard_id,)).fetchone()[0]
+        return (last_id or 0) + 1
+        
+    def _insert_log(self, session, valid, t, stream_id, tag, js, binary_id, t_ns):
+        """Insert an entry into the log, and return its id"""
+        if self.next_log_id is None:
+            self.execute("INSERT INTO %s(session, valid, time, stream, tag, json, binary, time_ns) VALUES (?, ?, ?, ?, ?, ?, ?, ?)" % self.log_table,
+                         (session, valid, t, stream_id, tag, js, binary_id, t_ns))
+            return self.cursor.lastrowid
+        id = self.next_log_id
+        self.execute("INSERT INTO %s(id, session, valid, time, stream, tag, json, binary, time_ns) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)" % self.log_table,
+                     (id, session, valid, t, stream_id, tag, js, binary_id, t_ns))
+        self.next_log_id += 1
+        return id
+        
+    @property
+    def log_table(self):
+        return "shard.log" if self.sharded else "log"
+        
+    @property
+    def binary_table(self):
+        return "shard.binary" if self.sharded else "binary"
+        
+    def _open_shard(self):
+        """Start a new shard database, holding the log and binary tables, and attach it as 'shard'"""
+        self.execute("INSERT INTO shards(run, start_time) VALUES (?, ?)", (self.run_id, self.real_time()))
+        shard_id = self.cursor.lastrowid
+        shard_fname = "%s.shard%06d" % (os.path.basename(self.fname), shard_id)
+        self.execute("UPDATE shards SET fname=?, first_id=? WHERE id=?", (shard_fname, (shard_id<<32)+1, shard_id))
+        # can't attach inside a transaction
+        self.conn.commit()
+        self.execute("ATTACH DATABASE ? AS shard", (os.path.join(os.path.dirname(self.fname), shard_fname),))
+        self.execute("PRAGMA shard.synchronous=OFF;")
+        self.execute('''CREATE TABLE shard.log
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT, session INT, valid INT, time REAL, stream INT, tag TEXT, json TEXT, binary INT, time_ns INT)''')
+        self.execute('''CREATE TABLE shard.binary (id INTEGER PRIMARY KEY AUTOINCREMENT, binary BLOB, hash TEXT)''')
+        self.execute('''CREATE UNIQUE INDEX shard.binary_hash_ix ON binary(hash)''')
+        self.execute("INSERT INTO shard.sqlite_sequence(name, seq) VALUES ('log', ?), ('binary', ?)", (shard_id<<32, shard_id<<32))
+        self._create_field_indices("shard")
+        self.conn.commit()
+        self.shard_id = shard_id
+        self.next_log_id = None
+        logging.debug("Opened shard [%06d] '%s'" % (shard_id, shard_fname))
+        
+    def _close_shard(self):
+        """Record the extent of the current shard, and detach it"""
+        self.execute("UPDATE shards SET end_time=?, last_id=(SELECT max(id) FROM shard.log) WHERE id=?", (self.real_time(), self.shard_id))
+        self.conn.commit()
+        self.execute("DETACH DATABASE shard")
+        logging.debug("Closed shard [%06d]" % self.shard_id)
+        
+    def backup(self, fname=None, pages=256, sleep=0.0):
+        """Write a consistent copy of the database to fname (default: the database name + ".backup"), 
+        while it is in use, with backup_database(). Everything logged so far is committed first. The copy is 
+        made on connections of its own, without holding the log's lock, so other threads can log meanwhile.
+        
+        For a sharded database, the copy is written as a catalog plus shards in the same way, with the
+        catalog referring to the copied shards. Closed shards are no longer written to, so are copied as files.
+        """
+        fname = fname or self.fname + ".backup"
         with self.db_lock:
-            self.execute("CREATE INDEX log_session_ix ON log(session)")
-            self.execute("CREATE INDEX log_tag_ix ON log(tag)")
-            self.execute("CREATE INDEX log_stream_ix ON log(stream)")
-            self.execute("CREATE INDEX log_valid_ix ON log(valid)")
+            self.commit()
+            if self.fname==":memory:":
+                # no other connection can see an in-memory database
+                backup_database(self.conn, fname, pages=pages, sleep=sleep)
+                return
+        self._copy_database(fname, pages, sleep)
+        
+    def _copy_database(self, fname, pages, sleep):
+        """Copy what has been committed to fname (see backup()), on new connections"""
+        start = time.time()
+        conn = sqlite3.connect(self.fname)
+        try:
+            backup_database(conn, fname, pages=pages, sleep=sleep)
+            if self.sharded:
+                dirname = os.path.dirname(self.fname)
+                backup_conn = sqlite3.connect(fname)
+                for shard_id, shard_fname, end_time in conn.execute("SELECT id, fname, end_time FROM shards").fetchall():
+                    backup_shard = "%s.shard%06d" % (os.path.basename(fname), shard_id)
+                    target = os.path.join(os.path.dirname(fname), backup_shard)
+                    if end_time is None:
+                        # the shard being written
+                        shard_conn = sqlite3.connect(os.path.join(dirname, shard_fname))
+                        backup_database(shard_conn, target, pages=pages, sleep=sleep)
+                        shard_conn.close()
+                    else:
+                        shutil.copyfile(os.path.join(dirname, shard_fname), target)
+                    backup_conn.execute("UPDATE shards SET fname=? WHERE id=?", (backup_shard, shard_id))
+                backup_conn.commit()
+                backup_conn.close()
+        finally:
+            conn.close()
+        logging.debug("Backed up to %s in %.2f seconds" % (fname, time.time()-start))
+            
+    def snapshot_every(self, interval, fname=None, pages=256, sleep=0.0):
+        """Take a hot snapshot of what has been committed every interval seconds, in a background thread, 
+        replacing the previous snapshot (see backup() for pages and sleep). Logging is not held up while the 
+        snapshot is copied. fname defaults to the database name + ".snapshot". If interval is None, 
+        snapshots are stopped."""
+        if self.snapshot_thread is not None:
+            self.snapshot_stop.set()
+            self.snapshot_thread.join()
+            self.snapshot_thread = None
+        if interval is None:
+            return
+        if self.fname==":memory:":
+            raise ExperimentException("Cannot snapshot an in-memory database in the background")
+        self.snapshot_stop = threading.Event()
+        self.snapshot_thread = threading.Thread(target=self._snapshot_every, args=(interval, fname or self.fname + ".snapshot", pages, sleep))
+        self.snapshot_thread.daemon = True
+        self.snapshot_thread.start()
+        
+    def _snapshot_every(self, interval, fname, pages, sleep):
+        """The snapshot thread"""
+        while not self.snapshot_stop.wait(interval):
+            try:
+                self._copy_database(fname, pages, sleep)
+            except BackupBusy as e:
+                logging.warn("Skipped a snapshot: %s" % e)
+            except Exception:
+                logging.error("Snapshot failed:\n%s" % traceback.format_exc())
             
+    @property
+    def journal_fname(self):
+        return self.fname + ".journal"
+        
+    def _open_journal(self, size):
+        """Open the capture journal, importing any entries left in it"""
+        self.execute("CREATE TABLE IF NOT EXISTS journal_info (id INTEGER PRIMARY KEY, generation INT, offset INT, time REAL)")
+        # a new journal continues the generations of the earlier ones, so their journal_info rows don't apply to it
+        generation = (self.execute("SELECT max(generation) FROM journal_info").fetchone()[0] or 0) + 1
+        self.journal = journal.Journal(self.journal_fname, size, generation)
+        # entries up to offset were imported in the same transaction as the journal_info row
+        imported = self.execute("SELECT max(offset) FROM journal_info WHERE generation=?", (self.journal.generation,)).fetchone()[0]
+        if imported is not None:
+            self.journal.start = imported
+        recovered = self.import_journal()
+        if recovered:
+            logging.warn("Recovered %d log entries from the journal %s" % (recovered, self.journal_fname))
+            
+    def _close_journal(self):
+        self.import_journal()
+        self.journal.close()
+        self.journal = None
+        os.remove(self.journal_fname)
+        
+    def _import_journal_every(self, interval):
+        while self.journal is not None:
+            time.sleep(interval)
+            with self.db_lock:
+                if self.journal is not None:
+                    self.import_journal()
+        
+    def import_journal(self):
+        """Import the entries in the capture journal into the log, in bulk, and commit. 
+        Returns the number of entries imported."""
+        with self.db_lock:
+            if self.journal is None:
+                return 0
+            records, offset = self.journal.read()
+            if not records:
+                return 0
+            if self.subscribers:
+                stream_names = {id:name for (mtype, name), id in self.registry.ids.iteritems() if mtype=="STREAM"}
+                # the keys stored with the codecs, which outlive set_codec(stream, None)
+                decoder = payload.PayloadDecoder(self.cursor) if any(r.packed for r in records) else None
+            for r in records:
+                binary_id = self._store_binary(r.binary) if r.binary is not None else None
+                js = sqlite3.Binary(r.payload) if r.packed else r.payload.decode("utf8")
+                id = self._insert_log(r.session, r.valid, r.time, r.stream, r.tag, js, binary_id, r.time_ns)
+                if self.subscribers:
+                    stream = stream_names[r.stream]
+                    data = payload.decode(r.payload, decoder.keys[r.stream]) if r.packed else json.loads(js)
+                    if r.session not in self.path_cache:
+                        self.path_cache[r.session] = self.execute("SELECT path FROM session WHERE id=?", (r.session,)).fetchone()[0]
+                    self.pending.append(LogRecord(id, r.session, self.path_cache[r.session], stream, r.time, r.valid, r.tag, data, binary_id))
+            self.execute("INSERT INTO journal_info(generation, offset, time) VALUES (?, ?, ?)", (self.journal.generation, offset, self.real_time()))
+            self.commit()
+            self.journal.release(offset)
+            logging.debug("Imported %d journal entries" % len(records))
+            return len(records)
+        
     def close(self):
         # auto end the run        
+        self.snapshot_every(None)
         with self.db_lock:
+            if self.journal is not None:
+                self._close_journal()
             self.end()
             self.commit()        
+            if self.sharded:
+                self._close_shard()
             logging.debug("Database closed.")
             self.opened = False
         
@@ -311,26 +932,137 @@ class ExperimentLog(object):
         with self.db_lock:
             logging.debug("<Commit>")
             self.conn.commit()
+            if self.pending:
+                batch, self.pending = self.pending, []
+                self._publish(batch)
+            # roll over to a new shard if this one is full
+            if self.sharded and self.shard_size is not None and self.in_run:
+                shard_fname = self.execute("SELECT fname FROM shards WHERE id=?", (self.shard_id,)).fetchone()[0]
+                if os.path.getsize(os.path.join(os.path.dirname(self.fname), shard_fname)) > self.shard_size:
+                    self._close_shard()
+                    self._open_shard()
         
     
+    def subscribe(self, callback, streams=None, path=None, from_id=None):
+        """Call callback(records) with each batch of log records as it is committed, where
+        records is a list of LogRecord tuples.
+        
+        Parameters:
+            streams: If given, only pass on records from these streams (a list of names)
+            path: If given, only pass on records from sessions whose path begins with this prefix
+            from_id: If given, first catch up by passing on all of the records already in the log
+                     with id > from_id, read from the database 
+        """
+        with self.db_lock:
+            # flush out any pending records to the existing subscribers, so the catch up does not repeat them
+            self.commit()
+            if from_id is not None:
+                for batch in read_records(self.conn.cursor(), from_id, streams=streams, path=path, log_table=self.log_table):
+                    callback(batch)
+            self.subscribers.append((callback, streams, path))
+            
+    def unsubscribe(self, callback):
+        """Stop calling callback with committed records"""
+        with self.db_lock:
+            self.subscribers = [s for s in self.subscribers if s[0]!=callback]
+            
+    def _publish(self, batch):
+        """Pass a batch of committed records on to each of the subscribers"""
+        for callback, streams, path in self.subscribers:
+            records = [r for r in batch if (streams is None or r.stream in streams) and (path is None or r.path.startswith(path))]
+            if records:
+                try:
+                    callback(records)
+                except Exception:
+                    logging.error("Log subscriber failed:\n%s" % traceback.format_exc())
+        
+    def load_codecs(self):
+        """Load the payload codecs (see set_codec()) of all of the streams"""
+        with self.db_lock:
+            self.codecs = {}
+            if payload.has_codecs(self.cursor):
+                for stream_id, name, keys, compress in self.execute("SELECT stream_codec.stream, meta.name, stream_codec.keys, stream_codec.compress FROM stream_codec JOIN meta ON meta.id=stream_codec.stream WHERE stream_codec.codec IS NOT NULL").fetchall():
+                    keys = json.loads(keys)
+                    self.codecs[name] = dict(keys=keys, key_index={key:i for i, key in enumerate(keys)}, compress=bool(compress))
+                    
+    def set_codec(self, stream, codec="packed", compress=False):
+        """Set how the dictionary payloads of a stream are stored from now on.
+        
+        Parameters:
+            stream: name of the (existing) stream
+            codec: "packed" stores the keys of the stream once, in the stream_codec table, and each
+                   payload as compact binary values (see payload.py). None stores payloads as JSON text.
+                   extract.py decodes either transparently.
+            compress: If True, packed payloads are also zlib compressed
+        """
+        with self.db_lock:
+            stream_id = self.find_metatable("STREAM", stream)
+            if stream_id is None:
+                raise ExperimentException("No stream %s registered; cannot set its codec" % stream)
+            self.execute("CREATE TABLE IF NOT EXISTS stream_codec (stream INTEGER PRIMARY KEY, codec TEXT, keys TEXT, compress INT, FOREIGN KEY(stream) REFERENCES meta(id))")
+            if codec is None:
+                # keep the keys, as they are needed to decode the existing payloads
+                self.execute("UPDATE stream_codec SET codec=NULL WHERE stream=?", (stream_id[0],))
+                self.codecs.pop(_unicode(stream), None)
+            elif codec=="packed":
+                if any(indexed==stream_id[0] for indexed, _ in self.indexed_fields()):
+                    raise ExperimentException("Stream %s has indexed fields; cannot pack its payloads" % stream)
+                self.execute("INSERT OR IGNORE INTO stream_codec(stream, keys) VALUES (?, '[]')", (stream_id[0],))
+                self.execute("UPDATE stream_codec SET codec=?, compress=? WHERE stream=?", (codec, compress, stream_id[0]))
+                self.load_codecs()
+            else:
+                raise ExperimentException("Unknown codec %s" % codec)
+            logging.debug("Stream %s codec set to %s" % (stream, codec))
+            
+    def indexed_fields(self):
+        """Return the (stream id, field) pairs declared with index_field()"""
+        with self.db_lock:
+            if not self.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='indexed_fields'").fetchone()[0]:
+                return []
+            return self.execute("SELECT stream, field FROM indexed_fields ORDER BY id").fetchall()
+            
+    def _create_field_indices(self, schema, fields=None):
+        """Create the indices of the indexed payload fields on the log in the given schema"""
+        create_field_indices(self.conn, schema, fields or self.indexed_fields())
+        
+    def index_field(self, stream, field):
+        """Index a field of the (JSON) payloads of a stream, so that extract.query() can find the entries with 
+        given values of the field without reading the whole stream. Nested fields are given as dotted paths.
+        
+        In a sharded database, shards written before the field was indexed are not indexed."""
+        with self.db_lock:
+            payload.field_expression(field)
+            stream_id = self.registry.get("STREAM", stream)
+            if stream_id is None:
+                raise ExperimentException("No stream %s registered; cannot index its fields" % stream)
+            if payload.has_codecs(self.cursor) and self.execute("SELECT count(*) FROM stream_codec WHERE stream=?", (stream_id,)).fetchone()[0]:
+                raise ExperimentException("Stream %s has packed payloads; cannot index its fields" % stream)
+            self.execute("CREATE TABLE IF NOT EXISTS indexed_fields (id INTEGER PRIMARY KEY, stream INT, field TEXT, UNIQUE(stream, field), FOREIGN KEY(stream) REFERENCES meta(id))")
+            self.execute("INSERT OR IGNORE INTO indexed_fields(stream, field) VALUES (?, ?)", (stream_id, field))
+            self._create_field_indices("shard" if self.sharded else "main", [(stream_id, field)])
+            self.commit()
+            logging.debug("Indexed field %s of stream %s" % (field, stream))
+            
     def create(self, mtype, name, stype="", description="", data=None, force_update=False):
         """Register a new metadata object."""
         with self.db_lock:
-            id = self.find_metatable(mtype, name)         
+            id = self.registry.get(mtype, name)
             if id is None:        
                 logging.debug("Registering '%s' of type '%s', with data [%s]" % (name, mtype, json.dumps(data)))
                 self.execute("INSERT INTO meta(name,type,description,json,mtype) VALUES (?,?,?,?,?)", (name, stype, description, json.dumps(data), mtype))   
                 id = self.cursor.lastrowid
+                self.registry.add(mtype, name, id)
             else:
                 if not force_update:                
                     raise ExperimentException("%s:%s already exists; not updating" % (mtype,name))
                 else:
                     logging.warn("%s:%s exists; force updating" % (mtype,name))
-                    self.execute("UPDATE meta SET name=?,type=?,description=?,json=? where meta.id=%d"%id[0], (name, stype, description, json.dumps(data), ))    
+                    self.execute("UPDATE meta SET name=?,type=?,description=?,json=? where meta.id=%d"%id, (name, stype, description, json.dumps(data), ))    
         
             if mtype=="STREAM":
-                self.stream_cache[name] = id
-                self.execute("CREATE VIEW IF NOT EXISTS %s AS SELECT * FROM log WHERE stream=%d" % (name, id))
+                # views in the catalog can't refer to the shards; extract.open_shards() creates these instead
+                if not self.sharded:
+                    self.execute("CREATE VIEW IF NOT EXISTS %s AS SELECT * FROM log WHERE stream=%d" % (name, id))
                            
     @property
     def bindings(self):
@@ -401,9 +1133,9 @@ class ExperimentLog(object):
             logging.debug("Entering session '%s'" % new_path )                         
             
             # log this path
-            path_id = self.execute("SELECT id FROM path WHERE name=?", (new_path,)).fetchone()
-            if path_id is None:            
+            if self.registry.get("PATH", new_path) is None:
                 self.execute("INSERT INTO meta(name,mtype) VALUES (?, 'PATH')", (new_path,))
+                self.registry.add("PATH", new_path, self.cursor.lastrowid)
                     
             # 64 bit random seed
             seed = int(self.real_time() * 1000 * self.session_id) & ((1<<64)-1)
@@ -457,8 +1189,10 @@ class ExperimentLog(object):
         
         
     def find_metatable(self, mtype, name):
+        """Return the id of the given metadata object as a 1-tuple, or None if it does not exist"""
         with self.db_lock:
-            return self.execute("SELECT id FROM meta WHERE name=? AND mtype=?", (name,mtype)).fetchone()
+            id = self.registry.get(mtype, name)
+            return None if id is None else (id,)
         
     def bind(self, mtype, name, data={}):   
         with self.db_lock:
@@ -473,7 +1207,7 @@ class ExperimentLog(object):
         with self.db_lock:
             id = self.find_metatable(mtype, name)
             if id is not None:
-                self.execute("UPDATE meta_session SET  unbound_session=session session=NULL WHERE (meta=? AND session=?)", (id[0],self.session_id))
+                self.execute("UPDATE meta_session SET unbound_session=session, session=NULL WHERE (meta=? AND session=?)", (id[0],self.session_id))
                 logging.debug("Unbinding meta table %s:%s from %s" % (mtype, name, self.session_path))
             else:   
                 logging.warn("Tried to unbind non-existent meta table %s:%s" % (mtype, name))
@@ -502,51 +1236,160 @@ class ExperimentLog(object):
         with self.db_lock:
             return self.cursor.execute(query, parameters)                      
     
-    def log(self, stream, t=None, valid=True, data=None, tag="", binary=None):
+    def _store_binary(self, binary):
+        """Store a binary attachment, and return its id. Identical attachments share a single row."""
+        digest = hashlib.sha256(binary).hexdigest()
+        row = self.execute("SELECT id FROM %s WHERE hash=?" % self.binary_table, (digest,)).fetchone()
+        if row is not None:
+            return row[0]
+        self.execute("INSERT INTO %s(binary, hash) VALUES (?, ?)" % self.binary_table, (binary, digest))
+        return self.cursor.lastrowid
+        
+    def gc_binaries(self):
+        """Merge identical binaries stored before they were deduplicated, and delete the binaries which 
+        no log entry refers to (in the current shard, if the database is sharded).
+        
+        Returns:
+            removed: the number of binary rows deleted
+        """
+        with self.db_lock:
+            binary, log = self.binary_table, self.log_table
+            # hash the old binaries, one at a time
+            hashes = []
+            result = self.conn.cursor().execute("SELECT id, binary FROM %s WHERE hash IS NULL" % binary)
+            for id, data in result:
+                hashes.append((id, hashlib.sha256(data).hexdigest()))
+                
+            # map each duplicate onto the first copy
+            self.execute("CREATE TEMP TABLE IF NOT EXISTS binary_remap (duplicate INTEGER PRIMARY KEY, original INT)")
+            self.execute("DELETE FROM temp.binary_remap")
+            for id, digest in hashes:
+                row = self.execute("SELECT id FROM %s WHERE hash=?" % binary, (digest,)).fetchone()
+                if row is None:
+                    self.execute("UPDATE %s SET hash=? WHERE id=?" % binary, (digest, id))
+                else:
+                    self.execute("INSERT INTO temp.binary_remap(duplicate, original) VALUES (?, ?)", (id, row[0]))
+            self.execute("UPDATE %s SET binary=(SELECT original FROM temp.binary_remap WHERE duplicate=binary) WHERE binary IN (SELECT duplicate FROM temp.binary_remap)" % log)
+            
+            before = self.execute("SELECT count(id) FROM %s" % binary).fetchone()[0]
+            self.execute("DELETE FROM %s WHERE id NOT IN (SELECT binary FROM %s WHERE binary IS NOT NULL)" % (binary, log))
+            removed = before - self.execute("SELECT count(id) FROM %s" % binary).fetchone()[0]
+            logging.debug("Removed %d binaries" % removed)
+            self.commit()
+            return removed
+            
+    def _stream_payload(self, stream, data):
+        """Return the id of the stream, and the payload as it is stored (see set_codec()). Registers the
+        stream, and any new keys of a packed stream, if needed."""
+        stream_id = self.registry.get("STREAM", stream)
+        # if there is no such stream ID, create a new one and use that
+        if stream_id is None:
+            with self.db_lock:
+                logging.warn("No stream %s registered; creating a new blank entry" % stream)
+                self.create("STREAM", stream, stype="AUTO")
+                stream_id = self.registry.get("STREAM", stream)
+                if self.journal is not None:
+                    # the journal refers to the stream by id, so it must be stored before the journal entry
+                    self.conn.commit()
+        
+        codec = self.codecs.get(_unicode(stream))
+        if codec is not None and isinstance(data, dict):
+            key_index = codec["key_index"]
+            if all(key in key_index for key in data):
+                # known keys keep their index, so this needs no lock, even in journal mode
+                js = sqlite3.Binary(payload.encode(data, codec["keys"], key_index, codec["compress"]))
+            else:
+                # new keys are registered under the lock, or concurrent producers could give two keys one index
+                with self.db_lock:
+                    n_keys = len(codec["keys"])
+                    js = sqlite3.Binary(payload.encode(data, codec["keys"], key_index, codec["compress"]))
+                    if len(codec["keys"]) > n_keys:
+                        self.execute("UPDATE stream_codec SET keys=? WHERE stream=?", (json.dumps(codec["keys"]), stream_id))
+                        if self.journal is not None:
+                            self.conn.commit()
+        else:
+            js = json.dumps(data)
+        return stream_id, js
+        
+    def _journal_log(self, stream, t, t_ns, valid, data, tag, binary):
+        """log() in journal mode: append the entry to the journal, without touching the database"""
+        if not self.in_run:
+            raise ExperimentException("No run active; cannot log data")
+        stream_id, js = self._stream_payload(stream, data)
+        packed = isinstance(js, buffer)
+        if packed:
+            js = str(js)
+        while True:
+            try:
+                self.journal.append(t, t_ns, self.session_id, stream_id, valid, tag, js, packed, binary)
+                return
+            except journal.JournalFull:
+                if not self.journal.fits(len(tag) + len(js) + len(binary or "")):
+                    raise ExperimentException("Log entry is too large for the journal (%d bytes)" % self.journal.size)
+                # other threads append without the lock, so they may fill the journal again before the retry
+                with self.db_lock:
+                    self.import_journal()
+            
+    def log_many(self, entries):
+        """Log a batch of entries, each a dictionary of log() arguments, in one go (e.g. in a single
+        round trip to a zmq_log server). Returns the list of their ids.
+        
+        If an entry cannot be logged, the exception is raised with a written attribute, the list of 
+        the ids of the entries before it, which have been logged; the entries after it have not."""
+        with self.db_lock:
+            ids = []
+            try:
+                for entry in entries:
+                    ids.append(self.log(**entry))
+            except Exception as e:
+                e.written = ids
+                raise
+            return ids
+            
+    def log(self, stream, t=None, valid=True, data=None, tag="", binary=None, t_ns=None):
         """Log the given data in the currently active session        
         Parameters:
             stream: stream id to write to
             tag: Tag to use for the stream (optional)
             t: Timestamp of the data. If None, uses the timestamp when the data is written in
+            t_ns: Timestamp of the data in integer nanoseconds (e.g. from clock.time_ns()), used instead of t. 
+                  Taking timestamps at the source with the clock is cheaper and more precise than passing t.
             valid: True if this datapoint should be marked as valid, False otherwise
             data: Dictionary of data entries to be written to the log.        
             
         Returns:
-            id: The id of this log entry (e.g. if you want to store additional table in another table)
+            id: The id of this log entry (e.g. if you want to store additional table in another table),
+                or None in journal mode, where the entry is only given an id when it is imported
             """    
-        t = t or self.real_time()
+        if t_ns is not None:
+            t = t_ns * 1e-9
+        elif not t:
+            t_ns = self.clock.time_ns()
+            t = t_ns * 1e-9
+        elif self.store_ns:
+            t_ns = int(round(t * 1e9))
+        if not self.store_ns:
+            t_ns = None
+        if self.journal is not None:
+            return self._journal_log(stream, t, t_ns, valid, data, tag, binary)
         with self.db_lock:
             if not self.in_run:
                 raise ExperimentException("No run active; cannot log data")
             
-            
-            # check if we already know what kind of stream this is; otherwise,
-            # look it up from the DB and cache it for later use
-            if stream in self.stream_cache:
-                stream_id = self.stream_cache[stream]
-            else:
-                stream_id = self.execute("SELECT id FROM stream WHERE stream.name=?", (stream,)).fetchone()
-                # if there is no such stream ID, create a new one and use that
-                if stream_id is None:
-                    logging.warn("No stream %s registered; creating a new blank entry" % stream)
-                    self.create("STREAM", stream, stype="AUTO")
-                    stream_id = self.execute("SELECT id FROM stream WHERE stream.name=?", (stream,)).fetchone()   
-                stream_id = stream_id[0]
-                self.stream_cache[stream] = stream_id                            
+            stream_id, js = self._stream_payload(stream, data)
             
             # attach binaries if needed
             if binary is not None:
-                self.execute("INSERT INTO binary(binary) VALUES (?)", (binary,))
-                binary_id = self.cursor.lastrowid
+                binary_id = self._store_binary(binary)
             else:
                 binary_id = None
             
-            self.execute("INSERT INTO log(session, valid, time, stream, tag, json, binary) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                               (self.session_id,
-                               valid, t, stream_id, tag,
-                               json.dumps(data), binary_id))
+            id = self._insert_log(self.session_id, valid, t, stream_id, tag, js, binary_id, t_ns)
             
-            id = self.cursor.lastrowid        
+            if self.subscribers:
+                if self.session_id not in self.path_cache:
+                    self.path_cache[self.session_id] = self.session_path
+                self.pending.append(LogRecord(id, self.session_id, self.path_cache[self.session_id], stream, t, valid, tag, data, binary_id))
             
              # deal with autocommits to the log
             now = self.real_time()
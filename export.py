@@ -0,0 +1,15 @@
+import sqlite3
+import sys
+import extract
+
+if __name__=="__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args)==2:
+        conn = sqlite3.connect(args[0])
+        incremental = "--incremental" in sys.argv
+        print("Exporting %s to %s%s" % (args[0], args[1], " (incremental)" if incremental else ""))
+        watermark = extract.export_columns(conn.cursor(), args[1], incremental=incremental)
+        print("Exported log entries up to id %d" % watermark)
+        conn.close()
+    else:
+        print("Usage: export.py <in_db> <out_dir> [--incremental]")
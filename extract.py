@@ -1,65 +1,198 @@
 import json
 import logging
 import os
+import shutil
+import time
+import urllib
 from collections import defaultdict
+import numpy as np
 import pandas as pd
 import base64
+import gzip
+import hashlib
+import heapq
+import itertools
+import sqlite3
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import payload
+from records import LogRecord
 
-def dump_json(cursor, file):
+# size of the slices BLOBs are base64 encoded in (a multiple of 3, so the slices can be concatenated)
+blob_slice_size = 3 * 1024 * 1024
+
+def _write_blob(file, value):
+    """Write a BLOB as a quoted base64 string, one slice at a time"""
+    file.write('"')
+    for i in range(0, len(value), blob_slice_size):
+        file.write(base64.b64encode(value[i:i+blob_slice_size]))
+    file.write('"')
+        
+def dump_json(cursor, file, chunk_size=1000, blob_chunk_size=16):
     """Dump the **entire** database to a JSON file. This is intended where the DB needs to be archived in a text format.
     
-    The JSON has a dictionary of table names -> table data.
-    
-    Each table data has two entries:
+    The JSON has a single "entries" list, with one entry for each table, index and view in the database:
+        type: "table", "index" or "view"
+        name: the name of the entry
+        sql: the statement that creates the entry
+        
+    Table entries also have:
         schema: giving the schema as a JSON column:type dictionary
-        rows: The table data as a list of column:value dictionaries
+        columns: the column names, in order
+        rows: The table data as a list of rows, each a list of values in column order
     
-    Data is recorded in native format, except for BLOBs which are written as base64 encoded strings.    
+    Data is recorded in native format, except for BLOBs which are written as base64 encoded strings.
+    Binary values in columns not declared as BLOB (such as encoded log payloads, see payload.py) are 
+    written as {"base64": string} objects.
     
+    Rows are read from the database in chunks of chunk_size (blob_chunk_size for tables with BLOB columns) 
+    and written one per line, so the database is never held in memory. load_json() reads the file back
+    in the same way.
     """    
-    # find all tables
-    tables = cursor.execute("SELECT * FROM sqlite_master WHERE type='table'").fetchall()
-    file.write('{\n')
-
-    first_table = True
-    for table in tables:
-        name =  table[1]
+    entries = cursor.execute("SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY type!='table', type, rowid").fetchall()
+    file.write('{"entries": [\n')
+    first_entry = True
+    for mtype, name, sql in entries:
+        if not first_entry:
+            file.write(",\n")
+        first_entry = False
+        header = dict(type=mtype, name=name, sql=sql)
+        if mtype!='table':
+            file.write(json.dumps(header))
+            continue
+            
         # find all columns
         info = cursor.execute("PRAGMA table_info(%s)"%name).fetchall()
-        
-        if not first_table:
-            file.write(",\n")
-        first_table = False
-                
         column_names = [i[1] for i in info]
         column_types = [i[2] for i in info]
-        column_dict = {name:type for name,type in zip(column_names, column_types)}
-        
+        header.update(schema=dict(zip(column_names, column_types)), columns=column_names)
+        blobs = [t=='BLOB' for t in column_types]
         
-        result = cursor.execute("SELECT * FROM %s"%name)
-        file.write('"%s":{\n' % name)
-        file.write('"schema": %s,\n' % (json.dumps(column_dict)))
-        file.write('"rows": [\n')
+        # everything up to the opening of the rows list fits on a single line
+        file.write(json.dumps(header)[:-1] + ', "rows": [\n')
+        result = cursor.execute("SELECT %s FROM %s" % (",".join(column_names), name))
         first = True
-        # write out each row as a JSON dictionary column:value
-        for row in result:
-            r = result.fetchone()
-            
-            if r is not None:
+        while True:
+            rows = result.fetchmany(blob_chunk_size if any(blobs) else chunk_size)
+            if not rows:
+                break
+            for row in rows:
                 if not first:
                     file.write(",\n")
                 first = False
-                col_dict = {column:value for column,value in zip(column_names,r)}
+                if not any(blobs) and not any(isinstance(value, buffer) for value in row):
+                    file.write(json.dumps(row))
+                    continue
                 # write binary blobs as base64 encoded strings
-                for col in col_dict:
-                    if column_dict[col] == 'BLOB':                                            
-                        col_dict[col] = base64.b64encode(col_dict[col])
-                        
-                # dump this row
-                file.write(json.dumps(col_dict))
-                                               
-        file.write("\n]\n}")            
-    file.write("}")
+                file.write("[")
+                for i, (value, blob) in enumerate(zip(row, blobs)):
+                    if i>0:
+                        file.write(", ")
+                    if blob and value is not None:
+                        _write_blob(file, value)
+                    elif isinstance(value, buffer):
+                        # binary value in a column not declared BLOB (e.g. an encoded log payload)
+                        file.write('{"base64": ')
+                        _write_blob(file, value)
+                        file.write('}')
+                    else:
+                        file.write(json.dumps(value))
+                file.write("]")
+        file.write("\n]}")
+    file.write("\n]}\n")
+    
+def load_json(file, conn, chunk_size=1000):
+    """Rebuild a database from a file written by dump_json(), into the (empty) connection conn.
+    The file is read one line at a time, and rows are inserted in chunks of chunk_size."""
+    table, rows = None, []
+    
+    def insert():
+        conn.executemany("INSERT INTO %s(%s) VALUES (%s)" % (table["name"], ",".join(table["columns"]), ",".join("?"*len(table["columns"]))), rows)
+        
+    for line in file:
+        line = line.strip().rstrip(",")
+        if line.startswith('{"entries"') or line in ("]}", ""):
+            # start of the file, or the end of a table
+            if table is not None and rows:
+                insert()
+            table, rows = None, []
+        elif line.startswith("{"):
+            if line.endswith('"rows": ['):
+                # table entry; rows follow on the next lines
+                header = json.loads(line[:-len(', "rows": [')] + "}")
+                blobs = [header["schema"][c]=='BLOB' for c in header["columns"]]
+                table = header
+            else:
+                header = json.loads(line)
+            conn.execute(header["sql"])
+        elif table is not None:
+            row = json.loads(line)
+            rows.append([sqlite3.Binary(base64.b64decode(value)) if blob and value is not None else 
+                         sqlite3.Binary(base64.b64decode(value["base64"])) if isinstance(value, dict) else value 
+                         for value, blob in zip(row, blobs)])
+            if len(rows)>=chunk_size:
+                insert()
+                rows = []
+    conn.commit()
+    
+def dump_sql(conn, file):
+    """Write the database as SQL statements, one per line, as conn.iterdump() does. This reads the whole
+    database in one transaction, so use it on a copy (ExperimentLog.backup()) rather than a database that is
+    being written to. Use open_archive() for a compressed file."""
+    for statement in conn.iterdump():
+        if isinstance(statement, unicode):
+            statement = statement.encode("utf8")
+        file.write(statement)
+        file.write("\n")
+    
+def open_archive(fname, mode="r"):
+    """Open an archive file for dump_json()/load_json()/dump_sql(); files ending .gz are gzip compressed"""
+    if fname.endswith(".gz"):
+        return gzip.open(fname, mode + "b")
+    return open(fname, mode)
+    
+def open_shards(fname, runs=None, start_time=None, end_time=None):
+    """Open a database written with ExperimentLog(..., shard=True) so that the other functions in this module
+    work unchanged.
+    
+    Each shard is ATTACHed to the catalog, and TEMP views named log and binary present all of the 
+    attached shards as one table (along with the per-stream views). Queries on log are pushed down 
+    into each shard. 
+    
+    SQLite limits the number of attached databases (10 by default), so for large studies select 
+    only the shards that are needed:
+        runs: If given, only attach the shards written by these run ids
+        start_time, end_time: If given, only attach shards with data in this time range
+        
+    Returns:
+        conn: an sqlite3 connection to the catalog, with the shards attached
+    """
+    conn = sqlite3.connect(fname)
+    query, parameters = "SELECT id, fname FROM shards WHERE 1", ()
+    if runs is not None:
+        query += " AND run IN (%s)" % ",".join("?"*len(runs))
+        parameters += tuple(runs)
+    if start_time is not None:
+        query, parameters = query + " AND (end_time IS NULL OR end_time>=?)", parameters + (start_time,)
+    if end_time is not None:
+        query, parameters = query + " AND start_time<=?", parameters + (end_time,)
+    shards = conn.execute(query + " ORDER BY id", parameters).fetchall()
+    
+    for shard, shard_fname in shards:
+        logging.debug("Attaching shard %s" % shard_fname)
+        conn.execute("ATTACH DATABASE ? AS shard%d" % shard, (os.path.join(os.path.dirname(fname), shard_fname),))
+    if shards:
+        for table in ["log", "binary"]:
+            conn.execute("CREATE TEMP VIEW %s AS %s" % (table, " UNION ALL ".join(["SELECT * FROM shard%d.%s" % (shard, table) for shard, _ in shards])))
+    else:
+        conn.execute("CREATE TEMP TABLE log (id INTEGER PRIMARY KEY, session INT, valid INT, time REAL, stream INT, tag TEXT, json TEXT, binary INT)")
+        conn.execute("CREATE TEMP TABLE binary (id INTEGER PRIMARY KEY, binary BLOB)")
+    for id, name in conn.execute("SELECT id, name FROM stream").fetchall():
+        conn.execute("CREATE TEMP VIEW IF NOT EXISTS %s AS SELECT * FROM log WHERE stream=%d" % (name, id))
+    return conn
     
 class AutoVivification(dict):    
     def __getitem__(self, item):
@@ -69,6 +202,16 @@ class AutoVivification(dict):
             value = self[item] = type(self)()
             return value
 
+def json_code(value):
+    """Return the column type code of a single decoded JSON value: TEXT, INTEGER, FLOAT or JSON"""
+    if isinstance(value, basestring):
+        return "TEXT"
+    if type(value) in (int, long):
+        return "INTEGER"
+    if type(value) is float:
+        return "FLOAT"
+    return "JSON"
+
 def json_columns(json_seq):
     # get the datatype of all entries in this column
     columns = {}    
@@ -76,13 +219,7 @@ def json_columns(json_seq):
         if result is not None:           
                 for key, value in result.iteritems():
                     # each column is made up of strings, ints, floats or JSON
-                    code = 'JSON'
-                    if type(value) is str:
-                        code = "TEXT"
-                    if type(value) is int:
-                        code = "INTEGER"
-                    if type(value) is float:
-                        code = "FLOAT"
+                    code = json_code(value)
                     if key not in columns:
                         columns[key] = code
                     else:
@@ -95,6 +232,7 @@ def json_columns(json_seq):
 def dump(cursor):    
     c = cursor
     all = AutoVivification()    
+    decoder = payload.PayloadDecoder(c)
     paths = c.execute("SELECT DISTINCT(path) FROM session").fetchall()    
     for path in paths:
         sessions = c.execute("SELECT id, valid FROM session WHERE path=?", path).fetchall()            
@@ -102,7 +240,7 @@ def dump(cursor):
             rows = c.execute("SELECT log.stream,log.time,log.json,log.valid,stream.name FROM log JOIN stream ON stream.id=log.stream WHERE session=? ", (session,)).fetchall()
             frame = defaultdict(list)
             for stream, time, js, valid, stream_name in rows:
-                d = json.loads(js)
+                d = decoder.loads(js, stream)
                 d['t'] = time
                 d['valid'] = valid                
                 d['session_valid'] = svalid
@@ -111,40 +249,142 @@ def dump(cursor):
     return all
 
 import csv    
-def to_csv(cursor):
-    structure = dump(cursor)
-    for path,session in structure.iteritems():        
-        path = path.strip('/') # make sure we don't accidentally write to root!
-        try:
-            os.makedirs(path)
-        except OSError, e:
-            logging.debug("Could not create directory %s (%s)"  % (path, e))
-            
-        # each path has a directory; each entry has a directory within that
-        for session_k,streams in session.iteritems():
-            fullpath = os.path.join(path, str(session_k))
-            try:
-                os.makedirs(fullpath)
-            except OSError, e:
-                logging.debug("Could not create directory %s (%s)"  % (path, e))
-                
-            # write out each stream independently
-            for stream_name, stream_data in streams.iteritems():
-                
-                with open(os.path.join(fullpath,"%s.csv" % (stream_name)), 'w') as f:
-                    csvfile = csv.DictWriter(f, delimiter=",", fieldnames=stream_data[0].keys())
-                    csvfile.writeheader()
-                    for s in stream_data:
-                        csvfile.writerow(s)
+import multiprocessing
+
+def _csv_value(value):
+    if isinstance(value, unicode):
+        return value.encode("utf8")
+    return value
+    
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        logging.debug("Could not create directory %s (%s)"  % (path, e))
+    
+class _CSVStream(object):
+    """The CSV file of one stream of a session. The keys of the stream are only known once all of its entries 
+    have been read, so the rows are first written to a temporary file, with the columns in the order the keys 
+    were found; finish() then writes the CSV file with its header (t, valid and session_valid, followed by 
+    the keys in sorted order)."""
+    base = ["t", "valid", "session_valid"]
+    
+    def __init__(self, fname):
+        self.fname = fname
+        self.keys = list(self.base)
+        self.index = {key:i for i, key in enumerate(self.keys)}
+        self.tmp = open(fname + ".tmp", "wb")
+        self.writer = csv.writer(self.tmp)
+        
+    def writerow(self, d):
+        row = [None] * len(self.keys)
+        for key, value in d.iteritems():
+            if key not in self.index:
+                self.index[key] = len(self.keys)
+                self.keys.append(key)
+                row.append(None)
+            row[self.index[key]] = _csv_value(value)
+        self.writer.writerow(row)
+        
+    def finish(self):
+        self.tmp.close()
+        header = self.base + sorted(set(self.keys) - set(self.base))
+        columns = [self.index[key] for key in header]
+        with open(self.tmp.name, "rb") as tmp, open(self.fname, "wb") as f:
+            writer = csv.writer(f)
+            writer.writerow([_csv_value(key) for key in header])
+            for row in csv.reader(tmp):
+                # rows written before a key was found are shorter
+                writer.writerow([row[i] if i < len(row) else "" for i in columns])
+        os.remove(self.tmp.name)
+        
+    def close(self):
+        if not self.tmp.closed:
+            self.tmp.close()
+            os.remove(self.tmp.name)
+    
+def _session_to_csv(cursor, session, path, svalid, outdir, names, chunk_size):
+    """Write the CSV files of one session, reading its entries once, in chunks"""
+    decoder = payload.PayloadDecoder(cursor)
+    # file names are written as UTF-8, whatever the locale
+    fullpath = os.path.join(outdir, _csv_value((path or "").strip("/")), str(session)) # make sure we don't accidentally write to root!
+    _makedirs(fullpath)
+    files = {}
+    result = cursor.execute("SELECT log.stream,log.time,log.json,log.valid FROM log WHERE session=? ORDER BY log.id", (session,))
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            for stream, time, js, valid in rows:
+                if stream not in files:
+                    files[stream] = _CSVStream(os.path.join(fullpath, "%s.csv" % _csv_value(names[stream])))
+                d = decoder.loads(js, stream)
+                d = d if isinstance(d, dict) else {}
+                d['t'] = time
+                d['valid'] = valid
+                d['session_valid'] = svalid
+                files[stream].writerow(d)
+        for f in files.itervalues():
+            f.finish()
+    finally:
+        for f in files.itervalues():
+            f.close()
+    return session
+    
+def _session_to_csv_worker(args):
+    # runs in a worker process, with its own connection to the database
+    fname, session, path, svalid, outdir, names, chunk_size = args
+    conn = sqlite3.connect(fname)
+    try:
+        return _session_to_csv(conn.cursor(), session, path, svalid, outdir, names, chunk_size)
+    finally:
+        conn.close()
+    
+def to_csv(cursor, outdir=".", workers=None, chunk_size=1000):
+    """Write the log to CSV files: one directory for each session path, with a directory for each session
+    within that, holding a CSV file for each stream logged in that session.
+    
+    Sessions are written one at a time, and the entries of each session are read in chunks of chunk_size, 
+    so memory use does not grow with the size of the database. Each CSV file has a column for every key used
+    in the entries of its stream in that session; keys missing from an entry are left empty.
+    
+    Parameters:
+        outdir: directory to write the session paths into
+        workers: if given, the number of processes to write sessions in parallel. Each process opens the
+                 database file itself, so this cannot be used with in-memory or open_shards() databases.
+        chunk_size: number of rows fetched from the database at a time
+    """
+    c = cursor
+    names = dict(c.execute("SELECT id, name FROM stream").fetchall())
+    sessions = c.execute("SELECT id, path, valid FROM session ORDER BY id").fetchall()
+    
+    if workers is None:
+        for session, path, svalid in sessions:
+            _session_to_csv(c, session, path, svalid, outdir, names, chunk_size)
+        return
+        
+    fname = [f for _, name, f in c.execute("PRAGMA database_list").fetchall() if name=="main"][0]
+    if not fname:
+        raise ValueError("Parallel CSV export needs a database file, not an in-memory database")
+    pool = multiprocessing.Pool(workers)
+    try:
+        for session in pool.imap_unordered(_session_to_csv_worker, [(fname, session, path, svalid, outdir, names, chunk_size) 
+                                                                    for session, path, svalid in sessions]):
+            logging.debug("Wrote CSV files for session %d" % session)
+    finally:
+        pool.close()
+        pool.join()
 
 def dumpflat(cursor):
     """Return a dictionary of stream entries for the **whole** dataset. Each entry has the t, valid, path, and session fields filled in,
     along with the columns stored in the JSON entries"""
     c = cursor
     rows = c.execute("SELECT log.stream,log.time,log.json,log.valid,stream.name,log.session,session.path,session.valid FROM log JOIN stream ON stream.id=log.stream JOIN session on log.session=session.id").fetchall()
+    decoder = payload.PayloadDecoder(c)
     frame = defaultdict(list)
     for stream, time, js, valid, stream_name,session,path,svalid in rows:
-        d = json.loads(js)
+        d = decoder.loads(js, stream)
         d['t'] = time
         d['valid'] = valid                
         d['session_valid'] = svalid
@@ -154,15 +394,699 @@ def dumpflat(cursor):
     return frame
     
     
+# numpy dtypes for the typed column codes; everything else (TEXT, JSON, MIXED) is stored as objects
+column_dtypes = {"INTEGER": np.int64, "FLOAT": np.float64}
+
+def _empty_column(code, n):
+    return np.empty(n, dtype=column_dtypes.get(code, object))
+
+def _merge_codes(code, new_code):
+    """Return the column code that can hold both code and new_code values"""
+    if code==new_code:
+        return code
+    if set([code, new_code])==set(["INTEGER", "FLOAT"]):
+        return "FLOAT"
+    return "MIXED"
+    
+def _promote_column(column, code, new_code):
+    """Return the (column, code) pair that can hold both code and new_code values"""
+    merged = _merge_codes(code, new_code)
+    if merged!=code:
+        column = column.astype(column_dtypes.get(merged, object))
+    return column, merged
+
+# comparisons that can be used in query() predicates
+query_operators = {"=":"=", "==":"=", "!=":"!=", "<":"<", "<=":"<=", ">":">", ">=":">=", "in":"IN", "not in":"NOT IN"}
+
+def _where_sql(where):
+    """Return the SQL condition and parameters for a list of (field, op, value) payload predicates"""
+    terms, parameters = [], ()
+    for field, op, value in where:
+        if op not in query_operators:
+            raise ValueError("Unknown query operator %s" % op)
+        expression = payload.field_expression(field, "log.json")
+        op = query_operators[op]
+        if value is None and op in ("=", "!="):
+            terms.append("%s IS %sNULL" % (expression, "NOT " if op=="!=" else ""))
+        elif op in ("IN", "NOT IN"):
+            terms.append("%s %s (%s)" % (expression, op, ",".join("?"*len(value))))
+            parameters += tuple(value)
+        else:
+            terms.append("%s %s ?" % (expression, op))
+            parameters += (value,)
+    return " AND ".join(terms), parameters
+    
+def _where_mask(df, where):
+    """Evaluate (field, op, value) payload predicates on a DataFrame from decode_stream()"""
+    mask = np.ones(len(df), dtype=bool)
+    for field, op, value in where:
+        if op not in query_operators:
+            raise ValueError("Unknown query operator %s" % op)
+        if field in df:
+            column = df[field]
+        else:
+            column = pd.Series([None]*len(df), index=df.index, dtype=object)
+        op = query_operators[op]
+        if value is None and op in ("=", "!="):
+            match = column.isnull() if op=="=" else column.notnull()
+        elif op in ("IN", "NOT IN"):
+            match = column.isin(list(value)) if op=="IN" else ~column.isin(list(value))
+        else:
+            match = {"=":column==value, "!=":column!=value, "<":column<value, "<=":column<=value, 
+                     ">":column>value, ">=":column>=value}[op]
+        mask &= np.asarray(match, dtype=bool)
+    return mask
+    
+def decode_stream(cursor, stream, sample_size=1000, chunk_size=10000, min_id=None, max_id=None, start_time=None, end_time=None, where=None, log_ids=False):
+    """Decode one stream of the **whole** dataset directly into column arrays, without building per-row dictionaries.
+    
+    The schema is inferred once from the first sample_size rows of the stream, and typed NumPy columns are
+    then filled in a single pass over the log. Columns which turn out to hold mixed types are promoted to 
+    object columns; keys missing from a row are NaN (numeric columns) or None (object columns).
+    
+    Parameters:
+        stream: name of the stream to decode
+        sample_size: number of rows used to infer the schema
+        chunk_size: number of rows fetched from the database at a time
+        min_id, max_id: if given, only decode log entries with min_id < id <= max_id
+        start_time, end_time: if given, only decode log entries with start_time <= time <= end_time
+        where: if given, only decode log entries matching these predicates on the (JSON) payload (see query())
+        log_ids: If True, the log id of each entry is included, as an id column
+        
+    Returns:
+        columns: dictionary of column name -> NumPy array, with the t, valid, session_valid, path and session
+                 fields filled in, along with the columns stored in the JSON entries
+    """
+    c = cursor
+    stream_id = c.execute("SELECT id FROM stream WHERE name=?", (stream,)).fetchone()[0]
+    # the stream id is given literally, so the partial indices of indexed fields can be used
+    id_range, ids = "log.stream=%d" % stream_id, ()
+    if min_id is not None:
+        id_range, ids = id_range + " AND log.id>?", ids + (min_id,)
+    if max_id is not None:
+        id_range, ids = id_range + " AND log.id<=?", ids + (max_id,)
+    if start_time is not None:
+        id_range, ids = id_range + " AND log.time>=?", ids + (start_time,)
+    if end_time is not None:
+        id_range, ids = id_range + " AND log.time<=?", ids + (end_time,)
+    if where:
+        condition, parameters = _where_sql(where)
+        id_range, ids = id_range + " AND " + condition, ids + parameters
+    # counted with the same JOIN as the decoding query below, so entries of missing sessions aren't counted
+    n = c.execute("SELECT count(log.id) FROM log JOIN session ON log.session=session.id WHERE %s" % id_range, ids).fetchone()[0]
+    
+    # infer the schema from a sample of the stream
+    decoder = payload.PayloadDecoder(c)
+    sample = [decoder.loads(js, stream_id) for js, in c.execute("SELECT json FROM log WHERE %s ORDER BY id LIMIT ?" % id_range, ids + (sample_size,))]
+    codes = {}
+    for d in sample:
+        if isinstance(d, dict):
+            for key, value in d.iteritems():
+                codes[key] = _merge_codes(codes.get(key, json_code(value)), json_code(value))
+    columns = {key:_empty_column(code, n) for key, code in codes.iteritems()}
+    present = {key:np.zeros(n, dtype=bool) for key in codes}
+        
+    t = np.empty(n, dtype=np.float64)
+    valid = np.empty(n, dtype=np.int64)
+    session_valid = np.empty(n, dtype=np.float64) # NULL for unfinished sessions
+    path = np.empty(n, dtype=object)
+    session = np.empty(n, dtype=np.int64)
+    log_id = np.empty(n, dtype=np.int64)
+    
+    result = c.execute("SELECT log.time,log.valid,session.valid,session.path,log.session,log.json,log.id FROM log JOIN session ON log.session=session.id WHERE %s ORDER BY log.id" % id_range, ids)
+    i = 0
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        k = len(rows)
+        fields = zip(*rows)
+        t[i:i+k] = fields[0]
+        valid[i:i+k] = fields[1]
+        session_valid[i:i+k] = fields[2]
+        path[i:i+k] = fields[3]
+        session[i:i+k] = fields[4]
+        log_id[i:i+k] = fields[6]
+        for js in fields[5]:
+            d = decoder.loads(js, stream_id)
+            if isinstance(d, dict):
+                for key, value in d.iteritems():
+                    code = json_code(value)
+                    if key not in columns:
+                        # a key that was not in the sample
+                        codes[key] = code
+                        columns[key] = _empty_column(code, n)
+                        present[key] = np.zeros(n, dtype=bool)
+                    elif codes[key]!=code:
+                        columns[key], codes[key] = _promote_column(columns[key], codes[key], code)
+                    columns[key][i] = value
+                    present[key][i] = True
+            i += 1
+    
+    # fill in the missing entries
+    for key, column in columns.iteritems():
+        missing = ~present[key]
+        if missing.any():
+            if codes[key]=="INTEGER":
+                column = columns[key] = column.astype(np.float64)
+            column[missing] = np.nan if column.dtype==np.float64 else None
+            
+    columns.update(t=t, valid=valid, session_valid=session_valid, path=path, session=session)
+    if log_ids:
+        columns["id"] = log_id
+    return columns
+    
+def query(cursor, stream, where, start_time=None, end_time=None):
+    """Return the entries of a stream whose payloads match the predicates in where, as a DataFrame
+    in the same format as dump_flat_dataframe().
+    
+    Each predicate is a (field, op, value) tuple, where op is one of =, ==, !=, <, <=, >, >=, in or not in
+    (with a list of values), and nested fields are given as dotted paths. For example:
+        query(cursor, "satisfaction", [("score", "<", 3)])
+        query(cursor, "trial", [("condition", "=", "B"), ("block", "in", [1, 2])])
+        
+    The predicates are evaluated by SQLite, and use the indices of fields declared with 
+    ExperimentLog.index_field(), so only the matching entries are read. Packed streams (see 
+    ExperimentLog.set_codec()) are decoded in full and filtered here instead.
+    """
+    stream_id = cursor.execute("SELECT id FROM stream WHERE name=?", (stream,)).fetchone()[0]
+    if stream_id in payload.PayloadDecoder(cursor).keys:
+        df = pd.DataFrame(decode_stream(cursor, stream, start_time=start_time, end_time=end_time))
+        return df[_where_mask(df, where)].reset_index(drop=True)
+    return pd.DataFrame(decode_stream(cursor, stream, start_time=start_time, end_time=end_time, where=where))
+    
 def dump_flat_dataframe(cursor):    
-    frame = dumpflat(cursor)
+    """Return a dictionary of stream name -> DataFrame for the **whole** dataset, in the same format as dumpflat()"""
+    streams = cursor.execute("SELECT name FROM stream WHERE id IN (SELECT DISTINCT(stream) FROM log)").fetchall()
     dfs = {}
-    for key, df in frame.iteritems():
-        columns = json_columns(df)
-        dfs[key] = pd.DataFrame(df, columns=columns.keys())
+    for stream, in streams:
+        dfs[stream] = pd.DataFrame(decode_stream(cursor, stream))
     return dfs
     
 
+# window sizes (in seconds) of the stream summaries
+default_resolutions = [0.01, 1.0, 60.0]
+# columns of decode_stream() which are not summarised
+unsummarised_columns = set(["t", "valid", "session_valid", "session"])
+
+def _next_chunk_end(cursor, start_id, chunk_size, max_id):
+    """Return the id which ends the chunk of chunk_size log entries after start_id"""
+    end = cursor.execute("SELECT id FROM log WHERE id>? ORDER BY id LIMIT 1 OFFSET ?", (start_id, chunk_size-1)).fetchone()
+    if end is None or end[0]>max_id:
+        return max_id
+    return end[0]
+    
+def _bin_fields(t, columns, resolution):
+    """Aggregate the numeric columns into bins of the given resolution; 
+    returns a list of (bin, field, count, total, minimum, maximum) rows"""
+    bins = np.floor(t / resolution).astype(np.int64)
+    rows = []
+    for field, column in columns.iteritems():
+        values = column.astype(np.float64)
+        ok = np.isfinite(values)
+        order = np.argsort(bins[ok], kind="mergesort")
+        b, v = bins[ok][order], values[ok][order]
+        if len(b)==0:
+            continue
+        starts = np.flatnonzero(np.r_[True, b[1:]!=b[:-1]])
+        counts = np.diff(np.r_[starts, len(b)])
+        rows.extend(zip(b[starts].tolist(), [field]*len(starts), counts.tolist(), np.add.reduceat(v, starts).tolist(), 
+                        np.minimum.reduceat(v, starts).tolist(), np.maximum.reduceat(v, starts).tolist()))
+    return rows
+    
+def update_summaries(cursor, resolutions=None, refresh=False, chunk_size=100000):
+    """Bring the multi-resolution stream summaries up to date. 
+    
+    For every numeric field of every stream, the count, sum, minimum and maximum of the values in each time 
+    window of each resolution are stored in the summary table. Only log entries added since the last update are 
+    read (chunk_size at a time), and merged into the existing windows, so this can be run repeatedly during and 
+    after capture.
+    
+    Parameters:
+        resolutions: list of window sizes, in seconds. Defaults to default_resolutions (10ms, 1s, 1min).
+        refresh: If True, the summaries are rebuilt from scratch
+    """
+    resolutions = resolutions or default_resolutions
+    c = cursor
+    c.execute("CREATE TABLE IF NOT EXISTS summary (stream INT, resolution REAL, bin INT, field TEXT, count INT, total REAL, minimum REAL, maximum REAL, PRIMARY KEY(stream, resolution, bin, field))")
+    c.execute("CREATE TABLE IF NOT EXISTS summary_info (id INTEGER PRIMARY KEY, log_id INT, time REAL)")
+    if refresh:
+        c.execute("DELETE FROM summary")
+        c.execute("DELETE FROM summary_info")
+    watermark = c.execute("SELECT max(log_id) FROM summary_info").fetchone()[0] or 0
+    max_id = c.execute("SELECT max(id) FROM log").fetchone()[0] or 0
+    
+    while watermark < max_id:
+        end_id = _next_chunk_end(c, watermark, chunk_size, max_id)
+        streams = c.execute("SELECT id, name FROM stream WHERE id IN (SELECT DISTINCT(stream) FROM log WHERE id>? AND id<=?)", (watermark, end_id)).fetchall()
+        for stream_id, stream in streams:
+            columns = decode_stream(c, stream, min_id=watermark, max_id=end_id)
+            numeric = {key:column for key, column in columns.iteritems() if key not in unsummarised_columns and column.dtype!=object}
+            for resolution in resolutions:
+                rows = _bin_fields(columns["t"], numeric, resolution)
+                # merge into any windows already summarised
+                c.executemany("""INSERT INTO summary(stream, resolution, bin, field, count, total, minimum, maximum) VALUES (?,?,?,?,?,?,?,?) 
+                              ON CONFLICT(stream, resolution, bin, field) DO UPDATE SET count=count+excluded.count, total=total+excluded.total,
+                              minimum=min(minimum, excluded.minimum), maximum=max(maximum, excluded.maximum)""",
+                              [(stream_id, resolution) + row for row in rows])
+        watermark = end_id
+        c.execute("INSERT INTO summary_info(log_id, time) VALUES (?,?)", (watermark, time.time()))
+        c.connection.commit()
+        
+def summary(cursor, stream, start_time, end_time, width=1000, fields=None):
+    """Return the summary of a stream over a time range, at the resolution that best suits
+    plotting it width pixels wide: the coarsest resolution that still has at least one window per pixel
+    (or the finest resolution, if none do). update_summaries() must have been run first.
+    
+    Parameters:
+        stream: name of the stream
+        start_time, end_time: time range to summarise
+        width: number of pixels (or points) required
+        fields: If given, list of fields to include
+    
+    Returns:
+        resolution: the window size used, in seconds
+        summary: a DataFrame with one row per field and window, with columns field, t (start of the window),
+                 count, mean, min and max
+    """
+    c = cursor
+    stream_id = c.execute("SELECT id FROM stream WHERE name=?", (stream,)).fetchone()[0]
+    resolutions = sorted(r for r, in c.execute("SELECT DISTINCT(resolution) FROM summary WHERE stream=?", (stream_id,)).fetchall())
+    if not resolutions:
+        return None, pd.DataFrame(columns=["field", "t", "count", "mean", "min", "max"])
+    suitable = [r for r in resolutions if (end_time-start_time)/r >= width]
+    resolution = suitable[-1] if suitable else resolutions[0]
+    
+    query = "SELECT field, bin, count, total, minimum, maximum FROM summary WHERE stream=? AND resolution=? AND bin>=? AND bin<=?"
+    parameters = (stream_id, resolution, int(np.floor(start_time/resolution)), int(np.floor(end_time/resolution)))
+    if fields is not None:
+        query += " AND field IN (%s)" % ",".join("?"*len(fields))
+        parameters += tuple(fields)
+    rows = c.execute(query + " ORDER BY field, bin", parameters).fetchall()
+    df = pd.DataFrame.from_records(rows, columns=["field", "bin", "count", "total", "min", "max"])
+    df["t"] = df["bin"] * resolution
+    df["mean"] = df["total"] / df["count"]
+    return resolution, df[["field", "t", "count", "mean", "min", "max"]]
+    
+def _match_times(t, targets, method="nearest", tolerance=None):
+    """Match each target time to a sample of the sorted times t, with searchsorted.
+    
+    Returns:
+        index: the index into t of the matched sample, for each target
+        matched: boolean array, False where there is no matching sample
+    """
+    after = np.searchsorted(t, targets, side="right")
+    before = np.maximum(after - 1, 0)
+    if len(t)==0:
+        return np.zeros(len(targets), dtype=np.int64), np.zeros(len(targets), dtype=bool)
+    if method=="previous":
+        index = before
+        matched = after>0
+    elif method in ("nearest", "linear"):
+        after = np.minimum(after, len(t)-1)
+        index = np.where(np.abs(t[after]-targets) < np.abs(targets-t[before]), after, before)
+        matched = np.ones(len(targets), dtype=bool)
+    else:
+        raise ValueError("Unknown alignment method %s" % method)
+    if tolerance is not None:
+        matched &= np.abs(t[index]-targets) <= tolerance
+    return index, matched
+    
+def _align_columns(columns, targets, method="nearest", tolerance=None):
+    """Resample a dictionary of columns (including the time column "t") onto the target times.
+    
+    method: "nearest" takes the nearest sample, "previous" the last sample at or before each target, 
+            and "linear" linearly interpolates numeric columns (other columns use the nearest sample)
+    tolerance: If given, targets further than this (in seconds) from the matched sample are left missing
+    """
+    t = columns["t"]
+    if len(t)==0:
+        # nothing to match (e.g. an empty stream, or nothing within the tolerance)
+        return {key:_missing_column(len(targets), column.dtype) for key, column in columns.iteritems()}
+    order = np.argsort(t, kind="mergesort")
+    t = t[order]
+    index, matched = _match_times(t, targets, method, tolerance)
+    aligned = {}
+    for key, column in columns.iteritems():
+        column = column[order]
+        if method=="linear" and column.dtype!=object and key!="t" and len(t)>0:
+            values = np.interp(targets, t, column.astype(np.float64))
+        elif column.dtype==object:
+            values = column[index]
+        else:
+            values = column[index].astype(np.float64)
+        values[~matched] = None if values.dtype==object else np.nan
+        aligned[key] = values
+    return aligned
+    
+def sync_entry(cursor, fname):
+    """Return the latest sync_ext() entry for the media file fname, as a dictionary"""
+    row = cursor.execute("SELECT id, fname, description, json, start_time, media_start_time, duration, time_rate FROM sync_ext WHERE fname=? ORDER BY id DESC", (fname,)).fetchone()
+    if row is None:
+        raise KeyError("No sync_ext entry for %s" % fname)
+    id, fname, description, js, start_time, media_start_time, duration, time_rate = row
+    return dict(id=id, fname=fname, description=description, data=json.loads(js or 'null'), start_time=start_time,
+                media_start_time=media_start_time or 0, duration=duration, time_rate=time_rate if time_rate is not None else 1.0)
+    
+def media_to_log_time(sync, media_times):
+    """Map times in a media file (in seconds) to log times, using a sync_entry()"""
+    return sync["start_time"] + (np.asarray(media_times, dtype=np.float64) - sync["media_start_time"]) * sync["time_rate"]
+    
+def align_media(cursor, fname, streams, frames=None, media_times=None, frame_rate=None, method="nearest", tolerance=None):
+    """Align log streams to the frames of a media file registered with ExperimentLog.sync_ext().
+    
+    Each frame is mapped to log time, and every stream is resampled onto the frame timeline in one 
+    vectorised pass.
+    
+    Parameters:
+        fname: the media file, as passed to sync_ext()
+        streams: list of stream names to align
+        frames: frame numbers to align to. Converted to media times with frame_rate (or the "frame_rate" 
+                stored in the sync_ext data)
+        media_times: media times (in seconds) to align to, instead of frames
+        method, tolerance: how streams are resampled; see _align_columns()
+        
+    Returns:
+        A DataFrame with one row per frame, with frame, media_time and t (log time) columns, and a 
+        <stream>.<column> column for every column of each stream (as in dump_flat_dataframe()). 
+        <stream>.t gives the time of the sample used.
+    """
+    sync = sync_entry(cursor, fname)
+    if media_times is None:
+        frame_rate = frame_rate or (sync["data"] or {}).get("frame_rate")
+        if frame_rate is None:
+            raise ValueError("No frame rate given or stored for %s" % fname)
+        if frames is None:
+            if sync["duration"] is None:
+                raise ValueError("No frames given, and no duration stored for %s" % fname)
+            frames = np.arange(int(sync["duration"] * frame_rate))
+        frames = np.asarray(frames)
+        media_times = frames / float(frame_rate)
+    targets = media_to_log_time(sync, media_times)
+    
+    aligned = {"media_time":np.asarray(media_times, dtype=np.float64), "t":targets}
+    if frames is not None:
+        aligned["frame"] = frames
+    # with a tolerance, only the part of each stream around the media needs to be decoded
+    start_time = end_time = None
+    if tolerance is not None and len(targets)>0:
+        start_time, end_time = targets.min()-tolerance, targets.max()+tolerance
+    for stream in streams:
+        columns = decode_stream(cursor, stream, start_time=start_time, end_time=end_time)
+        for key, values in _align_columns(columns, targets, method, tolerance).iteritems():
+            aligned["%s.%s" % (stream, key)] = values
+    first = [key for key in ["frame", "media_time", "t"] if key in aligned]
+    return pd.DataFrame(aligned, columns=first + sorted(set(aligned) - set(first)))
+    
+def _missing_column(n, dtype):
+    if dtype==object:
+        return np.empty(n, dtype=object)
+    return np.full(n, np.nan)
+    
+def _concat_columns(a, b):
+    """Concatenate two dictionaries of columns (with a "t" column), filling in any columns missing from either"""
+    n_a, n_b = len(a["t"]), len(b["t"])
+    return {key:np.concatenate([a[key] if key in a else _missing_column(n_a, b[key].dtype), 
+                                b[key] if key in b else _missing_column(n_b, a[key].dtype)]) for key in set(a) | set(b)}
+    
+class _TimeOrderedReader(object):
+    """Reads one stream from the database in time order, a chunk at a time, and buffers the rows 
+    around the current alignment position"""
+    def __init__(self, cursor, stream, chunk_size):
+        stream_id = cursor.execute("SELECT id FROM stream WHERE name=?", (stream,)).fetchone()[0]
+        # each stream has its own cursor, so the streams can be read side by side
+        self.result = cursor.connection.cursor().execute("SELECT time, json FROM log WHERE stream=? ORDER BY time", (stream_id,))
+        self.stream_id = stream_id
+        self.decoder = payload.PayloadDecoder(cursor)
+        self.chunk_size = chunk_size
+        self.columns = {"t":np.zeros(0)}
+        self.exhausted = False
+        
+    def read_chunk(self):
+        """Return the next chunk of the stream as a dictionary of columns, or None at the end of the stream"""
+        rows = self.result.fetchmany(self.chunk_size)
+        if not rows:
+            self.exhausted = True
+            return None
+        records = []
+        for t, js in rows:
+            d = self.decoder.loads(js, self.stream_id)
+            d = d if isinstance(d, dict) else {}
+            d["t"] = t
+            records.append(d)
+        return records_columns(records)
+        
+    def advance(self, until, limit=None):
+        """Buffer rows until the buffer holds a row after time until, or the stream ends. 
+        If limit is given, stop early once the buffer holds limit rows; returns True if it did"""
+        while not self.exhausted and (len(self.columns["t"])==0 or self.columns["t"][-1] <= until):
+            if limit is not None and len(self.columns["t"]) >= limit:
+                return True
+            chunk = self.read_chunk()
+            if chunk is not None:
+                self.columns = _concat_columns(self.columns, chunk)
+        return False
+                
+    def trim(self, until):
+        """Drop the buffered rows that can't be matched to targets after time until"""
+        start = max(np.searchsorted(self.columns["t"], until, side="right") - 1, 0)
+        self.columns = {key:column[start:] for key, column in self.columns.iteritems()}
+        
+def align_chunks(cursor, streams, rate=None, reference_stream=None, method="nearest", tolerance=None, chunk_size=10000):
+    """Align several streams onto a common clock, one chunk of chunk_size rows at a time (see align()). 
+    Each stream is read in time order side by side (a k-way merge). A dense stream can hold many
+    more rows than there are targets in a chunk, so each stream buffers at most a few chunks of rows:
+    when one would buffer more, the chunk is aligned in several smaller time windows instead. 
+    Memory use is therefore bounded by the chunk size, not the size or density of the streams.
+    
+    Returns:
+        generator of DataFrames, one per chunk
+    """
+    readers = [(stream, _TimeOrderedReader(cursor, stream, chunk_size)) for stream in streams if stream!=reference_stream]
+    if reference_stream is not None:
+        reference = _TimeOrderedReader(cursor, reference_stream, chunk_size)
+        def target_chunks():
+            while True:
+                chunk = reference.read_chunk()
+                if chunk is None:
+                    return
+                yield chunk
+    elif rate is not None:
+        ids = [cursor.execute("SELECT id FROM stream WHERE name=?", (stream,)).fetchone()[0] for stream in streams]
+        start, end = cursor.execute("SELECT min(time), max(time) FROM log WHERE stream IN (%s)" % ",".join("?"*len(ids)), ids).fetchone()
+        def target_chunks():
+            if start is None:
+                return
+            k = 0
+            while True:
+                targets = start + np.arange(k*chunk_size, (k+1)*chunk_size) / float(rate)
+                targets = targets[targets<=end]
+                if len(targets)==0:
+                    return
+                yield {"t":targets}
+                k += 1
+    else:
+        raise ValueError("One of rate or reference_stream must be given")
+        
+    limit = 2 * chunk_size
+    for target_columns in target_chunks():
+        targets = target_columns["t"]
+        aligned = {"t":np.zeros(0)}
+        first = 0
+        while first < len(targets):
+            # shrink the window [first, stop) until no stream needs more than limit rows to cover it
+            stop = len(targets)
+            for stream, reader in readers:
+                while reader.advance(targets[stop-1], limit):
+                    last = reader.columns["t"][-1]
+                    if last >= targets[first]:
+                        stop = min(stop, np.searchsorted(targets, last, side="right"))
+                        break
+                    # all the buffered rows come before the window, so only the last one can be matched
+                    reader.trim(targets[first])
+            window = {"t":targets[first:stop]}
+            for stream, reader in readers:
+                for key, values in _align_columns(reader.columns, window["t"], method, tolerance).iteritems():
+                    window["%s.%s" % (stream, key)] = values
+                reader.trim(targets[stop-1])
+            aligned = _concat_columns(aligned, window)
+            first = stop
+        if reference_stream is not None:
+            for key, values in target_columns.iteritems():
+                aligned["%s.%s" % (reference_stream, key)] = values
+        yield pd.DataFrame(aligned, columns=["t"] + sorted(set(aligned) - set(["t"])))
+        
+def align(cursor, streams, rate=None, reference_stream=None, method="nearest", tolerance=None, chunk_size=10000):
+    """Align several streams onto a common clock, as a single table.
+    
+    Parameters:
+        streams: list of stream names to align
+        rate: If given, align to a regular clock of this rate (in Hz), covering all of the streams
+        reference_stream: Otherwise, align to the times of the entries of this stream
+        method: "nearest", "previous" or "linear" (see _align_columns())
+        tolerance: If given, entries further than this (in seconds) from a target time are not used
+        chunk_size: number of rows read and aligned at a time
+        
+    Returns:
+        A DataFrame with a t column, and a <stream>.<field> column for every field of each stream. <stream>.t 
+        gives the time of the entry used.
+    """
+    chunks = list(align_chunks(cursor, streams, rate=rate, reference_stream=reference_stream, method=method, tolerance=tolerance, chunk_size=chunk_size))
+    if not chunks:
+        return pd.DataFrame(columns=["t"])
+    return pd.concat(chunks, ignore_index=True)
+    
+# queued by the replay prefetch thread after the last chunk
+_END = object()
+
+def _put_unless_stopped(chunks, item, stop):
+    """Wait for space on the queue chunks to put item, but give up if stop is set (the consumer has gone away)"""
+    while not stop.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def _session_time_index(conn, schema):
+    """Make sure the log in the given schema has an index on (session, time, ...), so that each session 
+    can be read in time order without sorting it. finalize() builds one; otherwise it is created here. 
+    Returns False if there is none and it can't be created (e.g. the database is read only or locked)."""
+    for _, index in [row[:2] for row in conn.execute("PRAGMA %s.index_list(log)" % schema).fetchall()]:
+        columns = [info[2] for info in conn.execute("PRAGMA %s.index_info(%s)" % (schema, index)).fetchall()]
+        if columns[:2]==["session", "time"]:
+            return True
+    logging.warn("Indexing the log by session for replay(); finalize() the database to do this in advance")
+    try:
+        conn.execute("CREATE INDEX IF NOT EXISTS %s.log_session_time_ix ON log(session, time, id)" % schema)
+        conn.commit()
+        return True
+    except sqlite3.OperationalError as e:
+        logging.warn("Could not index the log (%s); replay() will sort the entries first" % e)
+        return False
+    
+def _merge_session_rows(conn, schemas, path, streams):
+    """Yield the log rows of replay() in (time, id) order, by merging one cursor per session (and shard), 
+    each read in time order from the (session, time) index. A session's cursor is only opened once the 
+    merge reaches its first entry, so only the sessions that overlap in time are read side by side."""
+    sessions = conn.execute("SELECT id, path FROM session WHERE substr(path, 1, ?)=?", (len(path), path)).fetchall()
+    query = """SELECT log.id, log.session, stream.name, log.time, log.valid, log.tag, log.json, log.binary, log.stream
+               FROM %s.log AS log JOIN stream ON stream.id=log.stream WHERE log.session=?"""
+    parameters = ()
+    if streams is not None:
+        query += " AND stream.name IN (%s)" % ",".join("?"*len(streams))
+        parameters += tuple(streams)
+    starts = []
+    for schema in schemas:
+        for session, spath in sessions:
+            first = conn.execute("SELECT min(time) FROM %s.log WHERE session=?" % schema, (session,)).fetchone()[0]
+            if first is not None:
+                starts.append((first, schema, session, spath))
+    starts.sort()
+    merge = []
+    def push(rows, spath):
+        row = next(rows, None)
+        if row is not None:
+            # ties in time are broken by id, so replays are repeatable
+            heapq.heappush(merge, ((row[3], row[0]), row[:2] + (spath,) + row[2:], rows, spath))
+    k = 0
+    while merge or k < len(starts):
+        while k < len(starts) and (not merge or starts[k][0] <= merge[0][0][0]):
+            first, schema, session, spath = starts[k]
+            push(conn.execute(query % schema + " ORDER BY log.time, log.id", (session,) + parameters), spath)
+            k += 1
+        _, row, rows, spath = heapq.heappop(merge)
+        yield row
+        push(rows, spath)
+        
+def _prefetch_records(fname, path, streams, chunk_size, chunks, stop):
+    """Read the log entries of replay() in a background thread, with its own connection, and put each
+    chunk of LogRecords on the queue chunks. Stops early if stop is set."""
+    try:
+        conn = sqlite3.connect(fname)
+        if conn.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='shards'").fetchone()[0]:
+            conn.close()
+            conn = open_shards(fname)
+        cursor = conn.cursor()
+        decoder = payload.PayloadDecoder(cursor)
+        # the schemas holding a log table: main, each attached shard, or (for a sharded database without shards) temp
+        schemas = [name for _, name, _ in conn.execute("PRAGMA database_list").fetchall()
+                   if conn.execute("SELECT count(*) FROM %s.sqlite_master WHERE type='table' AND name='log'" % name).fetchone()[0]]
+        if all([_session_time_index(conn, schema) for schema in schemas]):
+            entries = _merge_session_rows(conn, schemas, path, streams)
+        else:
+            query = """SELECT log.id, log.session, session.path, stream.name, log.time, log.valid, log.tag, log.json, log.binary, log.stream
+                       FROM log JOIN stream ON stream.id=log.stream JOIN session ON session.id=log.session
+                       WHERE log.session IN (SELECT id FROM session WHERE substr(path, 1, ?)=?)"""
+            parameters = (len(path), path)
+            if streams is not None:
+                query += " AND stream.name IN (%s)" % ",".join("?"*len(streams))
+                parameters += tuple(streams)
+            # ties in time are broken by id, so replays are repeatable
+            entries = iter(cursor.execute(query + " ORDER BY log.time, log.id", parameters))
+        while not stop.is_set():
+            rows = list(itertools.islice(entries, chunk_size))
+            if not rows:
+                break
+            chunk = [LogRecord(id, session, spath, stream, t, valid, tag, decoder.loads(js, stream_id), binary) 
+                     for id, session, spath, stream, t, valid, tag, js, binary, stream_id in rows]
+            _put_unless_stopped(chunks, chunk, stop)
+        conn.close()
+        _put_unless_stopped(chunks, _END, stop)
+    except Exception as e:
+        _put_unless_stopped(chunks, e, stop)
+        
+def replay(fname, path="/", streams=None, speed=None, chunk_size=1000, prefetch=4):
+    """Replay the log entries of the sessions with the given path (and all of their descendants), from every stream
+    merged in time order, as if they were being logged live. Entries are read in chunks by a background thread, 
+    at most prefetch chunks ahead, so memory use does not depend on the length of the sessions.
+    
+        for record in extract.replay("my.db", "/Experiment/Trial/", speed=10.0):
+            analysis.update(record)
+    
+    Parameters:
+        fname: database file (sharded databases are opened with open_shards())
+        path: session path to replay; "/Experiment/Trial" and "/Experiment/Trial/" both replay 
+              /Experiment/Trial/ and its descendants, but not /Experiment/Trial2/
+        streams: If given, only replay entries from these streams (a list of names)
+        speed: If None, entries are yielded as fast as they are consumed. Otherwise, they are paced at 
+               speed times real time (1.0 is real time), from the time of the first entry.
+        chunk_size: number of entries read at a time
+        prefetch: number of chunks read ahead
+        
+    Returns:
+        generator of LogRecord tuples, in (time, id) order, the same as LogSubscriber yields
+        
+    Each session is read in time order from an index on log(session, time), which finalize() builds
+    (or which is built here, the first time), and the sessions are merged as they are read.
+    """
+    # session paths end in /, so a path without one would also match its siblings with longer names
+    if not path.endswith("/"):
+        path += "/"
+    chunks = queue.Queue(prefetch)
+    stop = threading.Event()
+    thread = threading.Thread(target=_prefetch_records, args=(fname, path, streams, chunk_size, chunks, stop))
+    thread.daemon = True
+    thread.start()
+    start = None
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _END:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            for record in chunk:
+                if speed is not None:
+                    if start is None:
+                        start = (record.time, time.time())
+                    delay = start[1] + (record.time - start[0]) / speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                yield record
+    finally:
+        stop.set()
+        
 def to_csv_flat(cursor, csvdir):
     """Write each stream type to an individual CSV file in the given directory, in the same format as dumpflat() does"""
     streams = dumpflat(cursor)    
@@ -224,6 +1148,7 @@ def paths(cursor):
 def dump_dataframe(cursor):    
     c = cursor
     all = defaultdict(list) 
+    decoder = payload.PayloadDecoder(c)
     paths = c.execute("SELECT DISTINCT(path) FROM session").fetchall()    
     for path in paths:
         sessions = c.execute("SELECT id FROM session WHERE path=?", path).fetchall()            
@@ -231,7 +1156,7 @@ def dump_dataframe(cursor):
             rows = c.execute("SELECT log.stream,log.time,log.json,log.valid,stream.name FROM log JOIN stream ON stream.id=log.stream WHERE session=? ", session).fetchall()
             frame = defaultdict(list)
             for stream, time, js, valid, stream_name in rows:
-                d = json.loads(js)
+                d = decoder.loads(js, stream)
                 d['t'] = time
                 d['valid'] = valid                
                 frame[stream_name].append(d)            
@@ -264,7 +1189,7 @@ def meta(cursor):
     metas = defaultdict(list)
     bound_ix = defaultdict(list)
     for id,name,description,stype,mtype,js in meta:        
-        session = c.execute("SELECT session FROM meta_session WHERE meta_session.meta=?", (id,)).fetchall()    
+        session = c.execute("SELECT session FROM meta_session WHERE meta_session.meta=? AND meta_session.session IS NOT NULL", (id,)).fetchall()    
         if session is not None:            
             bound = [s[0] for s in session]
         else:
@@ -287,13 +1212,425 @@ def meta_dataframe(cursor):
         
     return frames
     
+def records_columns(records):
+    """Convert a sequence of dictionaries into a dictionary of column name -> NumPy array, typed in the same way as 
+    decode_stream(). None values are treated as missing."""
+    codes = {}
+    for record in records:
+        for key, value in record.iteritems():
+            if value is not None:
+                codes[key] = _merge_codes(codes.get(key, json_code(value)), json_code(value))
+    keys = set(key for record in records for key in record)
+    columns = {}
+    for key in keys:
+        code = codes.get(key, "JSON")
+        values = [record.get(key) for record in records]
+        if code in column_dtypes:
+            if None in values:
+                columns[key] = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+            else:
+                columns[key] = np.array(values, dtype=column_dtypes[code])
+        else:
+            # fill element-wise, so that list values are not turned into extra dimensions
+            columns[key] = np.empty(len(values), dtype=object)
+            for i, v in enumerate(values):
+                columns[key][i] = v
+    return columns
+
+def _has_pyarrow():
+    try:
+        import pyarrow.parquet
+        return True
+    except ImportError:
+        return False
+
+def _write_columns(dirname, columns, format):
+    """Write a dictionary of column arrays to the directory dirname, either as a single Parquet file or 
+    as one .npy file per column. Object columns are written as JSON encoded strings. The layout is recorded
+    in dirname/schema.json."""
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    schema = []
+    encoded = []
+    for i, (name, column) in enumerate(sorted(columns.iteritems())):
+        kind = "npy"
+        if column.dtype==object:
+            column = np.array([json.dumps(v) for v in column], dtype=str)
+            kind = "json"
+        schema.append(dict(name=name, file="col%d.npy" % i, kind=kind))
+        encoded.append(column)
+    n = len(encoded[0]) if encoded else 0
+    if format=="parquet":
+        import pyarrow, pyarrow.parquet
+        table = pyarrow.Table.from_arrays([pyarrow.array(c) for c in encoded], [s["name"] for s in schema])
+        pyarrow.parquet.write_table(table, os.path.join(dirname, "part.parquet"))
+    else:
+        for s, column in zip(schema, encoded):
+            np.save(os.path.join(dirname, s["file"]), column)
+    with open(os.path.join(dirname, "schema.json"), "w") as f:
+        json.dump(dict(format=format, rows=n, columns=schema), f)
+
+def _write_table(dirname, columns, format):
+    """Replace the (small) table in dirname with the given columns"""
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    _write_columns(dirname, columns, format)
+    
+def _quote_name(name):
+    """URL quote a stream name or session path for use as a file name"""
+    if isinstance(name, unicode):
+        name = name.encode("utf-8")
+    return urllib.quote(name, safe='')
+    
+def _read_stream_index(stream_dir):
+    index_file = os.path.join(stream_dir, "index.json")
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            return json.load(f)
+    return {"parts":[]}
+    
+def export_columns(cursor, outdir, incremental=False, format=None, log_ids=False):
+    """Export the database into columnar files, so that it can be reloaded without decoding any JSON.
+    
+    Each stream is written to outdir/streams/<stream>/path=<path>/part-<first id>/, partitioned by session path
+    (both names are URL quoted). The sessions, meta data and bindings (as returned by dump_sessions() and meta()) 
+    are written to outdir/sessions, outdir/meta and outdir/bindings. 
+    
+    Parameters:
+        outdir: directory to export to
+        incremental: If True, only log entries added since the last export to outdir are exported,
+                     as new parts. Otherwise, any previously exported streams are replaced.
+        format: "parquet" or "npy". If None, uses Parquet if pyarrow is installed, and .npy files otherwise.
+        log_ids: If True, the log id of each entry is exported too, as an id column
+        
+    Returns:
+        watermark: the largest log id that has been exported
+    """
+    index_file = os.path.join(outdir, "export.json")
+    watermark = 0
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+        if incremental:
+            watermark = index["watermark"]
+            format = index["format"]
+        elif os.path.exists(os.path.join(outdir, "streams")):
+            shutil.rmtree(os.path.join(outdir, "streams"))
+    if format is None:
+        if _has_pyarrow():
+            format = "parquet"
+        else:
+            logging.warn("No pyarrow installed; exporting .npy columns instead of Parquet.\n 'pip install pyarrow' will install pyarrow")
+            format = "npy"
+            
+    max_id = cursor.execute("SELECT max(id) FROM log").fetchone()[0] or 0
+    streams = cursor.execute("SELECT name FROM stream WHERE id IN (SELECT DISTINCT(stream) FROM log WHERE id>? AND id<=?)", (watermark, max_id)).fetchall()
+    for stream, in streams:
+        logging.debug("Exporting stream %s (ids %d-%d)" % (stream, watermark+1, max_id))
+        columns = decode_stream(cursor, stream, min_id=watermark, max_id=max_id, log_ids=log_ids)
+        stream_dir = os.path.join(outdir, "streams", _quote_name(stream))
+        # the sidecar index records what each part holds, so readers can skip parts without opening them
+        stream_index = _read_stream_index(stream_dir)
+        path = columns["path"]
+        for p in np.unique(path):
+            selected = path==p
+            part = os.path.join("path=%s" % _quote_name(p), "part-%012d" % (watermark+1))
+            _write_columns(os.path.join(stream_dir, part), {key:column[selected] for key, column in columns.iteritems()}, format)
+            stream_index["parts"].append(dict(dir=part, path=p, rows=int(selected.sum()),
+                                              sessions=sorted(set(columns["session"][selected].tolist())),
+                                              start_time=float(columns["t"][selected].min()), end_time=float(columns["t"][selected].max())))
+        with open(os.path.join(stream_dir, "index.json"), "w") as f:
+            json.dump(stream_index, f)
+    
+    # the session and meta tables are small, and are always exported in full
+    _write_table(os.path.join(outdir, "sessions"), records_columns(dump_sessions(cursor).values()), format)
+    metas, _ = meta(cursor)
+    meta_records, bindings = [], []
+    for mtype, entries in metas.iteritems():
+        for m in entries:
+            meta_records.append(dict(mtype=mtype, name=m["name"], description=m["description"], type=m["type"], data=m["data"]))
+            bindings.extend([dict(session=session, mtype=mtype, name=m["name"]) for session in m["bound"]])
+    _write_table(os.path.join(outdir, "meta"), records_columns(meta_records), format)
+    _write_table(os.path.join(outdir, "bindings"), records_columns(bindings), format)
+    
+    with open(index_file, "w") as f:
+        json.dump(dict(watermark=max_id, format=format, time=time.time()), f)
+    return max_id
+    
+def _load_column(dirname, schema, name):
+    """Load one column of an exported part. Numeric .npy columns are memory mapped, not read."""
+    for column in schema["columns"]:
+        if column["name"]==name:
+            break
+    else:
+        # this part does not have the column at all
+        return np.full(schema["rows"], np.nan)
+    if schema["format"]=="parquet":
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(os.path.join(dirname, "part.parquet"), columns=[name], memory_map=True)
+        data = table.to_pandas()[name].values
+    else:
+        data = np.load(os.path.join(dirname, column["file"]), mmap_mode='r')
+    if column["kind"]=="json":
+        decoded = np.empty(len(data), dtype=object)
+        for i, js in enumerate(data):
+            decoded[i] = json.loads(js)
+        return decoded
+    return data
+    
+class StreamColumns(object):
+    """Read-only, dictionary-like view of the columns of an exported stream (see open_stream()).
+    
+    Columns are only loaded when they are accessed. If the view covers a single part and
+    no sessions are filtered out, numeric columns are returned directly as read-only memory mapped arrays, 
+    so only the pages that are actually touched are read from disk. Otherwise, the selected rows are copied.
+    """
+    def __init__(self, parts):
+        # list of (dirname, schema, selected rows or None for all rows)
+        self.parts = parts
+        
+    def keys(self):
+        keys = []
+        for dirname, schema, selected in self.parts:
+            keys.extend([c["name"] for c in schema["columns"] if c["name"] not in keys])
+        return keys
+        
+    def __len__(self):
+        return sum(schema["rows"] if selected is None else int(selected.sum()) for dirname, schema, selected in self.parts)
+        
+    def __contains__(self, name):
+        return name in self.keys()
+        
+    def __iter__(self):
+        return iter(self.keys())
+        
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        arrays = []
+        for dirname, schema, selected in self.parts:
+            data = _load_column(dirname, schema, name)
+            arrays.append(data if selected is None else data[selected])
+        if len(arrays)==1:
+            return arrays[0]
+        return np.concatenate(arrays)
+        
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+        
+def exported_streams(outdir):
+    """Return the names of all of the streams exported to outdir by export_columns()"""
+    stream_dir = os.path.join(outdir, "streams")
+    if not os.path.exists(stream_dir):
+        return []
+    return sorted(urllib.unquote(name).decode("utf-8") for name in os.listdir(stream_dir))
+    
+def open_stream(outdir, stream, path=None, sessions=None):
+    """Open one stream exported by export_columns(), without reading any of the data.
+    
+    Parameters:
+        outdir: directory the database was exported to
+        stream: name of the stream to open
+        path: If given, only include sessions whose path begins with this prefix (i.e. the path and all its children)
+        sessions: If given, a session id or list of session ids to include
+        
+    Returns:
+        columns: a StreamColumns view, mapping column names to arrays
+    """
+    stream_dir = os.path.join(outdir, "streams", _quote_name(stream))
+    if not os.path.exists(stream_dir):
+        raise KeyError("Stream %s was not exported to %s" % (stream, outdir))
+    if sessions is not None:
+        sessions = set([sessions] if isinstance(sessions, (int, long)) else sessions)
+    parts = []
+    for part in _read_stream_index(stream_dir)["parts"]:
+        # use the index to skip parts without opening them
+        if path is not None and not part["path"].startswith(path):
+            continue
+        if sessions is not None and sessions.isdisjoint(part["sessions"]):
+            continue
+        dirname = os.path.join(stream_dir, part["dir"])
+        with open(os.path.join(dirname, "schema.json")) as f:
+            schema = json.load(f)
+        selected = None
+        if sessions is not None and not sessions.issuperset(part["sessions"]):
+            selected = np.in1d(_load_column(dirname, schema, "session"), list(sessions))
+        parts.append((dirname, schema, selected))
+    return StreamColumns(parts)
+    
+def load_stream_dataframe(outdir, stream, path=None, sessions=None, columns=None):
+    """Return one exported stream as a DataFrame, in the same format as dump_flat_dataframe(). 
+    See open_stream() for the parameters; columns optionally restricts the columns which are loaded."""
+    view = open_stream(outdir, stream, path=path, sessions=sessions)
+    columns = columns or view.keys()
+    return pd.DataFrame({name:view[name] for name in columns}, columns=columns)
+    
+def load_table_dataframe(outdir, table):
+    """Return one of the sessions, meta or bindings tables exported by export_columns() as a DataFrame"""
+    dirname = os.path.join(outdir, table)
+    with open(os.path.join(dirname, "schema.json")) as f:
+        schema = json.load(f)
+    view = StreamColumns([(dirname, schema, None)])
+    return pd.DataFrame({name:view[name] for name in view.keys()}, columns=view.keys())
+
+default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "experimentlog")
+
+class ExtractionCache(object):
+    """Disk cache for dump_flat_dataframe(), dump_sessions_dataframe() and meta_dataframe().
+    
+    Each database has its own export_columns() directory in cachedir, keyed by the identity of the database file
+    (its path, device, inode and first run). The cache records watermarks for the database: the largest log, 
+    session, meta and binding ids, and the state of the sessions. If none of them have changed, results are 
+    loaded straight from the cache; if they have advanced, only the new log entries are decoded and appended.
+    If the log has been renumbered (by ExperimentLog.finalize()), the cache for the database is rebuilt.
+    
+    When the cache grows beyond max_bytes, the least recently used databases are evicted.
+    
+        cache = ExtractionCache()
+        dfs = cache.dump_flat_dataframe(cursor)
+    
+    In-memory databases are not cached.
+    """
+    # layout of the cached exports; caches written with another version are rebuilt
+    version = 2
+    
+    def __init__(self, cachedir=None, max_bytes=4<<30, format=None):
+        self.cachedir = cachedir or default_cache_dir
+        self.max_bytes = max_bytes
+        self.format = format
+        
+    def _key(self, cursor):
+        """Return the cache directory name for the database of cursor, or None if it cannot be cached"""
+        fname = None
+        for _, name, fname in cursor.execute("PRAGMA database_list").fetchall():
+            if name=="main":
+                break
+        if not fname or not os.path.exists(fname):
+            return None
+        st = os.stat(fname)
+        first_run = cursor.execute("SELECT start_time FROM runs WHERE id=(SELECT min(id) FROM runs)").fetchone()
+        identity = "%s:%d:%d:%r" % (os.path.realpath(fname), st.st_dev, st.st_ino, first_run and first_run[0])
+        return hashlib.sha1(identity).hexdigest()
+        
+    def _watermarks(self, cursor):
+        log_id = cursor.execute("SELECT max(id) FROM log").fetchone()[0] or 0
+        # sessions are updated in place when they are left, so their state is part of the watermark
+        sessions = cursor.execute("SELECT max(id), max(end_time), total(valid), total(complete) FROM session").fetchone()
+        # meta data is updated in place by create(..., force_update=True), and bindings by unbind(); both 
+        # tables are small, so their whole contents are fingerprinted
+        meta = hashlib.sha1(json.dumps(cursor.execute("SELECT * FROM meta ORDER BY id").fetchall())).hexdigest()
+        bindings = hashlib.sha1(json.dumps(cursor.execute("SELECT * FROM meta_session ORDER BY id").fetchall())).hexdigest()
+        return dict(log=log_id, sessions=list(sessions), meta=meta, bindings=bindings)
+        
+    def _manifests(self):
+        """Return a list of (dirname, manifest) for every database in the cache"""
+        manifests = []
+        if not os.path.exists(self.cachedir):
+            return manifests
+        for name in os.listdir(self.cachedir):
+            fname = os.path.join(self.cachedir, name, "cache.json")
+            if os.path.exists(fname):
+                with open(fname) as f:
+                    manifests.append((os.path.join(self.cachedir, name), json.load(f)))
+        return manifests
+        
+    def _write_manifest(self, dirname, manifest):
+        with open(os.path.join(dirname, "cache.json.tmp"), "w") as f:
+            json.dump(manifest, f)
+        os.rename(os.path.join(dirname, "cache.json.tmp"), os.path.join(dirname, "cache.json"))
+        
+    def _evict(self, keep):
+        """Remove the least recently used databases (other than keep) until the cache fits in max_bytes"""
+        manifests = sorted(self._manifests(), key=lambda m: m[1]["last_used"])
+        total = sum(manifest["bytes"] for _, manifest in manifests)
+        for dirname, manifest in manifests:
+            if total <= self.max_bytes:
+                break
+            if dirname!=keep:
+                logging.debug("Evicting %s (%d bytes) from the extraction cache" % (manifest["database"], manifest["bytes"]))
+                shutil.rmtree(dirname)
+                total -= manifest["bytes"]
+        
+    def update(self, cursor):
+        """Bring the cache for the database of cursor up to date, and return its export_columns() directory
+        (or None if the database cannot be cached)"""
+        key = self._key(cursor)
+        if key is None:
+            return None
+        dirname = os.path.join(self.cachedir, key)
+        watermarks = self._watermarks(cursor)
+        manifest = None
+        if os.path.exists(os.path.join(dirname, "cache.json")):
+            with open(os.path.join(dirname, "cache.json")) as f:
+                manifest = json.load(f)
+            old = manifest["watermarks"]
+            if manifest.get("version")!=self.version:
+                manifest = None
+            elif old["log"] > watermarks["log"]:
+                # the log has lost entries (e.g. the database was replaced), so cached entries cannot be matched up
+                logging.debug("Log rolled back; rebuilding the extraction cache %s" % dirname)
+                manifest = None
+        if manifest is None and os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        if manifest is None or manifest["watermarks"]!=watermarks:
+            # the ids put the entries back in log order, across the path partitions
+            export_columns(cursor, dirname, incremental=manifest is not None, format=self.format, log_ids=True)
+            size = sum(os.path.getsize(os.path.join(path, f)) for path, _, files in os.walk(dirname) for f in files)
+            manifest = dict(database=cursor.execute("PRAGMA database_list").fetchone()[2], watermarks=watermarks, bytes=size, version=self.version)
+        manifest["last_used"] = time.time()
+        self._write_manifest(dirname, manifest)
+        self._evict(keep=dirname)
+        return dirname
+        
+    def dump_sessions_dataframe(self, cursor):
+        """Cached dump_sessions_dataframe()"""
+        dirname = self.update(cursor)
+        if dirname is None:
+            return dump_sessions_dataframe(cursor)
+        return load_table_dataframe(dirname, "sessions").set_index("id")
+        
+    def dump_flat_dataframe(self, cursor):
+        """Cached dump_flat_dataframe()"""
+        dirname = self.update(cursor)
+        if dirname is None:
+            return dump_flat_dataframe(cursor)
+        # session validity can change after entries have been cached, so it is taken from the current sessions
+        sessions = load_table_dataframe(dirname, "sessions")
+        valid = pd.Series(sessions["valid"].values, index=sessions["id"].values)
+        dfs = {}
+        for stream in exported_streams(dirname):
+            df = load_stream_dataframe(dirname, stream)
+            df = df.iloc[np.argsort(df["id"].values, kind="mergesort")].drop("id", axis=1).reset_index(drop=True)
+            df["session_valid"] = valid.reindex(df["session"].values).values
+            dfs[stream] = df
+        return dfs
+        
+    def meta_dataframe(self, cursor):
+        """Cached meta_dataframe()"""
+        dirname = self.update(cursor)
+        if dirname is None:
+            return meta_dataframe(cursor)
+        bound = defaultdict(list)
+        if os.path.exists(os.path.join(dirname, "bindings")):
+            bindings = load_table_dataframe(dirname, "bindings")
+            for session, mtype, name in zip(*[bindings[c].values if c in bindings else [] for c in ["session", "mtype", "name"]]):
+                bound[(mtype, name)].append(int(session))
+        metas = defaultdict(list)
+        entries = load_table_dataframe(dirname, "meta")
+        for row in entries.to_dict("records"):
+            metas[row["mtype"]].append({'name':row["name"], 'description':row["description"], 'type':row["type"], 
+                                        'data':row["data"], 'bound':bound[(row["mtype"], row["name"])]})
+        return {mtype:pd.DataFrame(value) for mtype, value in metas.iteritems()}
+    
 if __name__=="__main__":
-    import sqlite3
     import sys
     conn = sqlite3.connect("my.db")
     cursor = conn.cursor()
-    with open("test.json", "w") as f:
+    with open_archive("test.json.gz", "w") as f:
         dump_json(cursor, f)    
-    with open("test.json", "r") as f:
-        print json.load(f)
+    restored = sqlite3.connect(":memory:")
+    with open_archive("test.json.gz", "r") as f:
+        load_json(f, restored)
+    for name, in restored.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall():
+        print name, restored.execute("SELECT count(*) FROM %s" % name).fetchone()[0]
         
@@ -0,0 +1,12 @@
+import sys
+import sqlite3
+from experimentlog import finalize_database
+
+if __name__=="__main__":
+    if len(sys.argv)==2:
+        print("Finalizing %s" % sys.argv[1])
+        conn = sqlite3.connect(sys.argv[1])
+        finalize_database(conn)
+        conn.close()
+    else:
+        print("Usage: finalize.py <in_db>")
@@ -0,0 +1,126 @@
+import collections
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+# Append-only capture journal: a preallocated, memory mapped file of length-prefixed log records,
+# imported into the database in bulk (see ExperimentLog(..., journal=True)).
+#
+# The file starts with a header (magic, generation). Each record is
+#   length, crc32, generation (uint32 each), then the body:
+#   time, time_ns, session, stream, valid, flags, tag length, payload length, binary length, then the
+#   tag, payload and binary bytes.
+# The length is written last, so a record is only seen once it is complete; the crc catches records
+# torn by a crash. The journal is emptied by starting a new generation, so records left over from
+# earlier generations are ignored.
+
+HEADER = struct.Struct("<8sQ")
+RECORD = struct.Struct("<III")
+BODY = struct.Struct("<dqqqBBIIi")
+MAGIC = "EXPJRNL1"
+
+# flags
+HAS_TIME_NS = 1
+PACKED = 2
+
+JournalRecord = collections.namedtuple("JournalRecord", ["time", "time_ns", "session", "stream", "valid", "tag", "payload", "packed", "binary"])
+
+class JournalFull(Exception):
+    pass
+
+class Journal(object):
+    """A capture journal file. Appending is thread safe; reading and release() are meant to be called from
+    one importer at a time.
+
+    Parameters:
+        fname: journal file; it is created (preallocated to size bytes) if it does not exist
+        size: size of a new journal file, in bytes
+        generation: first generation of a new journal file
+    """
+    def __init__(self, fname, size=64<<20, generation=1):
+        self.fname = fname
+        self.lock = threading.Lock()
+        if not os.path.exists(fname):
+            with open(fname, "wb") as f:
+                f.write(HEADER.pack(MAGIC, generation))
+                f.truncate(size)
+        self.file = open(fname, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.size = len(self.map)
+        magic, self.generation = HEADER.unpack_from(self.map, 0)
+        if magic!=MAGIC:
+            raise IOError("%s is not a capture journal" % fname)
+        # records before start have been imported; records are appended at end
+        self.start = HEADER.size
+        self.end = self.scan(self.start)[1]
+
+    def append(self, time, time_ns, session, stream, valid, tag, payload, packed, binary):
+        """Append a record. Raises JournalFull if there is not enough space left for it."""
+        if isinstance(tag, unicode):
+            tag = tag.encode("utf8")
+        if isinstance(payload, unicode):
+            payload = payload.encode("utf8")
+        flags = (HAS_TIME_NS if time_ns is not None else 0) | (PACKED if packed else 0)
+        body = BODY.pack(time, time_ns or 0, session, stream, valid, flags, len(tag), len(payload), -1 if binary is None else len(binary)) + tag + payload + (binary or "")
+        with self.lock:
+            offset = self.end
+            if offset + RECORD.size + len(body) > self.size:
+                raise JournalFull("%s is full" % self.fname)
+            generation = self.generation & 0xffffffff
+            crc = zlib.crc32(struct.pack("<I", generation) + body) & 0xffffffff
+            self.map[offset + RECORD.size:offset + RECORD.size + len(body)] = body
+            struct.pack_into("<II", self.map, offset + 4, crc, generation)
+            # the length marks the record as complete
+            struct.pack_into("<I", self.map, offset, len(body))
+            self.end = offset + RECORD.size + len(body)
+
+    def fits(self, n):
+        """True if a record with n bytes of tag, payload and binary fits in an empty journal"""
+        return HEADER.size + RECORD.size + BODY.size + n <= self.size
+
+    def scan(self, start, end=None):
+        """Return the complete records of the current generation from offset start (up to end), and
+        the offset after the last of them"""
+        records = []
+        offset = start
+        end = self.size if end is None else end
+        generation = self.generation & 0xffffffff
+        while offset + RECORD.size <= end:
+            length, crc, record_generation = RECORD.unpack_from(self.map, offset)
+            if length==0 or record_generation!=generation or offset + RECORD.size + length > end:
+                break
+            body = self.map[offset + RECORD.size:offset + RECORD.size + length]
+            if zlib.crc32(struct.pack("<I", generation) + body) & 0xffffffff != crc:
+                break
+            time, time_ns, session, stream, valid, flags, n_tag, n_payload, n_binary = BODY.unpack_from(body)
+            pos = BODY.size
+            tag = body[pos:pos+n_tag].decode("utf8")
+            payload = body[pos+n_tag:pos+n_tag+n_payload]
+            binary = None if n_binary < 0 else body[pos+n_tag+n_payload:pos+n_tag+n_payload+n_binary]
+            records.append(JournalRecord(time, time_ns if flags & HAS_TIME_NS else None, session, stream, bool(valid), tag,
+                                         payload, bool(flags & PACKED), binary))
+            offset += RECORD.size + length
+        return records, offset
+
+    def read(self):
+        """Return the records which have not been imported yet, and the offset to release() once they are"""
+        with self.lock:
+            end = self.end
+        return self.scan(self.start, end)
+
+    def release(self, offset):
+        """Mark the records before offset as imported. Once everything is imported, the journal starts
+        a new generation, and is filled again from the beginning."""
+        with self.lock:
+            self.start = offset
+            if self.start==self.end:
+                self.generation += 1
+                HEADER.pack_into(self.map, 0, MAGIC, self.generation)
+                self.start = self.end = HEADER.size
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+import payload
+from experimentlog import ExperimentException, backup_database
+
+# Merges ExperimentLog databases (e.g. from several rigs) into one, entirely in SQL: each source is ATTACHed,
+# and its tables are copied with INSERT ... SELECT, renumbering ids after those already in the target.
+# Meta data entries of the shared types are matched up by name, so a stream logged on every rig is one stream
+# in the merged database; identical binaries are matched up by their hash.
+
+# meta data types which are merged by name; entries of any other type are copied
+shared_mtypes = ["STREAM", "USER", "PATH"]
+
+def _columns(conn, schema, table):
+    return [info[1] for info in conn.execute("PRAGMA %s.table_info(%s)" % (schema, table)).fetchall()]
+
+def _has_table(conn, schema, table):
+    return conn.execute("SELECT count(*) FROM %s.sqlite_master WHERE type='table' AND name=?" % schema, (table,)).fetchone()[0] > 0
+
+def _max_id(conn, table):
+    return conn.execute("SELECT max(id) FROM main.%s" % table).fetchone()[0] or 0
+
+def _copy(conn, table, exprs={}, where=""):
+    """Copy the rows of src.table (aliased s) into main.table. exprs maps column names to the expressions
+    giving their new values, or to None to leave them to the target; other columns are copied as they are.
+    Only the columns both tables have are copied. Returns the number of rows copied."""
+    if not _has_table(conn, "src", table):
+        return 0
+    target = _columns(conn, "main", table)
+    columns = [c for c in _columns(conn, "src", table) if c in target and exprs.get(c, "")!=None]
+    select = [exprs.get(c, "s.%s" % c) for c in columns]
+    return conn.execute("INSERT INTO main.%s(%s) SELECT %s FROM src.%s s %s" % (table, ",".join(columns), ",".join(select), table, where)).rowcount
+
+def _merge_codecs(conn):
+    """Copy the key dictionaries of packed streams. A stream packed in both databases must have compatible
+    keys (one list of keys extending the other), as its payloads refer to the keys by index.
+
+    A stream packed in the source which the target stores as JSON (it has entries in the target, but no
+    codec, or it has indexed fields there) stays JSON: its packed payloads are re-encoded as JSON when the
+    log is copied. Returns the dictionary of source stream id -> keys of those streams."""
+    reencode = {}
+    if not _has_table(conn, "src", "stream_codec"):
+        return reencode
+    if not _has_table(conn, "main", "stream_codec"):
+        sql = conn.execute("SELECT sql FROM src.sqlite_master WHERE type='table' AND name='stream_codec'").fetchone()[0]
+        conn.execute(sql.replace("CREATE TABLE stream_codec", "CREATE TABLE main.stream_codec", 1))
+    indexed = set()
+    if _has_table(conn, "main", "indexed_fields"):
+        indexed = set(stream for stream, in conn.execute("SELECT stream FROM main.indexed_fields").fetchall())
+    codecs = conn.execute("SELECT c.stream, m.new, c.codec, c.keys, c.compress FROM src.stream_codec c JOIN temp.meta_map m ON m.old=c.stream").fetchall()
+    for old_stream, stream, codec, keys, compress in codecs:
+        row = conn.execute("SELECT keys FROM main.stream_codec WHERE stream=?", (stream,)).fetchone()
+        if row is None:
+            if stream in indexed or conn.execute("SELECT 1 FROM main.log WHERE stream=? LIMIT 1", (stream,)).fetchone():
+                reencode[old_stream] = json.loads(keys)
+            else:
+                conn.execute("INSERT INTO main.stream_codec(stream, codec, keys, compress) VALUES (?, ?, ?, ?)", (stream, codec, keys, compress))
+            continue
+        old, new = json.loads(row[0]), json.loads(keys)
+        if old[:len(new)]!=new[:len(old)]:
+            name = conn.execute("SELECT name FROM main.meta WHERE id=?", (stream,)).fetchone()[0]
+            raise ExperimentException("Stream %s is packed with different keys in the two databases; cannot merge" % name)
+        if len(new) > len(old):
+            conn.execute("UPDATE main.stream_codec SET keys=? WHERE stream=?", (keys, stream))
+    return reencode
+
+def _create_stream_views(conn):
+    """Create the views of the streams new to the target (see ExperimentLog.create())"""
+    for id, name in conn.execute("SELECT id, name FROM main.meta WHERE mtype='STREAM'").fetchall():
+        conn.execute("CREATE VIEW IF NOT EXISTS main.%s AS SELECT * FROM log WHERE stream=%d" % (name, id))
+
+def merge_into(conn, fname):
+    """Merge the database fname into the database of the connection conn, in one transaction.
+
+    Runs, sessions, log entries and binaries are renumbered to follow those already in conn; the root session
+    of fname is mapped onto the root session of conn, so the session hierarchy is kept. Meta data entries of the
+    shared_mtypes are matched by name, and bindings are remapped. The dataset metadata (DATASET) of fname is not
+    copied; instead, the merge is recorded in the "merged" list of the dataset metadata of conn.
+
+    Returns:
+        counts: dictionary of table name -> number of rows copied
+    """
+    conn.isolation_level = None
+    conn.execute("ATTACH DATABASE ? AS src", (fname,))
+    try:
+        for schema in ["main", "src"]:
+            if _has_table(conn, schema, "shards"):
+                raise ExperimentException("Cannot merge sharded databases (%s)" % (fname if schema=="src" else "the target"))
+        conn.execute("BEGIN")
+        try:
+            counts = _merge(conn, fname)
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.execute("DETACH DATABASE src")
+    return counts
+
+def _merge(conn, fname):
+    start = time.time()
+    run_offset, session_offset, meta_offset = _max_id(conn, "runs"), _max_id(conn, "session"), _max_id(conn, "meta")
+    log_offset, binary_offset = _max_id(conn, "log"), _max_id(conn, "binary")
+    root = conn.execute("SELECT min(id) FROM main.session WHERE parent IS NULL").fetchone()[0]
+    src_root = conn.execute("SELECT min(id) FROM src.session WHERE parent IS NULL").fetchone()[0]
+
+    def session(column):
+        # NULL stays NULL, as NULL+offset is NULL
+        return "CASE s.%s WHEN %d THEN %d ELSE s.%s+%d END" % (column, src_root, root, column, session_offset)
+
+    # map the source meta ids onto the target; shared entries which already exist keep their target id
+    shared = ",".join("'%s'" % mtype for mtype in shared_mtypes)
+    conn.execute("CREATE TEMP TABLE meta_map (old INTEGER PRIMARY KEY, new INT)")
+    conn.execute("""INSERT INTO temp.meta_map(old, new)
+                    SELECT s.id, coalesce((SELECT min(t.id) FROM main.meta t WHERE s.mtype IN (%s) AND t.mtype=s.mtype AND t.name=s.name), s.id+%d)
+                    FROM src.meta s WHERE s.mtype IS NOT 'DATASET'""" % (shared, meta_offset))
+    conn.execute("CREATE TEMP TABLE binary_map (old INTEGER PRIMARY KEY, new INT)")
+    if _has_table(conn, "src", "binary"):
+        conn.execute("""INSERT INTO temp.binary_map(old, new)
+                        SELECT s.id, coalesce((SELECT t.id FROM main.binary t WHERE t.hash=s.hash), s.id+%d) FROM src.binary s""" % binary_offset)
+
+    counts = {}
+    counts["meta"] = _copy(conn, "meta", dict(id="m.new", meta="(SELECT new FROM temp.meta_map WHERE old=s.meta)"),
+                           "JOIN temp.meta_map m ON m.old=s.id WHERE m.new=s.id+%d" % meta_offset)
+    reencode = _merge_codecs(conn)
+    counts["runs"] = _copy(conn, "runs", dict(id="s.id+%d" % run_offset))
+    counts["session"] = _copy(conn, "session", dict(id="s.id+%d" % session_offset, parent=session("parent")), "WHERE s.id!=%d" % src_root)
+    counts["run_session"] = _copy(conn, "run_session", dict(id=None, session=session("session"), run="s.run+%d" % run_offset))
+    counts["meta_session"] = _copy(conn, "meta_session", dict(id=None, meta="m.new", session=session("session"), unbound_session=session("unbound_session")),
+                                   "JOIN temp.meta_map m ON m.old=s.meta")
+    counts["binary"] = _copy(conn, "binary", dict(id="s.id+%d" % binary_offset), "JOIN temp.binary_map m ON m.old=s.id WHERE m.new=s.id+%d" % binary_offset)
+    log_exprs = dict(id="s.id+%d" % log_offset, session=session("session"),
+                     stream="(SELECT new FROM temp.meta_map WHERE old=s.stream)",
+                     binary="(SELECT new FROM temp.binary_map WHERE old=s.binary)")
+    if reencode:
+        conn.create_function("merge_json", 2, lambda value, stream: json.dumps(payload.decode(value, reencode[stream])))
+        log_exprs["json"] = "CASE WHEN typeof(s.json)='blob' AND s.stream IN (%s) THEN merge_json(s.json, s.stream) ELSE s.json END" % ",".join(str(stream) for stream in reencode)
+    counts["log"] = _copy(conn, "log", log_exprs, "ORDER BY s.id")
+    counts["sync_ext"] = _copy(conn, "sync_ext", dict(id=None))
+    _create_stream_views(conn)
+    conn.execute("DROP TABLE temp.meta_map")
+    conn.execute("DROP TABLE temp.binary_map")
+
+    # record the merge in the dataset metadata
+    row = conn.execute("SELECT json FROM main.meta WHERE id=(SELECT max(id) FROM main.meta WHERE mtype='DATASET')").fetchone()
+    dataset = json.loads(row[0]) if row is not None and row[0] else {}
+    dataset.setdefault("merged", []).append(dict(fname=os.path.abspath(fname), time=time.time(), counts=counts))
+    conn.execute("INSERT INTO main.meta(json, mtype) VALUES (?, 'DATASET')", (json.dumps(dataset),))
+    logging.debug("Merged %s (%d log entries) in %.1f seconds" % (fname, counts["log"], time.time()-start))
+    return counts
+
+def merge(target, sources):
+    """Merge the databases sources into the database target. If target does not exist, it starts as a copy
+    of the first source. See merge_into()."""
+    sources = list(sources)
+    if not os.path.exists(target):
+        first = sources.pop(0)
+        source_conn = sqlite3.connect(first)
+        if _has_table(source_conn, "main", "shards"):
+            raise ExperimentException("Cannot merge sharded databases (%s)" % first)
+        backup_database(source_conn, target)
+        source_conn.close()
+    conn = sqlite3.connect(target)
+    for fname in sources:
+        merge_into(conn, fname)
+    conn.close()
+
+if __name__=="__main__":
+    if len(sys.argv) >= 3:
+        print("Merging %s into %s" % (", ".join(sys.argv[2:]), sys.argv[1]))
+        merge(sys.argv[1], sys.argv[2:])
+    else:
+        print "Usage: merge.py <out_db> <in_db> [<in_db> ...]"
@@ -0,0 +1,138 @@
+import json
+import re
+import struct
+import zlib
+
+# Compact binary encoding for dictionary log payloads. The keys of each stream are stored once,
+# in the stream_codec table, and each payload refers to them by index.
+#
+# A payload is a flags byte followed by one entry per key: a varint of (key index << 3 | type tag),
+# then the value. Integers are zigzag varints, floats are 64-bit doubles, and text (and anything else,
+# as JSON) is a varint length followed by UTF-8 bytes.
+
+NONE, TRUE, FALSE, INT, FLOAT, TEXT, JSON = range(7)
+
+# flags
+COMPRESSED = 1
+
+def _varint(n):
+    out = []
+    while n > 0x7f:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return "".join(out)
+
+def _read_varint(s, pos):
+    n = shift = 0
+    while True:
+        b = ord(s[pos])
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+def _text(s):
+    if isinstance(s, unicode):
+        s = s.encode("utf8")
+    return _varint(len(s)) + s
+
+def encode(data, keys, key_index, compress=False):
+    """Encode a dictionary payload.
+
+    Parameters:
+        data: dictionary to encode
+        keys: list of the keys of the stream; any new keys are appended
+        key_index: dictionary mapping each key in keys to its index; updated with keys
+        compress: If True, the payload is zlib compressed (if that makes it smaller)
+
+    Returns:
+        the encoded payload, as a string
+    """
+    parts = [""]
+    for key, value in data.iteritems():
+        if key not in key_index:
+            key_index[key] = len(keys)
+            keys.append(key)
+        index = key_index[key] << 3
+        if value is None:
+            parts.append(_varint(index | NONE))
+        elif value is True:
+            parts.append(_varint(index | TRUE))
+        elif value is False:
+            parts.append(_varint(index | FALSE))
+        elif isinstance(value, (int, long)) and -(1<<63) <= value < (1<<63):
+            parts.append(_varint(index | INT) + _varint((value << 1) ^ (value >> 63)))
+        elif isinstance(value, float):
+            parts.append(_varint(index | FLOAT) + struct.pack("<d", value))
+        elif isinstance(value, basestring):
+            parts.append(_varint(index | TEXT) + _text(value))
+        else:
+            parts.append(_varint(index | JSON) + _text(json.dumps(value)))
+    body = "".join(parts)
+    flags = 0
+    if compress:
+        compressed = zlib.compress(body)
+        if len(compressed) < len(body):
+            body, flags = compressed, COMPRESSED
+    return chr(flags) + body
+
+def decode(payload, keys):
+    """Decode a payload produced by encode(), given the list of keys of its stream"""
+    payload = str(payload)
+    body = payload[1:]
+    if ord(payload[0]) & COMPRESSED:
+        body = zlib.decompress(body)
+    data = {}
+    pos, n = 0, len(body)
+    while pos < n:
+        code, pos = _read_varint(body, pos)
+        key, tag = keys[code >> 3], code & 7
+        if tag==NONE:
+            value = None
+        elif tag==TRUE:
+            value = True
+        elif tag==FALSE:
+            value = False
+        elif tag==INT:
+            zigzag, pos = _read_varint(body, pos)
+            value = (zigzag >> 1) ^ -(zigzag & 1)
+        elif tag==FLOAT:
+            value = struct.unpack_from("<d", body, pos)[0]
+            pos += 8
+        else:
+            length, pos = _read_varint(body, pos)
+            value = body[pos:pos+length].decode("utf8")
+            pos += length
+            if tag==JSON:
+                value = json.loads(value)
+        data[key] = value
+    return data
+
+def has_codecs(cursor):
+    return cursor.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='stream_codec'").fetchone()[0] > 0
+
+class PayloadDecoder(object):
+    """Decodes log.json values, whether they are JSON text or encoded with the key dictionary of their stream"""
+    def __init__(self, cursor):
+        self.keys = {}
+        if has_codecs(cursor):
+            for stream, keys in cursor.execute("SELECT stream, keys FROM stream_codec").fetchall():
+                self.keys[stream] = json.loads(keys)
+
+    def loads(self, value, stream):
+        """Decode the log.json value of an entry in the stream with id stream"""
+        if isinstance(value, basestring):
+            return json.loads(value)
+        return decode(value, self.keys[stream])
+
+# payload fields which can be indexed and queried in SQLite (JSON payloads only): names, or dotted paths
+# into nested dictionaries
+_field_pattern = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+
+def field_expression(field, column="json"):
+    """Return the SQL expression giving the value of a payload field, e.g. json_extract(json, '$.score')"""
+    if not _field_pattern.match(field):
+        raise ValueError("Cannot index or query the payload field %r" % field)
+    return "json_extract(%s, '$.%s')" % (column, field)
@@ -0,0 +1,5 @@
+import collections
+
+# A log entry, as passed to ExperimentLog.subscribe() callbacks, published by zmq_log and yielded by
+# extract.replay(). Kept in its own module so that it can be imported without experimentlog's logging setup.
+LogRecord = collections.namedtuple('LogRecord', ['id', 'session', 'path', 'stream', 'time', 'valid', 'tag', 'data', 'binary'])
@@ -1,6 +1,9 @@
 import sqlite3
 import json
+import time
+import sys
 import cStringIO
+from collections import defaultdict
 
 
 def pretty_json(x):
@@ -8,15 +11,68 @@ def pretty_json(x):
     
 
 
-def string_report(cursor):
+def _has_table(cursor, name):
+    return cursor.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone()[0] > 0
+
+def update_stats(cursor, refresh=False, store=False):
+    """Return the log statistics, as a dictionary mapping (stream, session) -> (count, start_time, end_time).
+    
+    The statistics are cached in the log_stats table, and hold the per-stream, per-session
+    counts and time ranges of the log. Only log entries added since the cache was last updated 
+    are aggregated (in a single grouped pass); if refresh is True, the cache is ignored, and the 
+    statistics are computed from scratch.
+    
+    The database is only read, unless store is True: then the cache is brought up to date (or rebuilt, 
+    if refresh is True) and committed.
+    """
+    if store:
+        cursor.execute("CREATE TABLE IF NOT EXISTS log_stats (stream INT, session INT, count INT, start_time REAL, end_time REAL, PRIMARY KEY(stream, session))")
+        cursor.execute("CREATE TABLE IF NOT EXISTS log_stats_info (id INTEGER PRIMARY KEY, log_id INT, time REAL)")
+        if refresh:
+            cursor.execute("DELETE FROM log_stats")
+            cursor.execute("DELETE FROM log_stats_info")
+    stats = {}
+    watermark = 0
+    if store or (not refresh and _has_table(cursor, "log_stats") and _has_table(cursor, "log_stats_info")):
+        for stream, session, count, start_time, end_time in cursor.execute("SELECT stream, session, count, start_time, end_time FROM log_stats").fetchall():
+            stats[(stream, session)] = (count, start_time, end_time)
+        watermark = cursor.execute("SELECT max(log_id) FROM log_stats_info").fetchone()[0] or 0
+        
+    last_id = cursor.execute("SELECT max(id) FROM log").fetchone()[0] or 0
+    if last_id > watermark:
+        new_rows = cursor.execute("SELECT stream, session, count(id), min(time), max(time) FROM log WHERE id>? AND id<=? GROUP BY stream, session", (watermark, last_id)).fetchall()
+        for stream, session, count, start_time, end_time in new_rows:
+            if (stream, session) in stats:
+                old_count, old_start, old_end = stats[(stream, session)]
+                count, start_time, end_time = count+old_count, min(start_time, old_start), max(end_time, old_end)
+            stats[(stream, session)] = (count, start_time, end_time)
+            if store:
+                cursor.execute("INSERT OR REPLACE INTO log_stats(stream, session, count, start_time, end_time) VALUES (?,?,?,?,?)", (stream, session, count, start_time, end_time))
+        if store:
+            cursor.execute("INSERT INTO log_stats_info(log_id, time) VALUES (?,?)", (last_id, time.time()))
+    if store:
+        cursor.connection.commit()
+    return stats
+    
+def stream_stats(stats):
+    """Reduce the statistics from update_stats() to stream -> (count, start_time, end_time)"""
+    streams = {}
+    for (stream, session), (count, start_time, end_time) in stats.iteritems():
+        if stream in streams:
+            old_count, old_start, old_end = streams[stream]
+            count, start_time, end_time = count+old_count, min(start_time, old_start), max(end_time, old_end)
+        streams[stream] = (count, start_time, end_time)
+    return streams
+    
+def string_report(cursor, refresh=False, store_stats=False):
     c = cStringIO.StringIO()
-    make_report(cursor, c)
+    make_report(cursor, c, refresh=refresh, store_stats=store_stats)
     return c.getvalue()
 
 
-def string_readme(cursor):
+def string_readme(cursor, refresh=False, store_stats=False):
     c = cStringIO.StringIO()
-    make_readme(cursor, c)
+    make_readme(cursor, c, refresh=refresh, store_stats=store_stats)
     return c.getvalue()    
 
 def date_format(t):
@@ -25,7 +81,7 @@ def date_format(t):
     
     
     
-def make_readme(cursor, f, fname="none"):
+def make_readme(cursor, f, fname="none", refresh=False, store_stats=False):
            
     def sqlresult(query):
         result = cursor.execute(query).fetchone()
@@ -78,10 +134,11 @@ def make_readme(cursor, f, fname="none"):
     f.write("* Total duration recorded: %.1f seconds\n" % sqlresult("SELECT sum(end_time-start_time) FROM runs"))
     f.write("* Number of users: %s\n" % sqlresult("SELECT count(id) FROM users"))
    
-    f.write("* Total logged entries: %d\n" % sqlresult("SELECT count(id) FROM log"))        
+    stats = update_stats(cursor, refresh=refresh, store=store_stats)
+    f.write("* Total logged entries: %d\n" % sum(count for count, start_time, end_time in stats.itervalues()))        
     f.write("\n----------------------------------------\n")
                             
-def make_report(cursor, f, fname="none"):
+def make_report(cursor, f, fname="none", refresh=False, store_stats=False):
            
     def sqlresult(query):
         result = cursor.execute(query).fetchone()
@@ -98,6 +155,8 @@ def make_report(cursor, f, fname="none"):
             return [row[0] for row in result.fetchall()]
     
     
+    stats = update_stats(cursor, refresh=refresh, store=store_stats)
+    
     f.write("# Report generated for %s\n" % fname)
     f.write("\n----------------------------------------\n")
     f.write("#### Report date: %s\n" % time.asctime())
@@ -117,20 +176,44 @@ def make_report(cursor, f, fname="none"):
     f.write("\n## Users\n")
     f.write("* Unique users: %s\n" % sqlresult("SELECT count(id) FROM users"))
     
+    # aggregate the durations and log entries of every user at once
+    durations = dict(cursor.execute("SELECT meta_session.meta, sum(session.end_time-session.start_time) FROM session JOIN meta_session ON meta_session.session=session.id GROUP BY meta_session.meta").fetchall())
+    session_counts = defaultdict(int)
+    for (stream, session), (count, start_time, end_time) in stats.iteritems():
+        session_counts[session] += count
+    entries = defaultdict(int)
+    for meta, session in cursor.execute("SELECT meta, session FROM meta_session").fetchall():
+        entries[meta] += session_counts.get(session, 0)
+        
     for id, name, jsons in cursor.execute("SELECT id,name,json FROM users").fetchall():
         f.write("\n\n#### %s\n" % name)
         f.write("**JSON** \n %s\n" % pretty_json(json.loads(jsons))) 
-        f.write("Duration recorded: %s seconds\n" % sqlresult("SELECT sum(session.end_time-session.start_time) FROM session JOIN meta_session ON meta_session.session=session.id JOIN users ON meta_session.meta=users.id WHERE users.id=%d"%id))
+        f.write("Duration recorded: %s seconds\n" % durations.get(id))
+        f.write("Entries logged: %d\n" % entries[id])
         
     f.write("\n----------------------------------------\n")
     f.write("\n## Log\n")
     f.write("* Log streams recorded: %s\n" % ",".join(allsqlresult("SELECT name FROM stream")))
+    streams = stream_stats(stats)
     session_types = cursor.execute("SELECT id, name, description, json FROM stream").fetchall()
     for id, name, description, jsons in session_types:
         f.write("\n#### %s\n" % name)
         f.write("##### %s\n" % description)                   
         f.write("**JSON** \n %s\n" % pretty_json(json.loads(jsons)))                   
-        f.write("* Total entries: %d\n" % sqlresult("SELECT count(id) FROM log WHERE stream=%d"%id))        
+        count, start_time, end_time = streams.get(id, (0, None, None))
+        f.write("* Total entries: %d\n" % count)        
+        if count>0:
+            f.write("* Recorded from %s to %s\n" % (time.ctime(start_time), time.ctime(end_time)))
     f.write("\n----------------------------------------\n")
-        
 
+if __name__=="__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args)==1:
+        conn = sqlite3.connect(args[0])
+        if "--readme" in sys.argv:
+            make_readme(conn.cursor(), sys.stdout, fname=args[0], refresh="--refresh" in sys.argv, store_stats="--store" in sys.argv)
+        else:
+            make_report(conn.cursor(), sys.stdout, fname=args[0], refresh="--refresh" in sys.argv, store_stats="--store" in sys.argv)
+        conn.close()
+    else:
+        print("Usage: report.py <in_db> [--readme] [--refresh] [--store]")
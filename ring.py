@@ -0,0 +1,141 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+import uuid
+
+# Single-producer, single-consumer ring buffer in shared memory, used by zmq_log to pass log entries
+# from processes on the same host to the server without a round trip.
+#
+# The buffer is a memory mapped file (in /dev/shm where there is one). The header holds the capacity,
+# and the head (total bytes written) and tail (total bytes read) positions, each on its own cache line.
+# Only the producer writes head, and only the consumer writes tail, so no lock is needed: a record is
+# written before head is advanced past it. Records are a length followed by the data, padded to 8 bytes;
+# a WRAP length marks that the rest of the buffer is unused and the next record is at the start.
+
+HEADER = struct.Struct("<8sQ")
+MAGIC = "EXPRING1"
+HEAD = 64
+TAIL = 128
+DATA = 192
+LENGTH = struct.Struct("<I")
+WRAP = 0xffffffff
+
+def _padded(n):
+    return (n + 7) & ~7
+
+def shared_memory_dir():
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+class RingBuffer(object):
+    """A shared memory ring buffer.
+
+    Parameters:
+        fname: the buffer file. If None, a new buffer of size bytes is created (see fname to open it from
+               the other process); otherwise, the existing buffer is opened
+        size: capacity of a new buffer, in bytes
+    """
+    def __init__(self, fname=None, size=4<<20):
+        if fname is None:
+            fname = os.path.join(shared_memory_dir(), "explog-ring-%d-%s" % (os.getpid(), uuid.uuid4().hex[:8]))
+            size = _padded(size)
+            with open(fname, "wb") as f:
+                f.write(HEADER.pack(MAGIC, size))
+                f.truncate(DATA + size)
+        self.fname = fname
+        self.file = open(fname, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, self.capacity = HEADER.unpack_from(self.map, 0)
+        if magic!=MAGIC:
+            raise IOError("%s is not a ring buffer" % fname)
+        # each side keeps its own position; the other side's is read from the header
+        self.head = self._get(HEAD)
+        self.tail = self._get(TAIL)
+
+    def _get(self, offset):
+        return struct.unpack_from("<Q", self.map, offset)[0]
+
+    def write(self, data, timeout=10.0):
+        """Write a record (producer only). If the buffer is full, waits up to timeout seconds for the
+        consumer to make space, and then raises IOError."""
+        need = _padded(LENGTH.size + len(data))
+        if need > self.capacity:
+            raise ValueError("Record of %d bytes is too large for the ring buffer" % len(data))
+        offset = self.head % self.capacity
+        skip = self.capacity - offset if offset + need > self.capacity else 0
+        deadline = None
+        while self.head + skip + need - self._get(TAIL) > self.capacity:
+            if deadline is None:
+                deadline = time.time() + timeout
+            elif time.time() > deadline:
+                raise IOError("Ring buffer %s is full; is the server reading it?" % self.fname)
+            time.sleep(0.0001)
+        if skip:
+            LENGTH.pack_into(self.map, DATA + offset, WRAP)
+            offset = 0
+        LENGTH.pack_into(self.map, DATA + offset, len(data))
+        self.map[DATA + offset + LENGTH.size:DATA + offset + LENGTH.size + len(data)] = data
+        # publish the record
+        self.head += skip + need
+        struct.pack_into("<Q", self.map, HEAD, self.head)
+
+    def read(self):
+        """Return all of the records written since the last read (consumer only)"""
+        head = self._get(HEAD)
+        records = []
+        while self.tail < head:
+            offset = self.tail % self.capacity
+            length = LENGTH.unpack_from(self.map, DATA + offset)[0]
+            if length==WRAP:
+                self.tail += self.capacity - offset
+                continue
+            records.append(self.map[DATA + offset + LENGTH.size:DATA + offset + LENGTH.size + length])
+            self.tail += _padded(LENGTH.size + length)
+        struct.pack_into("<Q", self.map, TAIL, self.tail)
+        return records
+
+    def close(self, remove=False):
+        self.map.close()
+        self.file.close()
+        if remove:
+            os.remove(self.fname)
+
+# log entries, as written to the ring buffer
+ENTRY = struct.Struct("<dqBBHHII")
+HAS_T = 1
+HAS_TIME_NS = 2
+HAS_BINARY = 4
+HAS_TRACE = 8
+TRACE = struct.Struct("<d")
+
+def _utf8(s):
+    """Byte strings are taken to be UTF-8 already"""
+    return s.encode("utf8") if isinstance(s, unicode) else s
+    
+def pack_entry(stream, t, t_ns, valid, data, tag, binary, trace=None):
+    """Encode the arguments of an ExperimentLog.log() call. trace is the time the entry was sent, if it is traced."""
+    stream, tag = _utf8(stream), _utf8(tag or "")
+    js = json.dumps(data)
+    flags = (HAS_T if t is not None else 0) | (HAS_TIME_NS if t_ns is not None else 0) | (HAS_BINARY if binary is not None else 0)
+    flags |= HAS_TRACE if trace is not None else 0
+    record = ENTRY.pack(t or 0.0, t_ns or 0, valid, flags, len(stream), len(tag), len(js), len(binary or "")) + stream + tag + js + (binary or "")
+    return record + TRACE.pack(trace) if trace is not None else record
+
+def unpack_entry(record):
+    """Decode an entry written by pack_entry(), as a dictionary of log() arguments (and trace, if it is traced)"""
+    t, t_ns, valid, flags, n_stream, n_tag, n_js, n_binary = ENTRY.unpack_from(record)
+    pos = ENTRY.size
+    stream = record[pos:pos+n_stream].decode("utf8")
+    pos += n_stream
+    tag = record[pos:pos+n_tag].decode("utf8")
+    pos += n_tag
+    data = json.loads(record[pos:pos+n_js])
+    pos += n_js
+    binary = record[pos:pos+n_binary] if flags & HAS_BINARY else None
+    entry = dict(stream=stream, t=t if flags & HAS_T else None, t_ns=t_ns if flags & HAS_TIME_NS else None,
+                 valid=bool(valid), data=data, tag=tag, binary=binary)
+    if flags & HAS_TRACE:
+        entry["trace"] = TRACE.unpack_from(record, pos + n_binary)[0]
+    return entry
@@ -0,0 +1,238 @@
+import csv
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from experimentlog import ExperimentLog, ExperimentException
+import extract
+import merge
+
+# regression tests; run with python -m unittest tests
+
+class TempDirTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+        
+    def fname(self, name):
+        return os.path.join(self.dirname, name)
+        
+        
+class CodecTest(TempDirTest):
+    def test_unset_codec_stays_unset(self):
+        e = ExperimentLog(self.fname("codec.db"), ntp_sync=False)
+        e.create("STREAM", name="s1")
+        e.create("STREAM", name="s2")
+        e.set_codec("s1", "packed")
+        e.set_codec("s1", None)
+        e.set_codec("s2", "packed")
+        self.assertNotIn("s1", e.codecs)
+        e.log("s1", data={"x":1})
+        e.close()
+        e = ExperimentLog(self.fname("codec.db"), ntp_sync=False)
+        self.assertEqual(sorted(e.codecs), ["s2"])
+        e.log("s1", data={"x":2})
+        e.close()
+        conn = sqlite3.connect(self.fname("codec.db"))
+        payloads = conn.execute("SELECT log.json FROM log JOIN meta ON meta.id=log.stream WHERE meta.name='s1'").fetchall()
+        self.assertEqual([json.loads(js) for js, in payloads], [{"x":1}, {"x":2}])
+        
+    def test_journal_codec_unset_before_import(self):
+        e = ExperimentLog(self.fname("journal.db"), ntp_sync=False, journal=True)
+        records = []
+        e.subscribe(records.extend)
+        e.create("STREAM", name="s")
+        e.set_codec("s", "packed")
+        e.log("s", data={"x":1})
+        e.set_codec("s", None)
+        e.import_journal()
+        self.assertEqual([r.data for r in records], [{"x":1}])
+        e.close()
+        
+        
+class AlignMediaTest(TempDirTest):
+    def setUp(self):
+        TempDirTest.setUp(self)
+        e = ExperimentLog(self.fname("media.db"), ntp_sync=False)
+        e.create("STREAM", name="empty")
+        e.enter("Trial")
+        for i in range(100):
+            e.log("s2", t=1000.0 + i*0.1, data={"i":i})
+        # 5s into the file was played at t=1002
+        e.sync_ext("m.mp4", start_time=1002.0, media_start_time=5.0, data={"frame_rate":10})
+        e.close()
+        self.cursor = sqlite3.connect(self.fname("media.db")).cursor()
+        
+    def test_frame_times(self):
+        df = extract.align_media(self.cursor, "m.mp4", ["s2"], frames=[30, 50, 70])
+        self.assertEqual(df["media_time"].tolist(), [3.0, 5.0, 7.0])
+        self.assertTrue(np.allclose(df["t"], [1000.0, 1002.0, 1004.0]))
+        self.assertEqual(df["s2.i"].tolist(), [0, 20, 40])
+        
+    def test_empty_stream(self):
+        df = extract.align_media(self.cursor, "m.mp4", ["empty"], frames=[30, 50])
+        self.assertTrue(df["empty.t"].isnull().all())
+        
+    def test_nothing_within_tolerance(self):
+        df = extract.align_media(self.cursor, "m.mp4", ["s2"], frames=[0], tolerance=1e-9)
+        self.assertEqual(len(df), 1)
+        self.assertTrue(df["s2.t"].isnull().all())
+        
+    def test_dense_stream_split(self):
+        e = ExperimentLog(self.fname("dense.db"), ntp_sync=False)
+        e.enter("Trial")
+        for i in range(300):
+            e.log("dense", t=1000.0 + i*0.01, data={"i":i})
+            if i % 100 == 50:
+                e.log("sparse", t=1000.0 + i*0.01 + 0.004, data={"j":i})
+        e.close()
+        cursor = sqlite3.connect(self.fname("dense.db")).cursor()
+        for method in ["nearest", "previous", "linear"]:
+            whole = extract.align(cursor, ["sparse", "dense"], reference_stream="sparse", method=method, chunk_size=1000)
+            split = extract.align(cursor, ["sparse", "dense"], reference_stream="sparse", method=method, chunk_size=2)
+            self.assertTrue(whole.equals(split))
+            if method=="previous":
+                self.assertEqual(split["dense.i"].tolist(), [50.0, 150.0, 250.0])
+        
+        
+class DecodeTest(TempDirTest):
+    def test_missing_session(self):
+        e = ExperimentLog(self.fname("decode.db"), ntp_sync=False)
+        for name in ["A", "B"]:
+            e.enter(name)
+            for i in range(3):
+                e.log("s", data={"x":i})
+            e.leave()
+        e.close()
+        conn = sqlite3.connect(self.fname("decode.db"))
+        conn.execute("DELETE FROM session WHERE path='/B/'")
+        columns = extract.decode_stream(conn.cursor(), "s")
+        self.assertEqual(columns["x"].tolist(), [0, 1, 2])
+        self.assertEqual(columns["path"].tolist(), ["/A/"] * 3)
+        
+        
+class ExportTest(TempDirTest):
+    def test_non_ascii_names(self):
+        e = ExperimentLog(self.fname("export.db"), ntp_sync=False)
+        e.cd("/Study")
+        e.enter("Trial")
+        e.log(u"caf\xe9", data={"x":1})
+        e.close()
+        cursor = sqlite3.connect(self.fname("export.db")).cursor()
+        extract.export_columns(cursor, self.fname("export"), format="npy")
+        self.assertEqual(extract.exported_streams(self.fname("export")), [u"caf\xe9"])
+        df = extract.load_stream_dataframe(self.fname("export"), u"caf\xe9", path=u"/Study/")
+        self.assertEqual(df["x"].tolist(), [1])
+        
+    def test_csv_non_ascii_fields(self):
+        e = ExperimentLog(self.fname("csv.db"), ntp_sync=False)
+        e.enter("Trial")
+        e.log(u"caf\xe9", data={u"cl\xe9":u"\xe9", "n":1})
+        e.log(u"caf\xe9", data={"n":2})
+        e.close()
+        extract.to_csv(sqlite3.connect(self.fname("csv.db")).cursor(), self.fname("csv"))
+        with open(os.path.join(self.fname("csv"), "Trial", "2", "caf\xc3\xa9.csv"), "rb") as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], ["t", "valid", "session_valid", "cl\xc3\xa9", "n"])
+        self.assertEqual([row[3:] for row in rows[1:]], [["\xc3\xa9", "1"], ["", "2"]])
+        
+        
+class ExtractionCacheTest(TempDirTest):
+    def test_same_as_uncached(self):
+        e = ExperimentLog(self.fname("cache.db"), ntp_sync=False)
+        for i, path in enumerate(["/a", "/b", "/a"]):
+            e.cd(path)
+            e.enter("Trial")
+            for j in range(3):
+                e.log("s", data={"i":i, "j":j})
+            e.leave(valid=i!=1)
+            e.cd("..")
+        e.commit()
+        cursor = sqlite3.connect(self.fname("cache.db")).cursor()
+        cache = extract.ExtractionCache(self.fname("cache"), format="npy")
+        for run in range(2):
+            if run:
+                # only the new entries are exported
+                e.cd("/b")
+                e.log("s", data={"i":3, "j":0})
+                e.commit()
+            cached, uncached = cache.dump_flat_dataframe(cursor), extract.dump_flat_dataframe(cursor)
+            self.assertEqual(sorted(cached), sorted(uncached))
+            for stream in uncached:
+                pd.util.testing.assert_frame_equal(cached[stream], uncached[stream], check_like=True, check_column_type=False)
+        e.close()
+        
+    def test_meta_updated_in_place(self):
+        e = ExperimentLog(self.fname("meta.db"), ntp_sync=False)
+        e.create("USER", "u", data={"age":1})
+        e.bind("USER", "u")
+        e.commit()
+        cursor = sqlite3.connect(self.fname("meta.db")).cursor()
+        cache = extract.ExtractionCache(self.fname("cache"), format="npy")
+        cache.meta_dataframe(cursor)
+        e.create("USER", "u", data={"age":2}, force_update=True)
+        e.unbind("USER", "u")
+        e.commit()
+        users = cache.meta_dataframe(cursor)["USER"]
+        self.assertEqual(users["data"].tolist(), [{"age":2}])
+        self.assertEqual(users["bound"].tolist(), [[]])
+        e.close()
+        
+        
+class RegistryTest(TempDirTest):
+    def test_str_and_unicode_names(self):
+        e = ExperimentLog(self.fname("registry.db"), ntp_sync=False)
+        e.create("STREAM", name=u"caf\xe9")
+        e.set_codec("caf\xc3\xa9", "packed")
+        e.close()
+        e = ExperimentLog(self.fname("registry.db"), ntp_sync=False)
+        # a UTF-8 str finds the stream read back from the database, rather than registering it again
+        e.log("caf\xc3\xa9", data={"x":1})
+        self.assertRaises(ExperimentException, e.create, "STREAM", name="caf\xc3\xa9")
+        self.assertEqual(e.registry.names("STREAM"), [u"caf\xe9"])
+        self.assertEqual(e.execute("SELECT typeof(json) FROM log").fetchall(), [("blob",)])
+        e.close()
+        
+        
+class FinalizeTest(TempDirTest):
+    def test_ids_kept(self):
+        e = ExperimentLog(self.fname("final.db"), ntp_sync=False)
+        ids = dict((e.log(["a", "b"][i%2], data={"i":i}), i) for i in range(10))
+        e.finalize()
+        ids[e.log("a", data={"i":10})] = 10
+        e.close()
+        conn = sqlite3.connect(self.fname("final.db"))
+        logged = dict((id, json.loads(js)["i"]) for id, js in conn.execute("SELECT id, json FROM log WHERE json LIKE '{\"i\"%'"))
+        self.assertEqual(logged, ids)
+        # stored clustered by stream
+        streams = [stream for stream, in conn.execute("SELECT stream FROM log WHERE json LIKE '{\"i\"%' ORDER BY rowid")][:10]
+        self.assertEqual(streams, sorted(streams))
+        
+        
+class MergeTest(TempDirTest):
+    def test_packed_into_json_stream(self):
+        e = ExperimentLog(self.fname("target.db"), ntp_sync=False)
+        e.log("s", data={"x":1})
+        e.close()
+        e = ExperimentLog(self.fname("source.db"), ntp_sync=False)
+        for stream in ["s", "new"]:
+            e.create("STREAM", name=stream)
+            e.set_codec(stream, "packed")
+            e.log(stream, data={"x":2})
+        e.close()
+        merge.merge(self.fname("target.db"), [self.fname("source.db")])
+        conn = sqlite3.connect(self.fname("target.db"))
+        # s stays a JSON stream in the target; the new stream keeps its codec, and gets its view
+        self.assertEqual(conn.execute("SELECT json FROM s ORDER BY id").fetchall(), [('{"x": 1}',), ('{"x": 2}',)])
+        self.assertEqual(conn.execute("SELECT meta.name, codec FROM stream_codec JOIN meta ON meta.id=stream_codec.stream").fetchall(), [("new", "packed")])
+        self.assertEqual(conn.execute("SELECT count(*) FROM new").fetchone()[0], 1)
+        
+        
+if __name__=="__main__":
+    unittest.main()
@@ -1,14 +1,142 @@
 import time
 import sys
+import os
+import math
+import json
+import platform
 import logging
 from multiprocessing import Process
 import experimentlog
 import zmq
-from experimentlog import MetaProxy
+from experimentlog import MetaProxy, AnchoredClock
 import traceback
+import sqlite3
+import cPickle
+import random
+import ring
+from collections import defaultdict
 
 # Port used for ZMQ communication
 ZMQ_PORT = 3149
+# Port committed log records are published on
+ZMQ_PUB_PORT = 3150
+# How often (in milliseconds) the server drains the ring buffers of same-host producers
+RING_POLL_MS = 1
+
+# traced log entries waiting to be committed, beyond which new traces are dropped
+TRACE_MAX_PENDING = 100000
+
+# published messages (batches of records of one stream and path) queued for each subscriber, on both
+# sides, beyond which 0MQ drops them; enough to cover a subscriber's catch up (see LogSubscriber)
+PUB_HWM = 100000
+
+def record_topic(stream, path):
+    """ZMQ topic records are published under; subscribers filter on its prefix"""
+    return (u"%s\0%s" % (stream, path)).encode("utf8")
+
+class LatencyHistogram(object):
+    """Histogram of latencies, in power of two buckets of microseconds (bucket i counts latencies
+    below 2**(i+1) us)"""
+    buckets = 32
+    
+    def __init__(self):
+        self.counts = [0] * self.buckets
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+        
+    def add(self, seconds):
+        # timestamps from different hosts can be slightly out of order
+        seconds = max(seconds, 0.0)
+        self.counts[min(int(math.log(max(seconds * 1e6, 1.0), 2)), self.buckets-1)] += 1
+        self.n += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        
+    def percentile(self, q):
+        """Return the upper bound (in seconds) of the bucket holding the qth percentile"""
+        rank, seen = q / 100.0 * self.n, 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(2.0 ** (i+1) * 1e-6, self.max)
+        return self.max
+        
+    def summary(self):
+        return dict(count=self.n, mean=self.total / self.n if self.n else None, p50=self.percentile(50), 
+                    p90=self.percentile(90), p99=self.percentile(99), max=self.max, histogram=list(self.counts))
+    
+
+class LatencyTracer(object):
+    """Latencies of the traced log entries (see LogProxy(trace=...)) received by the server, by client and stream.
+    
+    Each entry is timed through the stages:
+        queued: from being sent by the client to being received by the server (0MQ, or the ring buffer)
+        insert: from being received to being stored
+        commit: from being stored to being committed
+        total: from being sent to being committed
+    Timestamps are taken with the server's clock on both sides (see LogProxy.clock()); clients on other hosts
+    take the sent times with their wall clock, corrected by its offset from the server's, so their queued and
+    total latencies are only as accurate as that offset (to half a round trip).
+    """
+    stages = ["queued", "insert", "commit", "total"]
+    
+    def __init__(self):
+        self.histograms = defaultdict(LatencyHistogram)
+        # id -> (client, stream, sent, inserted), until the entry is committed
+        self.pending = {}
+        self.dropped = 0
+        # the largest id committed so far
+        self.committed_id = 0
+        
+    def inserted(self, id, client, stream, sent, received, inserted):
+        self.histograms[(client, stream, "queued")].add(received - sent)
+        self.histograms[(client, stream, "insert")].add(inserted - received)
+        if id is None:
+            # journal mode: the entry is only committed when the journal is imported
+            return
+        if id <= self.committed_id:
+            # already committed by log() itself (autocommit)
+            self._committed(client, stream, sent, inserted, inserted)
+        elif len(self.pending) < TRACE_MAX_PENDING:
+            self.pending[id] = (client, stream, sent, inserted)
+        else:
+            self.dropped += 1
+            
+    def committed(self, records, now):
+        for record in records:
+            self.committed_id = max(self.committed_id, record.id)
+            trace = self.pending.pop(record.id, None)
+            if trace is not None:
+                self._committed(*(trace + (now,)))
+                
+    def _committed(self, client, stream, sent, inserted, now):
+        self.histograms[(client, stream, "commit")].add(now - inserted)
+        self.histograms[(client, stream, "total")].add(now - sent)
+                
+    def stats(self):
+        """Return a dictionary mapping (client, stream) to a dictionary of stage -> latency summary"""
+        stats = defaultdict(dict)
+        for (client, stream, stage), histogram in self.histograms.iteritems():
+            stats[(client, stream)][stage] = histogram.summary()
+        return dict(stats)
+        
+    def write(self, explog):
+        """Write the latency summaries to the trace_latency table of the log"""
+        if not self.histograms:
+            return
+        explog.execute("""CREATE TABLE IF NOT EXISTS trace_latency (id INTEGER PRIMARY KEY, run INT, client TEXT, stream TEXT, stage TEXT,
+                          count INT, mean REAL, p50 REAL, p90 REAL, p99 REAL, max REAL, histogram TEXT, FOREIGN KEY(run) REFERENCES runs(id))""")
+        for (client, stream), stages in sorted(self.stats().iteritems()):
+            for stage in self.stages:
+                if stage in stages:
+                    s = stages[stage]
+                    explog.execute("INSERT INTO trace_latency(run, client, stream, stage, count, mean, p50, p90, p99, max, histogram) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                                   (explog.run_id, client, stream, stage, s["count"], s["mean"], s["p50"], s["p90"], s["p99"], s["max"], json.dumps(s["histogram"])))
+        if self.dropped:
+            logging.warn("%d traced log entries were not timed to their commit" % self.dropped)
+        explog.commit()
+        
 
 def start_experiment(args, kwargs):
     """Launch the ExperimentLog as a 0MQ server.
@@ -18,6 +146,17 @@ def start_experiment(args, kwargs):
     It responds with a (success, return_value) tuple. Success is True if no
     exception was thrown, and False if one was thrown. In the case of an exception,
     the second argument (return_value) is a tuple (exception, traceback).    
+    
+    Each batch of committed log records is published on port ZMQ_PUB_PORT, as
+    (topic, pickled list of LogRecords) messages, one for each stream and session path.
+    
+    Producers on the same host can instead write log entries to a shared memory ring buffer
+    (see LogProxy(ring_size=...)), registered with the attach_ring and detach_ring requests. The rings are
+    drained every RING_POLL_MS, and before every request, so each producer's entries stay in order
+    with its other calls.
+    
+    The latencies of traced log entries (see LogProxy(trace=...)) are returned by the trace_stats
+    request, and written to the trace_latency table when the log is closed.
     """
     
     stopped = False    
@@ -28,11 +167,93 @@ def start_experiment(args, kwargs):
     
     # create the object
     e = experimentlog.ExperimentLog(*args, **kwargs)
+    
+    # publish the records as they are committed
+    publisher = context.socket(zmq.PUB)
+    publisher.setsockopt(zmq.SNDHWM, PUB_HWM)
+    publisher.bind("tcp://*:%s" % ZMQ_PUB_PORT)
+    def publish(records):
+        groups = defaultdict(list)
+        for record in records:
+            groups[(record.stream, record.path)].append(record)
+        for (stream, path), group in groups.iteritems():
+            publisher.send_multipart([record_topic(stream, path), cPickle.dumps(group, protocol=-1)])
+    e.subscribe(publish)
+    
+    # time traced entries through to their commit
+    tracer = LatencyTracer()
+    e.subscribe(lambda records: tracer.committed(records, e.real_time()))
+    
+    # ring buffers of same-host producers, by file name, and the clients writing them
+    rings = {}
+    ring_clients = {}
+    def drain(fname=None):
+        for name, buf in rings.items():
+            if fname is None or name==fname:
+                entries = []
+                for record in buf.read():
+                    try:
+                        entries.append(ring.unpack_entry(record))
+                    except Exception:
+                        logging.error("Dropped an unreadable entry from ring buffer %s:\n%s" % (name, traceback.format_exc()))
+                received = e.real_time()
+                traces = [entry.pop("trace", None) for entry in entries]
+                while entries:
+                    # an entry which cannot be logged is dropped, and the rest are logged; the server keeps running
+                    try:
+                        ids = e.log_many(entries)
+                        failed = None
+                    except Exception as error:
+                        logging.error("Dropped an entry from ring buffer %s:\n%s" % (name, traceback.format_exc()))
+                        ids = getattr(error, "written", [])
+                        failed = len(ids)
+                    inserted = e.real_time()
+                    for id, entry, sent in zip(ids, entries, traces):
+                        if sent is not None:
+                            tracer.inserted(id, ring_clients[name], entry["stream"], sent, received, inserted)
+                    if failed is None:
+                        break
+                    entries, traces = entries[failed+1:], traces[failed+1:]
+    def attach_ring(fname, client=None):
+        rings[fname] = ring.RingBuffer(fname)
+        ring_clients[fname] = client or fname
+        logging.debug("Attached ring buffer %s" % fname)
+    def detach_ring(fname):
+        drain(fname)
+        rings.pop(fname).close(remove=True)
+        ring_clients.pop(fname)
+        logging.debug("Detached ring buffer %s" % fname)
+    def trace_log(client, sent, stream, **kwargs):
+        id = e.log(stream, **kwargs)
+        tracer.inserted(id, client, stream, sent, received[0], e.real_time())
+        return id
+    def close():
+        # commit the last entries first, so their commit latencies are in the summary
+        e.import_journal()
+        e.commit()
+        tracer.write(e)
+        e.close()
+    # requests handled by the server itself, rather than the log
+    server_requests = {"attach_ring":attach_ring, "detach_ring":detach_ring, "trace_log":trace_log,
+                       "trace_stats":tracer.stats, "close":close}
+    def drain_all():
+        try:
+            drain()
+        except Exception:
+            logging.error("Draining the ring buffers failed:\n%s" % traceback.format_exc())
+    # time the current request was received
+    received = [None]
+    
     while not stopped:        
         # loop, waiting for a request
+        if rings and not socket.poll(RING_POLL_MS):
+            drain_all()
+            continue
+        drain_all()
         cmd, args, kwargs = socket.recv_pyobj()                        
+        received[0] = e.real_time()
         try:
-            fn = getattr(e,cmd)
+            fn = server_requests.get(cmd) or getattr(e,cmd)
             if callable(fn):
                 retval = fn(*args, **kwargs)                        
             else:
@@ -46,26 +267,65 @@ def start_experiment(args, kwargs):
             socket.send_pyobj((False, (info[1], tb)), protocol=-1)
         # update stopped flag
         stopped = not e.opened        
+    for buf in rings.values():
+        buf.close(remove=True)
 
 
 class LogProxy(object):
     """Proxy for an ExperimentLog object. 
     Redirects calls and property accesses to the real, remote logging object
+    
+    Parameters:
+        host: the host the server runs on
+        ring_size: If given, and the server is on this host, log() writes entries to a shared memory
+                   ring buffer of this many bytes, which the server drains, instead of making a 0MQ
+                   round trip for each. log() then returns None rather than the id of the entry.
+                   Call close_ring() when done logging.
+        trace: If given, the fraction (0-1) of log() calls whose latency is traced, from being sent to being
+               committed by the server; see trace_stats()
     """
-    def __init__(self):
+    def __init__(self, host="localhost", ring_size=None, trace=None):
         # connect to the server
         context = zmq.Context()
         self.socket = context.socket(zmq.REQ)
-        self.socket.connect("tcp://localhost:%s" % ZMQ_PORT)
+        self.socket.connect("tcp://%s:%s" % (host, ZMQ_PORT))
+        self.host = host
         # make metadata work the same way as in the ExperimentLog
         self.meta = MetaProxy(self)    
+        self.client = "%s:%d" % (platform.node(), os.getpid())
+        self.trace = trace
+        local = host in ("localhost", "127.0.0.1")
+        if trace:
+            # sent times must be comparable with the server's clock: on the same host, the server's clock
+            # can be used as it is; elsewhere, the monotonic clocks differ, so the local wall clock is used, 
+            # corrected by its offset from the server's
+            self.trace_clock = self.clock() if local else AnchoredClock(offset=self._server_offset())
+        self.ring = None
+        if ring_size is not None:
+            if local:
+                self.ring = ring.RingBuffer(size=ring_size)
+                self._call("attach_ring", (self.ring.fname,), dict(client=self.client))
+                # entries are timestamped when they are logged, not when the server reads them
+                self.ring_clock = self.clock()
+            else:
+                logging.debug("Server is on %s; logging over 0MQ" % host)
+                
+    def _call(self, attr, args, kwargs):
+        self.socket.send_pyobj((attr, args, kwargs), protocol=-1)
+        success, value = self.socket.recv_pyobj()                
+        if success:                
+            return value
+        else:
+            # deal with exceptions in the remote process
+            logging.error(value[1])
+            raise value[0]
     
     def __getattr__(self, attr):             
         if attr=='meta':
             return
             
         # redirect properties
-        if attr in ['bindings', 'session_path', 'session_id', 't', 'in_run', 'random_seed']:
+        if attr in ['bindings', 'session_path', 'session_id', 't', 'in_run', 'random_seed', 'fname', 'clock_anchor', 'registry']:
             self.socket.send_pyobj((attr,(),()))
             success, value = self.socket.recv_pyobj()                
             if success:                
@@ -77,17 +337,133 @@ class LogProxy(object):
         else:
             # redirect calls to the remote object
             def proxy(*args, **kwargs): 
-                self.socket.send_pyobj((attr, args, kwargs), protocol=-1)
-                success, value = self.socket.recv_pyobj()                
-                if success:                
-                    return value
-                else:
-                    # deal with exceptions in the remote process
-                    logging.error(value[1])
-                    raise value[0]
+                return self._call(attr, args, kwargs)
                     
             return proxy
             
+    def log(self, stream, t=None, valid=True, data=None, tag="", binary=None, t_ns=None):
+        """Log an entry on the server; see ExperimentLog.log()"""
+        sent = None
+        if self.trace and random.random() < self.trace:
+            sent = self.trace_clock.time()
+        if self.ring is None:
+            kwargs = dict(t=t, valid=valid, data=data, tag=tag, binary=binary, t_ns=t_ns)
+            if sent is not None:
+                return self._call("trace_log", (self.client, sent, stream), kwargs)
+            return self._call("log", (stream,), kwargs)
+        if not t and t_ns is None:
+            t_ns = self.ring_clock.time_ns()
+        self.ring.write(ring.pack_entry(stream, t, t_ns, valid, data, tag, binary, trace=sent))
+        
+    def close_ring(self):
+        """Stop logging through the ring buffer; the server stores everything written to it first"""
+        if self.ring is not None:
+            self._call("detach_ring", (self.ring.fname,), {})
+            self.ring.close()
+            self.ring = None
+            
+    def trace_stats(self):
+        """Return the latencies of the traced log entries of all clients so far, as a dictionary mapping 
+        (client, stream) to a dictionary of stage -> summary (count, mean, p50, p90, p99 and max, in seconds, 
+        and histogram, the counts in power of two buckets from 1 microsecond). See LatencyTracer for the stages."""
+        return self._call("trace_stats", (), {})
+        
+    def _server_offset(self, samples=5):
+        """Estimate the offset of the server's clock from the local wall clock, in seconds, from the 
+        fastest of a few round trips"""
+        best = None
+        for i in range(samples):
+            start = time.time()
+            server_time = self.real_time()
+            end = time.time()
+            if best is None or end - start < best[0]:
+                best = (end - start, server_time - (start + end) / 2.0)
+        logging.debug("Server clock offset %.6fs (+/- %.6fs)" % (best[1], best[0] / 2.0))
+        return best[1]
+        
+    def clock(self):
+        """Return an AnchoredClock giving the same timestamps as the server's clock, so that
+        timestamps can be taken locally (e.g. log(stream, t_ns=clock.time_ns())) without a round trip"""
+        return AnchoredClock(anchor=self.clock_anchor)
+        
+    def tail(self, streams=None, path=None, from_id=None):
+        """Return a LogSubscriber receiving the records committed by the server. 
+        See LogSubscriber for the parameters."""
+        return LogSubscriber(streams=streams, path=path, from_id=from_id, fname=self.fname, host=self.host)
+        
+        
+class LogSubscriber(object):
+    """Iterate over the log records committed by a ZMQLog server, as they are committed,
+    without polling the database.
+    
+    Parameters:
+        streams: If given, only receive records from these streams (a list of names)
+        path: If given, only receive records from sessions whose path begins with this prefix
+        from_id: If given, first catch up with the records already in the log with id > from_id, read
+                 from the database fname, and then switch to the live records
+        fname: the database file of the server, readable from this host (only needed with from_id)
+        host: the host the server is running on
+        
+    0MQ subscriptions take effect shortly after connecting, so records committed in the meantime are only 
+    received through the catch up: it is read again until the database holds nothing newer, by which time
+    the subscription is live. Live records which arrive during the catch up are queued, up to PUB_HWM 
+    messages; a subscriber which falls further behind than that loses records.
+    """
+    def __init__(self, streams=None, path=None, from_id=None, fname=None, host="localhost"):
+        context = zmq.Context()
+        self.socket = context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.RCVHWM, PUB_HWM)
+        self.socket.connect("tcp://%s:%s" % (host, ZMQ_PUB_PORT))
+        if streams is None:
+            self.socket.setsockopt(zmq.SUBSCRIBE, b"")
+        else:
+            for stream in streams:
+                self.socket.setsockopt(zmq.SUBSCRIBE, record_topic(stream, path or ""))
+        self.streams = streams
+        self.path = path
+        # live records up to this id were already read in the catch up; live records of one commit are
+        # published per stream and path in no particular order, so only these are skipped
+        self.last_id = from_id
+        self.cursor = None
+        if from_id is not None:
+            conn = sqlite3.connect(fname)
+            if conn.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='shards'").fetchone()[0]:
+                # the log is in the shards
+                from extract import open_shards
+                conn.close()
+                conn = open_shards(fname)
+            self.cursor = conn.cursor()
+                        
+    def __iter__(self):
+        """Yield LogRecords, forever"""
+        while self.cursor is not None:
+            # records that are both read and received are skipped by id
+            caught_up = True
+            for batch in experimentlog.read_records(self.cursor, self.last_id, streams=self.streams, path=self.path):
+                for record in batch:
+                    caught_up = False
+                    self.last_id = record.id
+                    yield record
+            if caught_up:
+                self.cursor.connection.close()
+                self.cursor = None
+        while True:
+            for record in self.recv():
+                yield record
+                
+    def recv(self, timeout=None):
+        """Wait for the next batch of live records, and return it as a list. 
+        If timeout (in milliseconds) is given and nothing arrives in that time, returns an empty list."""
+        if timeout is not None and not self.socket.poll(timeout):
+            return []
+        topic, data = self.socket.recv_multipart()
+        records = cPickle.loads(data)
+        if self.path is not None:
+            records = [r for r in records if r.path.startswith(self.path)]
+        if self.last_id is not None:
+            records = [r for r in records if r.id > self.last_id]
+        return records
+    
 
 class ZMQLog(object):
     def __init__(self, *args, **kwargs):
@@ -102,8 +478,6 @@ class ZMQLog(object):
     
         
         
-import random
-    
 def log_remote(name):
     logger = LogProxy()
     for i in range(20):